@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the book-image pipeline (upload-book-image-library.py) on reproducible synthetic inputs.
+
+Why:
+- A full library run takes hours; this catches decode/encode/upload regressions in minutes.
+- Results are machine-readable JSON and can be compared against a stored baseline.
+
+Corpus (seeded, regenerated only when its parameters change):
+  cmyk-tiff   CMYK LZW TIFFs (print scans)
+  alpha-png   RGBA PNGs (diagrams with anti-aliased edges)
+  exif-jpeg   large JPEGs with EXIF orientation 6 (camera photos)
+  psd         flat RGB PSDs
+  svg         small vector files (preserved; hash + upload only)
+
+Stages (per corpus kind, timed over all files, best of --repeat):
+  decode     load_normalized(): planned reduced decode, orientation, sRGB, resize to --max-px
+  transform  resize the normalized image to each --sizes rendition
+  encode     encode_image() at --max-px + every rendition
+  hash       sha256 of the source file and of every encoded output
+  upload     UploadPool to the uploader's in-process MockStorageServer (no network, no Supabase)
+
+Each kind runs in a fresh worker process so its peak RSS (ru_maxrss) is attributable.
+
+Usage:
+  python scripts/books/bench-book-image-pipeline.py --out tmp/book-images-bench/results.json
+  python scripts/books/bench-book-image-pipeline.py --baseline tmp/book-images-bench/baseline.json --max-regression 0.15
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+UPLOADER_PATH = Path(__file__).with_name("upload-book-image-library.py")
+STAGES = ("decode", "transform", "encode", "hash", "upload")
+KINDS = ("cmyk-tiff", "alpha-png", "exif-jpeg", "psd", "svg")
+CORPUS_VERSION = 1
+
+
+def _optional_import(module_name: str):
+    try:
+        return __import__(module_name)
+    except Exception:
+        return None
+
+
+def load_uploader():
+    """Import upload-book-image-library.py (hyphenated file name) as a module."""
+    spec = importlib.util.spec_from_file_location("upload_book_image_library", UPLOADER_PATH)
+    if spec is None or spec.loader is None:
+        raise RuntimeError(f"BLOCKED: cannot load {UPLOADER_PATH}")
+    module = importlib.util.module_from_spec(spec)
+    # Registered before exec: dataclasses resolve string annotations through sys.modules.
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# -----------------------------
+# Synthetic corpus
+# -----------------------------
+
+
+def _page_like(np, rng, h: int, w: int, channels: int):
+    """
+    Textbook-like content: smooth background gradient, a noisy photo region and dark "text" bars,
+    so codecs see realistic entropy (pure noise or flat fills would skew every stage).
+    """
+    y = np.linspace(0, 1, h, dtype=np.float32)[:, None]
+    x = np.linspace(0, 1, w, dtype=np.float32)[None, :]
+    out = np.empty((h, w, channels), dtype=np.uint8)
+    for c in range(channels):
+        out[..., c] = (255 * (0.55 + 0.35 * np.sin(3.1 * x + 1.7 * y + c))).astype(np.uint8)
+    ph, pw = h // 2, w // 2
+    out[h // 8 : h // 8 + ph, w // 3 : w // 3 + pw] = rng.integers(0, 256, (ph, pw, channels), dtype=np.uint8)
+    for row in range(h // 16, h - h // 16, max(8, h // 40)):
+        out[row : row + max(2, h // 200), w // 16 : w // 3] = 20
+    return out
+
+
+def _write_psd(path: Path, rgb) -> None:
+    """Minimal flat 8-bit RGB PSD (no layers, raw image data) - enough for Pillow's PSD reader."""
+    h, w, _ = rgb.shape
+    header = b"8BPS" + (1).to_bytes(2, "big") + bytes(6) + (3).to_bytes(2, "big")
+    header += h.to_bytes(4, "big") + w.to_bytes(4, "big") + (8).to_bytes(2, "big") + (3).to_bytes(2, "big")
+    with path.open("wb") as f:
+        f.write(header)
+        f.write(bytes(4) + bytes(4) + bytes(4))  # color mode data, image resources, layer/mask info
+        f.write((0).to_bytes(2, "big"))  # raw (uncompressed) image data, planar
+        for c in range(3):
+            f.write(rgb[..., c].tobytes())
+
+
+def generate_corpus(root: Path, *, files: int, scale: float, seed: int) -> Path:
+    """Create (or reuse) the corpus for these parameters; returns its directory."""
+    np = _optional_import("numpy")
+    from PIL import Image
+
+    if np is None:
+        raise RuntimeError("BLOCKED: the benchmark corpus requires numpy.")
+
+    params = {"v": CORPUS_VERSION, "files": files, "scale": scale, "seed": seed}
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    corpus = root / f"corpus-{digest}"
+    marker = corpus / "corpus.json"
+    if marker.exists():
+        return corpus
+
+    def dims(w: int, h: int) -> Tuple[int, int]:
+        return max(64, int(w * scale)), max(64, int(h * scale))
+
+    rng = np.random.default_rng(seed)
+    for kind in KINDS:
+        (corpus / kind).mkdir(parents=True, exist_ok=True)
+    for i in range(files):
+        w, h = dims(5000, 3800)
+        cmyk = _page_like(np, rng, h, w, 4)
+        Image.fromarray(cmyk, mode="CMYK").save(corpus / "cmyk-tiff" / f"scan{i}.tif", compression="tiff_lzw")
+        del cmyk
+
+        w, h = dims(3000, 2200)
+        rgba = _page_like(np, rng, h, w, 4)
+        rgba[..., 3] = 0
+        rgba[h // 10 : h - h // 10, w // 10 : w - w // 10, 3] = 255
+        Image.fromarray(rgba, mode="RGBA").save(corpus / "alpha-png" / f"diagram{i}.png")
+        del rgba
+
+        w, h = dims(6000, 4000)
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 CW on display
+        Image.fromarray(_page_like(np, rng, h, w, 3), mode="RGB").save(
+            corpus / "exif-jpeg" / f"photo{i}.jpg", quality=92, exif=exif
+        )
+
+        w, h = dims(3000, 2200)
+        _write_psd(corpus / "psd" / f"layout{i}.psd", _page_like(np, rng, h, w, 3))
+
+        paths = "".join(f'<path d="M{j} 0 L{j * 3} 100" stroke="#{j * 7919 % 0xFFFFFF:06x}"/>' for j in range(200))
+        (corpus / "svg" / f"figure{i}.svg").write_text(
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 800 600">{paths}</svg>', encoding="utf-8"
+        )
+
+    marker.write_text(json.dumps(params, indent=2), encoding="utf-8")
+    return corpus
+
+
+# -----------------------------
+# Stage runner (one corpus kind per worker process)
+# -----------------------------
+
+
+def _peak_rss_mb() -> Optional[float]:
+    resource = _optional_import("resource")
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def bench_kind(kind: str, paths: List[str], opts: Dict[str, object]) -> Dict[str, object]:
+    """Run every stage over one kind's files `repeat` times; keep the fastest time per stage."""
+    m = load_uploader()
+    max_px = int(opts["max_px"])
+    sizes = [int(s) for s in opts["sizes"]]  # type: ignore[union-attr]
+    quality = int(opts["jpeg_quality"])
+    mock = m.MockStorageServer()
+    url = mock.start()
+    best: Dict[str, float] = {}
+    source_bytes = sum(Path(p).stat().st_size for p in paths)
+    output_bytes = 0
+    decode_paths: List[str] = []
+
+    try:
+        for _ in range(int(opts["repeat"])):
+            times = dict.fromkeys(STAGES, 0.0)
+            outputs: List[Tuple[str, str, bytes]] = []
+            for p in paths:
+                path = Path(p)
+                raster = path.suffix.lower() != ".svg"
+                if raster:
+                    t = time.perf_counter()
+                    base, plan = m.load_normalized(path, max_px=max_px, alpha_mode="png")
+                    times["decode"] += time.perf_counter() - t
+                    decode_paths.append(plan)
+
+                    t = time.perf_counter()
+                    resized = []
+                    for px in sizes:
+                        im = base.copy()
+                        im.thumbnail((px, px), m.Image.Resampling.LANCZOS)
+                        resized.append(im)
+                    times["transform"] += time.perf_counter() - t
+
+                    t = time.perf_counter()
+                    encoded = [m.encode_image(base, jpeg_quality=quality)]
+                    encoded += [m.encode_image(im, jpeg_quality=quality) for im in resized]
+                    times["encode"] += time.perf_counter() - t
+                    del base, resized
+                    for j, opt in enumerate(encoded):
+                        outputs.append((f"{kind}/{path.name}.{j}.{opt.output_ext}", m.mime_for_ext(opt.output_ext), opt.output_bytes))
+                else:
+                    outputs.append((f"{kind}/{path.name}", "image/svg+xml", path.read_bytes()))
+
+                t = time.perf_counter()
+                m.sha256_file(path)
+                times["hash"] += time.perf_counter() - t
+            t = time.perf_counter()
+            for _name, _type, data in outputs:
+                m.sha256_bytes(data)
+            times["hash"] += time.perf_counter() - t
+
+            storage = m.SupabaseStorage(supabase_url=url, service_role_key="bench", bucket="bench", timeout_s=60, retries=0)
+            uploader = m.UploadPool(concurrency=int(opts["upload_concurrency"]), storage=storage)
+            t = time.perf_counter()
+            try:
+                futures = [
+                    uploader.submit(object_path=name, content_type=ctype, body=data, upsert=True) for name, ctype, data in outputs
+                ]
+                for fut in futures:
+                    fut.result()
+            finally:
+                uploader.shutdown()
+            times["upload"] = time.perf_counter() - t
+
+            output_bytes = sum(len(data) for _, _, data in outputs)
+            for stage, secs in times.items():
+                best[stage] = min(best.get(stage, secs), secs)
+    finally:
+        mock.stop()
+
+    stages: Dict[str, Dict[str, float]] = {}
+    for stage in STAGES:
+        secs = best[stage]
+        if stage in ("decode", "transform", "encode") and kind == "svg":
+            continue
+        # Throughput is measured against what the stage consumes: sources, except upload (encoded outputs).
+        volume = output_bytes if stage == "upload" else source_bytes
+        stages[stage] = {
+            "seconds": round(secs, 4),
+            "filesPerS": round(len(paths) / secs, 2) if secs > 0 else 0.0,
+            "mbPerS": round(volume / (1024 * 1024) / secs, 2) if secs > 0 else 0.0,
+        }
+    return {
+        "files": len(paths),
+        "sourceBytes": source_bytes,
+        "outputBytes": output_bytes,
+        "decodePaths": sorted(set(decode_paths)),
+        "stages": stages,
+        "peakRssMb": _peak_rss_mb(),
+    }
+
+
+# -----------------------------
+# Baseline comparison
+# -----------------------------
+
+
+def compare(
+    results: Dict[str, object], baseline: Dict[str, object], *, max_regression: float, min_seconds: float
+) -> List[str]:
+    """
+    Print per-stage deltas vs baseline; return the stages slower than max_regression (fraction).
+    Stages under min_seconds in the baseline are reported but never flagged (timer noise).
+    """
+    regressions: List[str] = []
+    base_kinds = baseline.get("kinds") or {}
+    print("\n=== vs baseline ===")
+    for kind, res in results["kinds"].items():  # type: ignore[union-attr]
+        base = base_kinds.get(kind)  # type: ignore[union-attr]
+        if not isinstance(base, dict):
+            print(f"  {kind}: no baseline")
+            continue
+        for stage, cur in res["stages"].items():
+            old = (base.get("stages") or {}).get(stage)
+            if not old or not old.get("seconds"):
+                continue
+            delta = cur["seconds"] / old["seconds"] - 1.0
+            flag = ""
+            if delta > max_regression and old["seconds"] >= min_seconds:
+                flag = "  [REGRESSION]"
+                regressions.append(f"{kind}/{stage}")
+            print(f"  {kind:10s} {stage:9s} {old['seconds']:8.3f}s -> {cur['seconds']:8.3f}s ({delta:+.1%}){flag}")
+        old_rss, cur_rss = base.get("peakRssMb"), res.get("peakRssMb")
+        if old_rss and cur_rss:
+            print(f"  {kind:10s} peak RSS  {old_rss:8.1f}MB -> {cur_rss:8.1f}MB ({cur_rss / old_rss - 1.0:+.1%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work-dir", default="tmp/book-images-bench", help="Corpus + results directory (gitignored).")
+    parser.add_argument("--files", type=int, default=2, help="Files per corpus kind.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale synthetic image dimensions (0.25 = quick run).")
+    parser.add_argument("--seed", type=int, default=1234, help="Corpus RNG seed.")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="Comma-separated corpus kinds to run.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per kind; the fastest time per stage is kept.")
+    parser.add_argument("--max-px", type=int, default=3000, help="Pipeline --max-px.")
+    parser.add_argument("--jpeg-quality", type=int, default=85, help="Pipeline --jpeg-quality.")
+    parser.add_argument("--sizes", default="1200,320", help="Rendition sizes for the transform stage.")
+    parser.add_argument("--upload-concurrency", type=int, default=4, help="UploadPool workers for the upload stage.")
+    parser.add_argument("--out", default="", help="Results JSON path (default: {work-dir}/results-{timestamp}.json).")
+    parser.add_argument("--baseline", default="", help="Baseline results JSON to compare against.")
+    parser.add_argument("--save-baseline", action="store_true", help="Also write the results to --baseline.")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.15,
+        help="Exit 1 if any stage is slower than baseline by more than this fraction.",
+    )
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.05,
+        help="Noise floor: stages faster than this in the baseline are never flagged.",
+    )
+    args = parser.parse_args()
+
+    kinds = [k.strip() for k in args.kinds.split(",") if k.strip()]
+    unknown = [k for k in kinds if k not in KINDS]
+    if unknown:
+        print(f"[BLOCKED] unknown --kinds: {', '.join(unknown)} (use {', '.join(KINDS)})", file=sys.stderr)
+        sys.exit(1)
+
+    work_dir = Path(args.work_dir)
+    t = time.perf_counter()
+    corpus = generate_corpus(work_dir, files=max(1, args.files), scale=args.scale, seed=args.seed)
+    print(f"[OK] corpus: {corpus} ({time.perf_counter() - t:.1f}s)")
+
+    opts = {
+        "max_px": args.max_px,
+        "jpeg_quality": args.jpeg_quality,
+        "sizes": [s for s in args.sizes.split(",") if s.strip()],
+        "repeat": max(1, args.repeat),
+        "upload_concurrency": args.upload_concurrency,
+    }
+    PIL = _optional_import("PIL")
+    np = _optional_import("numpy")
+    results: Dict[str, object] = {
+        "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "env": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pillow": getattr(PIL, "__version__", None),
+            "numpy": getattr(np, "__version__", None),
+        },
+        "params": {"files": args.files, "scale": args.scale, "seed": args.seed, **opts},
+        "kinds": {},
+    }
+
+    for kind in kinds:
+        paths = sorted(str(p) for p in (corpus / kind).iterdir() if p.is_file())
+        # Fresh process per kind: ru_maxrss is a high-water mark, so kinds must not share one.
+        with ProcessPoolExecutor(max_workers=1) as ex:
+            res = ex.submit(bench_kind, kind, paths, opts).result()
+        results["kinds"][kind] = res  # type: ignore[index]
+        summary = ", ".join(f"{s} {v['seconds']:.3f}s" for s, v in res["stages"].items())
+        print(f"  [OK] {kind}: {summary}; peak RSS {res['peakRssMb']} MB")
+
+    out = Path(args.out) if args.out else work_dir / f"results-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"\n[OK] results: {out}")
+
+    if args.baseline:
+        baseline_path = Path(args.baseline)
+        if args.save_baseline:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(results, indent=2), encoding="utf-8")
+            print(f"[OK] baseline saved: {baseline_path}")
+        elif not baseline_path.exists():
+            print(f"[WARN] baseline not found: {baseline_path} (use --save-baseline to create it)", file=sys.stderr)
+        else:
+            baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+            if baseline.get("params") != results["params"]:
+                print("[WARN] baseline was recorded with different parameters; deltas are not comparable.", file=sys.stderr)
+            regressions = compare(results, baseline, max_regression=args.max_regression, min_seconds=args.min_seconds)
+            if regressions:
+                print(f"\n[ERR] {len(regressions)} stage(s) regressed > {args.max_regression:.0%}: {', '.join(regressions)}", file=sys.stderr)
+                sys.exit(1)
+            print("\n[OK] no regressions")
+
+
+if __name__ == "__main__":
+    main()
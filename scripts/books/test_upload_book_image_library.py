@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression tests for upload-book-image-library.py, run end to end against --storage local.
+
+Usage:
+  python -m pytest -q scripts/books/test_upload_book_image_library.py
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+UPLOADER_PATH = Path(__file__).with_name("upload-book-image-library.py")
+
+
+def write_image(path: Path, color) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", (64, 64), color).save(path)
+
+
+def run_uploader(tmp_path: Path, *extra: str) -> subprocess.CompletedProcess:
+    cmd = [
+        sys.executable,
+        str(UPLOADER_PATH),
+        "--root",
+        str(tmp_path / "books"),
+        "--storage",
+        "local",
+        "--local-dir",
+        str(tmp_path / "store"),
+        "--state-dir",
+        str(tmp_path / "state"),
+        *extra,
+    ]
+    r = subprocess.run(cmd, capture_output=True, text=True, cwd=tmp_path)
+    assert r.returncode == 0, r.stdout + r.stderr
+    return r
+
+
+def load_index(tmp_path: Path, book_slug: str) -> Dict[str, object]:
+    return json.loads((tmp_path / "store" / "books" / "library" / book_slug / "images-index.json").read_text(encoding="utf-8"))
+
+
+def stored_names(index: Dict[str, object]) -> Dict[str, str]:
+    entries: List[Dict[str, object]] = index["entries"]  # type: ignore[assignment]
+    return {str(e["originalName"]): str(e["storedName"]) for e in entries}
+
+
+def test_sync_added_file_does_not_take_name_of_changed_file(tmp_path: Path) -> None:
+    images = tmp_path / "books" / "g" / "images"
+    write_image(images / "a_b.jpg", (0, 0, 255))
+    run_uploader(tmp_path)
+
+    # "a b.jpg" sanitizes to a_b.jpg and sorts first; a_b.jpg changes and keeps its object.
+    write_image(images / "a b.jpg", (255, 0, 0))
+    write_image(images / "a_b.jpg", (0, 255, 0))
+    run_uploader(tmp_path, "--sync")
+
+    names = stored_names(load_index(tmp_path, "g"))
+    assert names["a_b.jpg"] == "a_b.jpg"
+    assert names["a b.jpg"] != "a_b.jpg"
+    assert len(set(names.values())) == 2
+
+
+def write_logo(path: Path, *, quality: int) -> None:
+    """Structured image (near-dup hashing ignores flat fills), saved at a given JPEG quality."""
+    from PIL import ImageDraw
+
+    im = Image.new("RGB", (256, 256), "white")
+    draw = ImageDraw.Draw(im)
+    for i in range(0, 256, 32):
+        draw.rectangle([i, i // 2, i + 20, i // 2 + 100], fill=(i, 50, 200 - i // 2))
+    draw.ellipse([60, 120, 200, 240], fill=(20, 20, 20))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    im.save(path, quality=quality)
+
+
+def test_sync_changed_canonical_keeps_object_served_to_near_duplicates(tmp_path: Path) -> None:
+    pytest.importorskip("numpy")
+    write_logo(tmp_path / "books" / "b1" / "images" / "logo.jpg", quality=95)
+    write_logo(tmp_path / "books" / "b2" / "images" / "logo.jpg", quality=80)
+    run_uploader(tmp_path, "--near-dup")
+    dup = load_index(tmp_path, "b2")["entries"][0]  # type: ignore[index]
+    assert dup["duplicateOf"]["storagePath"] == "library/b1/images/logo.jpg"
+
+    write_image(tmp_path / "books" / "b1" / "images" / "logo.jpg", (255, 0, 0))
+    run_uploader(tmp_path, "--near-dup", "--sync")
+
+    bucket = tmp_path / "store" / "books"
+    canonical = load_index(tmp_path, "b1")["entries"][0]  # type: ignore[index]
+    assert canonical["storagePath"] != "library/b1/images/logo.jpg"
+    for book in ("b1", "b2"):
+        for e in load_index(tmp_path, book)["entries"]:  # type: ignore[union-attr]
+            body = (bucket / e["storagePath"]).read_bytes()
+            assert hashlib.sha256(body).hexdigest() == e["storedSha256"], (book, e["storagePath"])
+
+
+def test_renditions_of_colliding_sources_get_distinct_names(tmp_path: Path) -> None:
+    images = tmp_path / "books" / "g" / "images"
+    # x.png's jpeg thumb and x.png.jpg's both want renditions/thumb/x.png.jpg.
+    write_image(images / "x.png", (0, 0, 255))
+    write_image(images / "x.png.jpg", (255, 0, 0))
+    run_uploader(tmp_path, "--renditions", "thumb=32:jpeg")
+
+    def rendition_paths() -> Dict[str, List[str]]:
+        entries: List[Dict[str, object]] = load_index(tmp_path, "g")["entries"]  # type: ignore[assignment]
+        return {str(e["originalName"]): [r["storagePath"] for r in e["renditions"]] for e in entries}  # type: ignore[union-attr]
+
+    first = rendition_paths()
+    assert len({p for paths in first.values() for p in paths}) == 2
+
+    # --sync re-processes the changed file; both keep their rendition paths.
+    write_image(images / "x.png.jpg", (0, 255, 0))
+    run_uploader(tmp_path, "--renditions", "thumb=32:jpeg", "--sync")
+    assert rendition_paths() == first
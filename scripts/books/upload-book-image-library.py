@@ -10,38 +10,91 @@ Why:
 
 Input layout (local):
   books/{book_slug}/images/{files...}
+  or the archive itself (--root extracted_images.zip):
+  extracted_images/{book_slug}/linked_images/{files...}
 
 Output layout (Supabase Storage bucket `books`):
   library/{book_slug}/images/{original_filename}            (when preserved)
   library/{book_slug}/images/{original_filename}.{ext}      (when converted)
+  library/{book_slug}/renditions/{name}/{stored_name}[.{ext}]  (--renditions, e.g. thumb/web/print;
+                                                              jpeg of an image with alpha -> PNG under --alpha-mode png;
+                                                              __dupN per folder when two sources map to one name)
   library/{book_slug}/images-index.json
+  library/{book_slug}/images-index.min.json.gz              (lookup-only: minified, gzipped, normalized keys)
+  library/{book_slug}/images-index.min/{key_prefix}.json.gz (--compact-index-prefix-len N)
+  library/{book_slug}/shards/images-index.{i}-of-{N}.json  (--shard with books split by file, until --merge-shards)
 
 Notes:
 - Very large / non-web-friendly formats (TIFF/PSD) are converted to JPEG/PNG.
 - We cap the max pixel dimension to keep uploads practical while preserving print readability.
 - Secrets are resolved from env + local env files without printing values.
+- --storage local|mock runs the same pipeline without credentials (directory / in-process HTTP stand-in).
+- --reconcile-remote lists the bucket instead of trusting --state-dir, so a fresh machine only uploads what is missing.
+- --near-dup maps near-identical images (re-exports, shared logos) across books to one canonical object.
+- --shard i/N spreads a rebuild over N machines; results do not depend on which machine ran which shard.
+- --jpeg-target-ssim picks the JPEG quality per image (flat diagrams need far less than dense photos).
+- --root extracted_images.zip streams images from the archive (no extraction pass); resume state and
+  indexes are the same as for the folders organize_book_images.py would extract.
+- --plan projects a run (convert/preserve, upload volume, runtime) from image headers in seconds.
+- --workers N admits images by estimated decode memory (--memory-budget-mb), largest first, so a few
+  giant scans cannot exhaust RAM or end up as the tail of the batch.
 """
 
 from __future__ import annotations
 
 import argparse
+import base64
+import bisect
+import gzip
 import hashlib
+import heapq
+import importlib.util
+import io
 import json
 import math
 import os
+import random
 import re
+import struct
 import sys
+import threading
 import time
-from dataclasses import dataclass
+import zipfile
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
-from urllib.parse import quote
+from typing import IO, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, TypeVar, Union
+from urllib.parse import quote, unquote, urljoin
 
 import requests
-from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
 from PIL import UnidentifiedImageError
 
 
+def _lazy_module(name: str):
+    """
+    Import `name` on first attribute access (importlib's LazyLoader), so --help, --plan and
+    --merge-shards start without paying for imaging modules they may never touch.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ImportError(f"No module named {name!r}")
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+Image = _lazy_module("PIL.Image")
+ImageMode = _lazy_module("PIL.ImageMode")
+ImageOps = _lazy_module("PIL.ImageOps")
+
+
 # -----------------------------
 # Env resolution (no printing)
 # -----------------------------
@@ -138,6 +191,135 @@ def resolve_env(required: List[str]) -> Dict[str, str]:
     return resolved
 
 
+# -----------------------------
+# Color conversion (shared by the Pillow and streaming TIFF paths)
+# -----------------------------
+
+# ICC transforms are expensive to build (profile parsing + LUT precalc) but a library tends to use
+# a handful of profiles, so they are built once per (profile, in mode, out mode) and reused for
+# every image in this process. None marks a profile littlecms rejected (fall back to naive).
+_ICC_TRANSFORMS: Dict[Tuple[str, str, str], object] = {}
+_ICC_LOCK = threading.Lock()
+_CMYK_LUT = None
+
+# Pixels per block for LUT conversion: bounds the index temporaries numpy creates for fancy indexing.
+COLOR_BLOCK_PIXELS = 1 << 18
+
+
+def _image_cms():
+    try:
+        from PIL import ImageCms
+
+        return ImageCms
+    except ImportError:
+        return None
+
+
+def icc_transform(icc_profile: bytes, in_mode: str, out_mode: str):
+    """Cached littlecms transform from an embedded profile to sRGB (None if unavailable/invalid)."""
+    key = (hashlib.sha1(icc_profile).hexdigest(), in_mode, out_mode)
+    with _ICC_LOCK:
+        if key in _ICC_TRANSFORMS:
+            return _ICC_TRANSFORMS[key]
+    transform = None
+    ImageCms = _image_cms()
+    if ImageCms is not None:
+        from io import BytesIO
+
+        try:
+            transform = ImageCms.buildTransform(
+                ImageCms.ImageCmsProfile(BytesIO(icc_profile)),
+                ImageCms.createProfile("sRGB"),
+                in_mode,
+                out_mode,
+                renderingIntent=ImageCms.Intent.PERCEPTUAL,
+            )
+        except Exception:
+            transform = None
+    with _ICC_LOCK:
+        _ICC_TRANSFORMS[key] = transform
+    return transform
+
+
+def to_rgb_image(im: Image.Image, *, keep_alpha: bool) -> Image.Image:
+    """
+    Pillow path: convert any mode to sRGB "RGB" (or "RGBA" when keep_alpha).
+
+    An embedded ICC profile is honored through a cached transform; without one (or if littlecms
+    rejects it) Pillow's own conversion is used, which matches cmyk_to_rgb_u8() for CMYK.
+    The returned image carries no icc_profile (its pixels are sRGB now).
+    """
+    out_mode = "RGBA" if keep_alpha else "RGB"
+    icc = im.info.get("icc_profile")
+    if icc:
+        src = im
+        if src.mode in ("P", "PA", "LA", "I;16", "I", "F", "1"):
+            src = src.convert("RGBA" if keep_alpha else ("L" if src.mode in ("I;16", "I", "F", "1") else "RGB"))
+        in_mode = src.mode
+        if in_mode in ("RGB", "RGBA", "CMYK", "L"):
+            # littlecms keeps alpha only for RGBA -> RGBA; other sources have none to keep.
+            cms_out = out_mode if in_mode == "RGBA" else "RGB"
+            transform = icc_transform(icc, in_mode, cms_out)
+            if transform is not None:
+                out = _image_cms().applyTransform(src, transform)
+                if out.mode != out_mode:
+                    out = out.convert(out_mode)
+                out.info.pop("icc_profile", None)
+                return out
+    if im.mode != out_mode:
+        im = im.convert(out_mode)
+    im.info.pop("icc_profile", None)
+    return im
+
+
+def _cmyk_lut(np):
+    """LUT[c, k] -> RGB channel, bit-exact with Pillow's CMYK->RGB (nk - MULDIV255(c, nk))."""
+    global _CMYK_LUT
+    if _CMYK_LUT is None:
+        c = np.arange(256, dtype=np.int32)[:, None]
+        nk = 255 - np.arange(256, dtype=np.int32)[None, :]
+        tmp = c * nk + 128
+        _CMYK_LUT = (nk - (((tmp >> 8) + tmp) >> 8)).clip(0, 255).astype(np.uint8)
+    return _CMYK_LUT
+
+
+def cmyk_to_rgb_u8(cmyk, *, np, icc_profile: Optional[bytes] = None):
+    """
+    uint8 (..., 4+) CMYK array -> new uint8 (..., 3) RGB array.
+
+    With an ICC profile the cached littlecms transform runs on the raw buffer; otherwise a 256x256
+    LUT is applied in blocks of COLOR_BLOCK_PIXELS (no float temporaries).
+    """
+    shape = cmyk.shape[:-1]
+    flat = cmyk.reshape(-1, cmyk.shape[-1])
+    if icc_profile:
+        transform = icc_transform(icc_profile, "CMYK", "RGB")
+        if transform is not None and flat.shape[0]:
+            h = shape[0] if len(shape) == 2 else 1
+            src = Image.frombuffer("CMYK", (flat.shape[0] // h, h), np.ascontiguousarray(flat[:, :4]), "raw", "CMYK", 0, 1)
+            out = _image_cms().applyTransform(src, transform)
+            return np.asarray(out, dtype=np.uint8).reshape(*shape, 3)
+    lut = _cmyk_lut(np)
+    rgb = np.empty((flat.shape[0], 3), dtype=np.uint8)
+    for i in range(0, flat.shape[0], COLOR_BLOCK_PIXELS):
+        block = flat[i : i + COLOR_BLOCK_PIXELS]
+        k = block[:, 3]
+        for ch in range(3):
+            rgb[i : i + COLOR_BLOCK_PIXELS, ch] = lut[block[:, ch], k]
+    return rgb.reshape(*shape, 3)
+
+
+def rgb_icc_to_srgb_u8(rgb, *, np, icc_profile: Optional[bytes]):
+    """uint8 (h, w, 3) RGB in an embedded profile -> sRGB (returned unchanged without a usable profile)."""
+    if not icc_profile:
+        return rgb
+    transform = icc_transform(icc_profile, "RGB", "RGB")
+    if transform is None:
+        return rgb
+    src = Image.fromarray(np.ascontiguousarray(rgb), mode="RGB")
+    return np.asarray(_image_cms().applyTransform(src, transform), dtype=np.uint8)
+
+
 # -----------------------------
 # Image processing
 # -----------------------------
@@ -154,11 +336,52 @@ def _optional_import(name: str):
         return None
 
 
+class StageTimer:
+    """
+    Accumulates wall time per pipeline stage (seconds by stage name) for one file.
+    Plain data, so it travels back from --workers processes inside PreparedFile.
+    """
+
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + (time.perf_counter() - t)
+
+
+@contextmanager
+def pixel_limit(max_pixels: int) -> Iterator[None]:
+    """
+    Pillow's decompression-bomb limit (Image.MAX_IMAGE_PIXELS) for the duration of a block; 0 = no limit.
+    Sources are trusted local assets and decode memory is bounded by the scheduler's admission control,
+    so the limit is a guard rail, not a default. Restored afterwards: nothing else in the process inherits it.
+    """
+    prev = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = int(max_pixels) if max_pixels > 0 else None
+    try:
+        yield
+    finally:
+        Image.MAX_IMAGE_PIXELS = prev
+
+
 def sha256_bytes(b: bytes) -> str:
     h = hashlib.sha256()
     h.update(b)
     return h.hexdigest()
 
+
+def sha256_file(path: SourceFile) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
 def safe_storage_filename(name: str, *, max_len: int = 180) -> str:
     """
     Supabase Storage validates object keys. We keep filenames deterministic and safe:
@@ -198,6 +421,8 @@ def mime_for_ext(ext: str) -> str:
         return "image/png"
     if e == "webp":
         return "image/webp"
+    if e == "avif":
+        return "image/avif"
     if e == "gif":
         return "image/gif"
     if e == "svg":
@@ -209,7 +434,7 @@ def mime_for_ext(ext: str) -> str:
     return "application/octet-stream"
 
 
-def should_convert(path: Path, *, max_upload_mb: int) -> bool:
+def should_convert(path: SourceFile, *, max_upload_mb: int) -> bool:
     ext = path.suffix.lower().lstrip(".")
     if ext in CONVERT_FROM_EXTS:
         return True
@@ -221,6 +446,42 @@ def should_convert(path: Path, *, max_upload_mb: int) -> bool:
     return size_mb > max_upload_mb
 
 
+@dataclass(frozen=True)
+class OptimizeSettings:
+    """
+    Everything that controls how a source is converted. Picklable, so it travels to --workers processes.
+    """
+
+    max_px: int
+    jpeg_quality: int
+    alpha_mode: str
+    max_upload_mb: int
+    # Streaming TIFF reducer resources (never change the output bytes).
+    tiff_memory_mb: int = 1024
+    tiff_threads: int = 4
+    renditions: Tuple["RenditionSpec", ...] = ()
+    # --near-dup: also return a HashProbe per raster image (never changes the output bytes).
+    near_dup: bool = False
+    # Pillow decompression-bomb limit while decoding sources (0 = none; see pixel_limit()).
+    max_image_pixels: int = 0
+    # --jpeg-target-ssim: per-image JPEG quality search within (min, max); 0 = fixed jpeg_quality.
+    target_ssim: float = 0.0
+    jpeg_quality_range: Tuple[int, int] = (50, 95)
+
+    def output_ident(self) -> Dict[str, object]:
+        """The settings that determine output bytes (rendition cache key)."""
+        ident: Dict[str, object] = {
+            "maxPx": int(self.max_px),
+            "jpegQuality": int(self.jpeg_quality),
+            "alphaMode": self.alpha_mode,
+            "maxUploadMb": self.max_upload_mb,
+        }
+        if self.target_ssim > 0:
+            ident["targetSsim"] = float(self.target_ssim)
+            ident["jpegQualityRange"] = list(self.jpeg_quality_range)
+        return ident
+
+
 @dataclass
 class OptimizedImage:
     output_bytes: bytes
@@ -228,482 +489,4482 @@ class OptimizedImage:
     width: int
     height: int
     mode: str
+    encode_attempts: int = 1
+    decode_path: str = ""
+    # JPEG outputs: the quality used and, when it was searched (--jpeg-target-ssim), the probe SSIM.
+    quality: Optional[int] = None
+    ssim: Optional[float] = None
+
+
+# Reduced-resolution decoding keeps at least this factor above the target before the final LANCZOS
+# resample (same default as Pillow's thumbnail(reducing_gap=2.0)), so quality is unaffected.
+DECODE_REDUCING_GAP = 2
+# Modes where Image.reduce() averages meaningful values (not palette indices / bit planes).
+REDUCIBLE_MODES = {"L", "LA", "RGB", "RGBA", "CMYK", "I", "F"}
+
+
+def _pick_reduced_tiff_frame(src: Image.Image, min_side: int) -> int:
+    """
+    Smallest reduced-resolution TIFF page (NewSubfileType bit 0, same aspect ratio as page 0) whose
+    long side is still >= min_side. Returns 0 (the full-resolution page) when there is none.
+    """
+    w0, h0 = src.size
+    best, best_side = 0, max(w0, h0)
+    try:
+        for i in range(1, int(getattr(src, "n_frames", 1))):
+            src.seek(i)
+            w, h = src.size
+            if not (int(src.tag_v2.get(254, 0)) & 1):
+                continue
+            if abs(w / float(h) - w0 / float(h0)) > 0.01 * (w0 / float(h0)):
+                continue
+            if min_side <= max(w, h) < best_side:
+                best, best_side = i, max(w, h)
+    finally:
+        src.seek(0)
+    return best
 
 
-def optimize_image(path: Path, *, max_px: int, jpeg_quality: int, alpha_mode: str) -> OptimizedImage:
+def load_normalized(
+    path: SourceFile,
+    *,
+    max_px: int,
+    alpha_mode: str,
+    tiff_memory_mb: int = 1024,
+    tiff_threads: int = 4,
+    timer: Optional[StageTimer] = None,
+) -> Tuple[Image.Image, str]:
     """
-    Convert to a render-friendly JPEG/PNG and downscale to max_px.
+    Decode once into a render-ready in-memory image: EXIF orientation applied, RGB or RGBA
+    (RGBA flattened onto white for alpha_mode=flatten-white-jpeg) and downscaled to max_px.
+
+    Decode planner: when the source is much larger than max_px, use the cheapest format-native
+    reduced decode first (JPEG DCT scaling via draft(), a reduced-resolution TIFF page, then an
+    integer box reduce() before mode conversion); only the final resample uses LANCZOS.
+    Returns (image, plan) where plan records the path taken, e.g. "draft/4+reduce/2+lanczos".
+    Stage times (decode, exif_transpose, convert, resize) are added to `timer` when given.
     """
+    timer = timer or StageTimer()
     try:
-        with Image.open(path) as im:
+        with decode_input(path) as source, Image.open(source) as src:
+            with timer.stage("decode"):
+                plan: List[str] = []
+                min_side = max_px * DECODE_REDUCING_GAP
+                w, h = src.size
+                if src.format == "JPEG" and max(w, h) >= 2 * min_side:
+                    scale = min_side / float(max(w, h))
+                    src.draft(None, (max(1, int(math.ceil(w * scale))), max(1, int(math.ceil(h * scale)))))
+                    if src.size != (w, h):
+                        plan.append(f"draft/{max(1, round(w / float(src.size[0])))}")
+                elif src.format == "TIFF" and getattr(src, "n_frames", 1) > 1 and max(w, h) >= 2 * min_side:
+                    frame = _pick_reduced_tiff_frame(src, min_side)
+                    if frame:
+                        src.seek(frame)
+                        plan.append(f"tiff-page{frame}")
+
+                im = src
+                factor = max(im.size) // min_side
+                if factor >= 2 and im.mode in REDUCIBLE_MODES:
+                    im = im.reduce(int(factor))
+                    plan.append(f"reduce/{factor}")
+                else:
+                    im.load()
+
             # Fix common orientation issues based on EXIF (JPEG)
-            im = ImageOps.exif_transpose(im)
+            with timer.stage("exif_transpose"):
+                im = ImageOps.exif_transpose(im)
 
-            # Normalize modes
-            has_alpha = ("A" in im.getbands()) or (im.mode in ("LA", "RGBA"))
+            with timer.stage("convert"):
+                # Normalize modes
+                has_alpha = ("A" in im.getbands()) or (im.mode in ("LA", "RGBA"))
 
-            # Convert CMYK/P/etc to RGB/RGBA
-            if has_alpha:
-                if im.mode != "RGBA":
-                    im = im.convert("RGBA")
-            else:
-                if im.mode != "RGB":
-                    im = im.convert("RGB")
+                # Convert CMYK/P/etc to sRGB RGB/RGBA (embedded ICC profiles honored)
+                im = to_rgb_image(im, keep_alpha=has_alpha)
 
             # Downscale (do not upscale)
             w, h = im.size
             if max(w, h) > max_px:
-                im.thumbnail((max_px, max_px), Image.Resampling.LANCZOS)
-
-            out_w, out_h = im.size
+                with timer.stage("resize"):
+                    im.thumbnail((max_px, max_px), Image.Resampling.LANCZOS, reducing_gap=None)
+                plan.append("lanczos")
 
-            # Encode
-            from io import BytesIO
-
-            buf = BytesIO()
-            if has_alpha:
-                if alpha_mode == "flatten-white-jpeg":
-                    # Many textbook PNGs contain alpha for anti-aliased edges, but are rendered
-                    # on white pages. Flattening to white preserves print readability while
-                    # allowing JPEG compression (much smaller than PNG at full resolution).
+            if has_alpha and alpha_mode == "flatten-white-jpeg":
+                # Many textbook PNGs contain alpha for anti-aliased edges, but are rendered
+                # on white pages. Flattening to white preserves print readability while
+                # allowing JPEG compression (much smaller than PNG at full resolution).
+                with timer.stage("convert"):
                     bg = Image.new("RGB", im.size, (255, 255, 255))
                     bg.paste(im, mask=im.split()[-1])
-                    bg.save(
-                        buf,
-                        format="JPEG",
-                        quality=jpeg_quality,
-                        optimize=True,
-                        progressive=True,
-                    )
-                    return OptimizedImage(buf.getvalue(), "jpg", out_w, out_h, "RGB")
+                    im = bg
 
-                # Default: preserve transparency as PNG
-                im.save(buf, format="PNG", optimize=True)
-                return OptimizedImage(buf.getvalue(), "png", out_w, out_h, im.mode)
-            else:
-                im.save(
-                    buf,
-                    format="JPEG",
-                    quality=jpeg_quality,
-                    optimize=True,
-                    progressive=True,
-                )
-                return OptimizedImage(buf.getvalue(), "jpg", out_w, out_h, im.mode)
+            im.load()
+            return im, "+".join(plan) or "full"
     except UnidentifiedImageError:
         # Some very large/complex TIFFs cannot be decoded by Pillow on Windows.
-        # Fall back to a streaming downsample using tifffile + imagecodecs + zarr.
+        # Fall back to a streaming downsample using tifffile + imagecodecs.
         ext = path.suffix.lower().lstrip(".")
         if ext not in ("tif", "tiff"):
             raise
-        return optimize_tiff_streaming(path, max_px=max_px, jpeg_quality=jpeg_quality)
+        # The streaming reducer interleaves decode, box filter and color conversion per band.
+        with timer.stage("decode"):
+            return decode_tiff_streaming(path, max_px=max_px, memory_mb=tiff_memory_mb, threads=tiff_threads)
 
 
-def optimize_tiff_streaming(path: Path, *, max_px: int, jpeg_quality: int) -> OptimizedImage:
+def encode_image(im: Image.Image, *, jpeg_quality: int) -> OptimizedImage:
+    """
+    Encode a load_normalized() image: RGBA -> PNG (transparency preserved), anything else -> JPEG.
     """
-    Streaming downsample for TIFFs that Pillow cannot decode (e.g., huge CMYK+alpha LZW strips).
+    from io import BytesIO
 
-    Strategy:
-    - Use tifffile.aszarr() to access strips as chunks (rowsperstrip chunks)
-    - Sample rows/cols via slicing to keep output <= max_px
-    - Convert CMYK -> RGB (ignore extra samples) and encode JPEG
+    buf = BytesIO()
+    out_w, out_h = im.size
+    if im.mode == "RGBA":
+        im.save(buf, format="PNG", optimize=True)
+        return OptimizedImage(buf.getvalue(), "png", out_w, out_h, im.mode)
+    im.save(
+        buf,
+        format="JPEG",
+        quality=jpeg_quality,
+        optimize=True,
+        progressive=True,
+    )
+    return OptimizedImage(buf.getvalue(), "jpg", out_w, out_h, "RGB", quality=int(jpeg_quality))
+
+
+# -----------------------------
+# Perceptual JPEG quality (--jpeg-target-ssim)
+# -----------------------------
+
+# Probe: SSIM_PROBE_TILES tiles of SSIM_PROBE_TILE px cut from the image at full resolution. Tiles sit
+# on the 16 px MCU grid in both the image and the mosaic, so JPEG encodes every probe block exactly as
+# it would in the full image; a downscaled probe would average away the very artifacts being measured.
+SSIM_PROBE_TILE = 64
+SSIM_PROBE_TILES = 64
+SSIM_PROBE_COLUMNS = 8
+# Sliding window for the local SSIM statistics (box filter, stride 1).
+SSIM_WINDOW = 8
+# Score = mean SSIM of the worst tiles: text edges on white paper must not hide behind the paper.
+SSIM_WORST_FRACTION = 0.25
+
+
+def _luma(np, im: Image.Image):
+    rgb = np.asarray(im.convert("RGB"), dtype=np.float64)
+    return rgb @ np.array([0.299, 0.587, 0.114])
+
+
+def ssim_probe_image(im: Image.Image) -> Tuple[Image.Image, int]:
+    """
+    A small, representative stand-in for `im` and its tile size: tiles at evenly spaced quantiles of
+    local contrast (flat paper, gradients, text edges, photo detail) in a mosaic. Small images are
+    used whole, as one tile.
     """
-    tf = _optional_import("tifffile")
-    zarr = _optional_import("zarr")
     np = _optional_import("numpy")
-    if tf is None or zarr is None or np is None:
-        raise RuntimeError(
-            "BLOCKED: TIFF streaming fallback requires python packages: tifffile, zarr, numpy (and imagecodecs for compressed TIFFs)."
-        )
+    t = SSIM_PROBE_TILE
+    w, h = im.size
+    nx, ny = w // t, h // t
+    if np is None or nx * ny < SSIM_PROBE_TILES:
+        return im, 0
+    gray = np.asarray(im.convert("L"), dtype=np.float32)[: ny * t, : nx * t]
+    var = gray.reshape(ny, t, nx, t).var(axis=(1, 3)).ravel()
+    order = np.argsort(var, kind="stable")
+    picks = order[np.linspace(0, len(order) - 1, SSIM_PROBE_TILES).round().astype(int)]
+    cols = SSIM_PROBE_COLUMNS
+    mosaic = Image.new(im.mode, (cols * t, -(-len(picks) // cols) * t))
+    for n, k in enumerate(picks.tolist()):
+        ty, tx = divmod(k, nx)
+        mosaic.paste(im.crop((tx * t, ty * t, tx * t + t, ty * t + t)), ((n % cols) * t, (n // cols) * t))
+    return mosaic, t
 
-    # Disable decompression bomb limits for trusted local assets.
-    Image.MAX_IMAGE_PIXELS = None
-
-    with tf.TiffFile(str(path)) as tif:
-        page = tif.pages[0]
-        shape = page.shape
-        if len(shape) < 2:
-            raise RuntimeError("Unsupported TIFF shape")
-        height = int(shape[0])
-        width = int(shape[1])
-        samples = int(shape[2]) if len(shape) >= 3 else 1
-
-        # Compute step so output <= max_px
-        step_y = max(1, int(math.ceil(height / float(max_px))))
-        step_x = max(1, int(math.ceil(width / float(max_px))))
-
-        store = page.aszarr()
-        arr = zarr.open(store, mode="r")
-        # Slice reads only required strip chunks; columns are still full-width per chunk (TIFF strip layout),
-        # but we reduce chunk count by step_y.
-        sampled = arr[0:height:step_y, 0:width:step_x]
-
-        if sampled.ndim == 2:
-            sampled = sampled[:, :, None]
-
-        # Convert to RGB
-        if samples >= 4:
-            # Many textbook exports are CMYK (+ optional extra). Use first 4 as CMYK.
-            cmyk = sampled[:, :, 0:4].astype(np.float32)
-            C = cmyk[:, :, 0]
-            M = cmyk[:, :, 1]
-            Y = cmyk[:, :, 2]
-            K = cmyk[:, :, 3]
-            r = 255.0 * (1.0 - C / 255.0) * (1.0 - K / 255.0)
-            g = 255.0 * (1.0 - M / 255.0) * (1.0 - K / 255.0)
-            b = 255.0 * (1.0 - Y / 255.0) * (1.0 - K / 255.0)
-            rgb = np.stack([r, g, b], axis=-1).clip(0, 255).astype(np.uint8)
-            pil = Image.fromarray(rgb, mode="RGB")
-            out_w, out_h = pil.size
-            from io import BytesIO
-            buf = BytesIO()
-            pil.save(buf, format="JPEG", quality=jpeg_quality, optimize=True, progressive=True)
-            return OptimizedImage(buf.getvalue(), "jpg", out_w, out_h, "RGB")
-
-        if samples == 3:
-            rgb = sampled[:, :, 0:3].astype(np.uint8)
-            pil = Image.fromarray(rgb, mode="RGB")
-            out_w, out_h = pil.size
-            from io import BytesIO
-            buf = BytesIO()
-            pil.save(buf, format="JPEG", quality=jpeg_quality, optimize=True, progressive=True)
-            return OptimizedImage(buf.getvalue(), "jpg", out_w, out_h, "RGB")
 
-        # Grayscale
-        gray = sampled[:, :, 0].astype(np.uint8)
-        pil = Image.fromarray(gray, mode="L").convert("RGB")
-        out_w, out_h = pil.size
+def _window_means(np, x):
+    """Box-window means (SSIM_WINDOW, stride 1) per item of an (n, h, w) stack, via integral images."""
+    k = max(1, min(SSIM_WINDOW, x.shape[1], x.shape[2]))
+    c = np.pad(x, ((0, 0), (1, 0), (1, 0))).cumsum(1).cumsum(2)
+    return (c[:, k:, k:] - c[:, :-k, k:] - c[:, k:, :-k] + c[:, :-k, :-k]) / (k * k)
+
+
+class JpegQualityProbe:
+    """
+    SSIM of the probe after a JPEG round trip, memoized per quality: per-tile mean SSIM on luma
+    (0-255, box windows), scored as the mean of the worst SSIM_WORST_FRACTION of tiles.
+    Reference-side window statistics are computed once.
+    """
+
+    C1 = (0.01 * 255) ** 2
+    C2 = (0.03 * 255) ** 2
+
+    def __init__(self, im: Image.Image) -> None:
+        self.np = _optional_import("numpy")
+        if self.np is None:
+            raise RuntimeError("BLOCKED: --jpeg-target-ssim requires numpy.")
+        ref, self.tile = ssim_probe_image(im)
+        self.ref = ref.convert("RGB")
+        self.ref_luma = self._tiles(_luma(self.np, self.ref))
+        self.mu_ref = _window_means(self.np, self.ref_luma)
+        self.var_ref = _window_means(self.np, self.ref_luma * self.ref_luma) - self.mu_ref * self.mu_ref
+        self.scores: Dict[int, float] = {}
+
+    def _tiles(self, y):
+        if not self.tile:
+            return y[None]
+        t = self.tile
+        rows, cols = y.shape[0] // t, y.shape[1] // t
+        return y.reshape(rows, t, cols, t).swapaxes(1, 2).reshape(rows * cols, t, t)
+
+    def _ssim_tiles(self, b):
+        np = self.np
+        mu_b = _window_means(np, b)
+        var_b = _window_means(np, b * b) - mu_b * mu_b
+        cov = _window_means(np, self.ref_luma * b) - self.mu_ref * mu_b
+        num = (2 * self.mu_ref * mu_b + self.C1) * (2 * cov + self.C2)
+        den = (self.mu_ref * self.mu_ref + mu_b * mu_b + self.C1) * (self.var_ref + var_b + self.C2)
+        return (num / den).mean(axis=(1, 2))
+
+    def score(self, quality: int) -> float:
         from io import BytesIO
-        buf = BytesIO()
-        pil.save(buf, format="JPEG", quality=jpeg_quality, optimize=True, progressive=True)
-        return OptimizedImage(buf.getvalue(), "jpg", out_w, out_h, "RGB")
+
+        if quality not in self.scores:
+            # optimize/progressive only change the entropy coding, never the decoded pixels.
+            buf = BytesIO()
+            self.ref.save(buf, format="JPEG", quality=int(quality))
+            buf.seek(0)
+            with Image.open(buf) as dec:
+                per_tile = self.np.sort(self._ssim_tiles(self._tiles(_luma(self.np, dec))))
+            worst = max(1, int(len(per_tile) * SSIM_WORST_FRACTION))
+            self.scores[quality] = float(per_tile[:worst].mean())
+        return self.scores[quality]
+
+
+def search_jpeg_quality(im: Image.Image, *, target: float, lo: int, hi: int) -> Tuple[int, float]:
+    """
+    Lowest JPEG quality in [lo, hi] whose probe SSIM reaches `target` (bisection; SSIM rises with
+    quality). Returns (quality, ssim); hi when even hi misses the target.
+    """
+    probe = JpegQualityProbe(im)
+    if probe.score(hi) < target or lo >= hi:
+        return hi, probe.score(hi)
+    if probe.score(lo) >= target:
+        return lo, probe.score(lo)
+    # Invariant: lo misses the target, hi reaches it.
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if probe.score(mid) >= target:
+            hi = mid
+        else:
+            lo = mid
+    return hi, probe.score(hi)
+
+
+def encode_image_targeted(im: Image.Image, settings: OptimizeSettings) -> OptimizedImage:
+    """encode_image() at settings.jpeg_quality, or at the searched quality when --jpeg-target-ssim is set."""
+    if settings.target_ssim <= 0 or im.mode == "RGBA":
+        return encode_image(im, jpeg_quality=settings.jpeg_quality)
+    lo, hi = settings.jpeg_quality_range
+    quality, score = search_jpeg_quality(im, target=settings.target_ssim, lo=lo, hi=hi)
+    opt = encode_image(im, jpeg_quality=quality)
+    opt.ssim = round(score, 5)
+    return opt
 
 
 # -----------------------------
-# Supabase Storage upload
+# Renditions (--renditions: several sizes/formats from one decode)
 # -----------------------------
 
+# format -> (file extension, Pillow encoder name)
+RENDITION_FORMATS: Dict[str, Tuple[str, str]] = {
+    "jpeg": ("jpg", "JPEG"),
+    "webp": ("webp", "WEBP"),
+    "avif": ("avif", "AVIF"),
+}
 
-def storage_upload(
-    *,
-    session: requests.Session,
-    supabase_url: str,
-    service_role_key: str,
-    bucket: str,
-    object_path: str,
-    content_type: str,
-    body: bytes,
-    upsert: bool,
-    timeout_s: int,
-) -> None:
-    url = f"{supabase_url.rstrip('/')}/storage/v1/object/{bucket}/{quote(object_path, safe='/')}"
-    headers = {
-        "Authorization": f"Bearer {service_role_key}",
-        "Content-Type": content_type,
-        "x-upsert": "true" if upsert else "false",
-    }
-    r = session.post(url, headers=headers, data=body, timeout=timeout_s)
-    if r.status_code >= 400:
-        # Avoid printing secrets; response body is safe.
-        raise RuntimeError(f"Upload failed ({r.status_code}): {r.text[:300]}")
 
-def storage_upload_with_retries(
-    *,
-    session: requests.Session,
-    supabase_url: str,
-    service_role_key: str,
-    bucket: str,
-    object_path: str,
-    content_type: str,
-    body: bytes,
-    upsert: bool,
-    timeout_s: int,
-    retries: int,
-) -> None:
-    attempt = 0
-    while True:
-        try:
-            storage_upload(
-                session=session,
-                supabase_url=supabase_url,
-                service_role_key=service_role_key,
-                bucket=bucket,
-                object_path=object_path,
-                content_type=content_type,
-                body=body,
-                upsert=upsert,
-                timeout_s=timeout_s,
-            )
-            return
-        except (requests.RequestException, RuntimeError) as e:
-            attempt += 1
-            if attempt > retries:
-                raise
-            # Exponential backoff with cap; no secret printing.
-            sleep_s = min(60.0, 1.5 ** attempt)
-            print(f"  [WARN] upload retry {attempt}/{retries} after error: {str(e)[:120]}", file=sys.stderr)
-            time.sleep(sleep_s)
+@dataclass(frozen=True)
+class RenditionSpec:
+    name: str
+    max_px: int
+    formats: Tuple[str, ...]
 
-def write_json_atomic(path: Path, obj: object) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    tmp = path.with_suffix(path.suffix + ".tmp")
-    tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(path)
+    def ident(self) -> Dict[str, object]:
+        return {"name": self.name, "maxPx": self.max_px, "formats": list(self.formats)}
 
 
-def main() -> None:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--root", default="books", help="Local root folder containing book directories.")
-    parser.add_argument("--bucket", default="books", help="Supabase Storage bucket (default: books).")
-    parser.add_argument("--prefix", default="library", help="Storage prefix under the bucket.")
-    parser.add_argument("--max-px", type=int, default=3000, help="Max pixel dimension for optimized images.")
-    parser.add_argument("--jpeg-quality", type=int, default=85, help="JPEG quality for optimized images.")
-    parser.add_argument("--max-upload-mb", type=int, default=40, help="Convert files larger than this MB.")
-    parser.add_argument(
-        "--convert-all",
-        action="store_true",
-        help="Force conversion/optimization for ALL non-SVG images (even if below --max-upload-mb). Useful to reduce PDF size by converting small RGB PNGs to JPEG.",
-    )
-    parser.add_argument(
-        "--alpha-mode",
-        type=str,
-        default="png",
-        choices=["png", "flatten-white-jpeg"],
-        help="How to encode images with an alpha channel: png=preserve transparency (larger), flatten-white-jpeg=flatten onto white and encode JPEG (smaller).",
-    )
-    parser.add_argument("--upsert", action="store_true", help="Overwrite existing objects.")
-    parser.add_argument("--timeout-s", type=int, default=600, help="HTTP timeout per upload request.")
-    parser.add_argument("--retries", type=int, default=5, help="Retry count for transient upload errors.")
-    parser.add_argument("--state-dir", default="tmp/book-images-upload-state", help="Local resume state dir (gitignored).")
-    parser.add_argument("--no-resume", action="store_true", help="Disable resume and reprocess every file.")
-    parser.add_argument("--only-book", default="", help="Process only a single book slug (for smoke tests).")
-    parser.add_argument("--limit", type=int, default=0, help="Max files per book (0 = no limit).")
-    parser.add_argument("--dry-run", action="store_true", help="Do not upload; just report what would happen.")
-    args = parser.parse_args()
+@dataclass
+class RenditionOutput:
+    name: str
+    format: str
+    body: bytes
+    ext: str
+    width: int
+    height: int
+    sha256: str
+    quality: Optional[int] = None
+    ssim: Optional[float] = None
 
-    env = resolve_env(["SUPABASE_URL", "SUPABASE_SERVICE_ROLE_KEY"])
-    supabase_url = env["SUPABASE_URL"]
-    service_key = env["SUPABASE_SERVICE_ROLE_KEY"]
 
-    root = Path(args.root)
-    if not root.exists():
-        print(f"[BLOCKED] root folder not found: {root}", file=sys.stderr)
-        sys.exit(1)
+def parse_renditions(spec: str) -> Tuple[RenditionSpec, ...]:
+    """
+    Parse --renditions, e.g. "thumb=320:jpeg+webp,web=1200:jpeg+webp,print=3000:jpeg".
 
-    book_dirs = [p for p in root.iterdir() if p.is_dir()]
-    if args.only_book:
-        book_dirs = [p for p in book_dirs if p.name == args.only_book]
-        if not book_dirs:
-            print(f"[BLOCKED] --only-book '{args.only_book}' not found under {root}", file=sys.stderr)
-            sys.exit(1)
+    Raises ValueError for malformed specs, duplicate names and formats this Pillow cannot encode.
+    """
+    from PIL import features
 
-    total_uploaded = 0
-    start = time.time()
-    session = requests.Session()
+    out: List[RenditionSpec] = []
+    for part in [p.strip() for p in spec.split(",") if p.strip()]:
+        m = re.fullmatch(r"([a-z0-9_-]+)=(\d+):([a-z0-9+]+)", part)
+        if not m:
+            raise ValueError(f"invalid rendition '{part}' (expected name=px:fmt[+fmt...])")
+        name, px, fmts = m.group(1), int(m.group(2)), tuple(dict.fromkeys(m.group(3).split("+")))
+        if px <= 0:
+            raise ValueError(f"rendition '{name}': px must be > 0")
+        if any(r.name == name for r in out):
+            raise ValueError(f"duplicate rendition name '{name}'")
+        for fmt in fmts:
+            if fmt not in RENDITION_FORMATS:
+                raise ValueError(f"rendition '{name}': unknown format '{fmt}' (use {', '.join(RENDITION_FORMATS)})")
+            if fmt != "jpeg" and not features.check(fmt):
+                raise ValueError(f"rendition '{name}': this Pillow build cannot encode {fmt}")
+        out.append(RenditionSpec(name=name, max_px=px, formats=fmts))
+    return tuple(out)
 
-    for book_dir in sorted(book_dirs, key=lambda p: p.name):
-        book_slug = book_dir.name
-        images_dir = book_dir / "images"
-        if not images_dir.exists():
+
+def encode_rendition(im: Image.Image, fmt: str, *, quality: int) -> OptimizedImage:
+    """
+    Encode one rendition. "jpeg" follows encode_image(): with --alpha-mode png an RGBA image stays
+    PNG (indexed as format "png", requestedFormat "jpeg"); WebP/AVIF keep alpha.
+    """
+    if fmt == "jpeg":
+        return encode_image(im, jpeg_quality=quality)
+    from io import BytesIO
+
+    ext, pil_format = RENDITION_FORMATS[fmt]
+    buf = BytesIO()
+    im.save(buf, format=pil_format, quality=quality)
+    return OptimizedImage(buf.getvalue(), ext, im.size[0], im.size[1], im.mode)
+
+
+def render_renditions(
+    base: Image.Image,
+    specs: Tuple[RenditionSpec, ...],
+    *,
+    settings: OptimizeSettings,
+    cached: Optional[Dict[Tuple[str, str], OptimizedImage]] = None,
+    timer: Optional[StageTimer] = None,
+) -> Dict[Tuple[str, str], OptimizedImage]:
+    """
+    All (rendition, format) outputs from one normalized image. Sizes never exceed the base
+    (itself capped at --max-px); entries already in `cached` are returned as-is.
+    JPEG renditions get their own quality search under --jpeg-target-ssim (artifacts show
+    differently at each size); WebP/AVIF use --jpeg-quality.
+    """
+    timer = timer or StageTimer()
+    out: Dict[Tuple[str, str], OptimizedImage] = dict(cached or {})
+    for spec in specs:
+        missing = [fmt for fmt in spec.formats if (spec.name, fmt) not in out]
+        if not missing:
             continue
+        im = base
+        if max(base.size) > spec.max_px:
+            with timer.stage("resize"):
+                im = base.copy()
+                im.thumbnail((spec.max_px, spec.max_px), Image.Resampling.LANCZOS)
+        for fmt in missing:
+            with timer.stage("encode"):
+                if fmt == "jpeg":
+                    out[(spec.name, fmt)] = encode_image_targeted(im, settings)
+                else:
+                    out[(spec.name, fmt)] = encode_rendition(im, fmt, quality=settings.jpeg_quality)
+    return out
 
-        state_dir = Path(args.state_dir)
-        state_path = state_dir / f"{book_slug}.json"
-        resume_enabled = not args.no_resume and not args.dry_run
-        state: Dict[str, object] = {}
-        if resume_enabled and state_path.exists():
-            try:
-                state = json.loads(state_path.read_text(encoding="utf-8"))
-            except Exception:
-                state = {}
-        uploaded_by_original = state.get("uploadedByOriginal", {}) if isinstance(state.get("uploadedByOriginal"), dict) else {}
-
-        files = [p for p in images_dir.iterdir() if p.is_file()]
-        if args.limit and args.limit > 0:
-            files = files[: args.limit]
-
-        print(f"\nBOOK {book_slug}: {len(files)} files")
-
-        index: Dict[str, object] = {
-            "bookSlug": book_slug,
-            "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-            "maxPx": args.max_px,
-            "jpegQuality": args.jpeg_quality,
-            "alphaMode": args.alpha_mode,
-            "entries": [],
-            "srcMap": {},
-        }
-        used_names: Dict[str, int] = {}
 
-        for i, path in enumerate(files, start=1):
-            original_name = path.name
-            ext = path.suffix.lower().lstrip(".")
+def renditions_for(file_name: str, specs: Tuple[RenditionSpec, ...]) -> Tuple[RenditionSpec, ...]:
+    """Configured renditions for a source; vector images (SVG) already scale and get none."""
+    return () if file_name.lower().endswith(".svg") else specs
 
-            if resume_enabled and original_name in uploaded_by_original:
-                entry = uploaded_by_original.get(original_name)
-                if isinstance(entry, dict) and isinstance(entry.get("storagePath"), str):
-                    index["entries"].append(entry)  # type: ignore
-                    index["srcMap"][original_name] = entry["storagePath"]  # type: ignore
-                    if i % 50 == 0 or i == len(files):
-                        print(f"  [OK] resume-skip {i}/{len(files)}")
-                    continue
 
-            try:
-                original_size = path.stat().st_size
-            except Exception:
-                original_size = 0
+def rendition_object_name(stored_name: str, ext: str) -> str:
+    """Rendition file name: the stored name, plus the rendition extension when it differs."""
+    return stored_name if stored_name.lower().endswith(f".{ext}") else safe_storage_filename(f"{stored_name}.{ext}")
 
-            # Decide whether to preserve as-is or optimize
-            do_convert = (
-                args.convert_all
-                or should_convert(path, max_upload_mb=args.max_upload_mb)
-                or ext not in SUPPORTED_PRESERVE_EXTS
-            )
 
-            object_name: str
-            content_type: str
-            body: bytes
-            width = None
-            height = None
-            mode = None
-            output_ext: str
-
-            if ext == "svg" and not do_convert:
-                body = path.read_bytes()
-                output_ext = "svg"
-                object_name = safe_storage_filename(original_name)
-                content_type = "image/svg+xml"
-            else:
-                if do_convert:
-                    # Adaptive: if output is still too large, downscale further until under max_upload_mb.
-                    max_bytes = int(args.max_upload_mb * 1024 * 1024)
-                    cur_px = int(args.max_px)
-                    cur_q = int(args.jpeg_quality)
-                    last_err: Optional[Exception] = None
-                    opt: Optional[OptimizedImage] = None
-                    for _ in range(8):
-                        try:
-                            opt = optimize_image(path, max_px=cur_px, jpeg_quality=cur_q, alpha_mode=args.alpha_mode)
-                            if len(opt.output_bytes) <= max_bytes:
-                                break
-                            # Reduce size: lower px primarily, then quality if already small.
-                            cur_px = max(800, int(cur_px * 0.85))
-                            cur_q = max(65, int(cur_q - 4))
-                        except Exception as e:
-                            last_err = e
-                            # If conversion failed, try a smaller target once more.
-                            cur_px = max(800, int(cur_px * 0.85))
-                            cur_q = max(65, int(cur_q - 4))
-                            continue
-                    if not opt:
-                        raise RuntimeError(f"Failed to convert image: {type(last_err).__name__ if last_err else 'unknown'}")
-                    if len(opt.output_bytes) > max_bytes:
-                        raise RuntimeError(
-                            f"BLOCKED: Optimized image is still too large ({len(opt.output_bytes)} bytes). "
-                            f"Lower --max-px or --max-upload-mb and retry."
-                        )
+def entry_has_renditions(entry: Dict[str, object], specs: Tuple[RenditionSpec, ...]) -> bool:
+    """True if an index entry already lists every configured (rendition, format)."""
+    have = {
+        (r.get("name"), r.get("requestedFormat") or r.get("format"))
+        for r in entry.get("renditions") or []  # type: ignore[union-attr]
+        if isinstance(r, dict)
+    }
+    return all((spec.name, fmt) in have for spec in specs for fmt in spec.formats)
 
-                    body = opt.output_bytes
-                    output_ext = opt.output_ext
-                    width, height, mode = opt.width, opt.height, opt.mode
-                    # Ensure uniqueness and make mapping explicit (e.g. foo.tif.jpg)
-                    object_name = f"{original_name}.{output_ext}" if output_ext != ext else original_name
-                    object_name = safe_storage_filename(object_name)
-                    content_type = mime_for_ext(output_ext)
-                else:
-                    body = path.read_bytes()
-                    output_ext = ext
-                    object_name = safe_storage_filename(original_name)
-                    content_type = mime_for_ext(ext)
-
-            # Ensure uniqueness within this book prefix (deterministic-ish): append counter if needed.
-            if object_name in used_names:
-                used_names[object_name] += 1
-                base, ext2 = os.path.splitext(object_name)
-                object_name = safe_storage_filename(f"{base}__dup{used_names[object_name]}{ext2}")
-            else:
-                used_names[object_name] = 0
-
-            object_path = f"{args.prefix}/{book_slug}/images/{object_name}"
-
-            entry = {
-                "originalName": original_name,
-                "storedName": object_name,
-                "storagePath": object_path,
-                "originalBytes": original_size,
-                "storedBytes": len(body),
-                "storedExt": output_ext,
-                "storedMime": content_type,
-                "storedSha256": sha256_bytes(body),
-            }
-            if width and height:
-                entry["width"] = width
-                entry["height"] = height
-            if mode:
-                entry["mode"] = mode
 
-            # Index structures are created above; keep them simple and JSON-friendly.
-            index["entries"].append(entry)  # type: ignore
-            index["srcMap"][original_name] = object_path  # type: ignore
+def entry_storage_paths(entry: Dict[str, object]) -> List[str]:
+    """Every object an index entry owns (stored image + renditions); a near-duplicate owns none."""
+    if entry.get("duplicateOf"):
+        return []
+    paths = [str(entry["storagePath"])] if isinstance(entry.get("storagePath"), str) else []
+    for r in entry.get("renditions") or []:  # type: ignore[union-attr]
+        if isinstance(r, dict) and isinstance(r.get("storagePath"), str):
+            paths.append(r["storagePath"])
+    return paths
 
-            if args.dry_run:
-                if i % 25 == 0 or i == len(files):
-                    print(f"  (dry-run) {i}/{len(files)}")
-                continue
 
-            try:
-                storage_upload_with_retries(
-                    session=session,
-                    supabase_url=supabase_url,
-                    service_role_key=service_key,
-                    bucket=args.bucket,
-                    object_path=object_path,
-                    content_type=content_type,
-                    body=body,
-                    upsert=args.upsert,
-                    timeout_s=int(args.timeout_s),
-                    retries=int(args.retries),
-                )
-                total_uploaded += 1
-            except Exception as e:
-                msg = str(e)
-                print(f"  [ERR] upload failed ({book_slug}/{original_name}): {msg[:200]}", file=sys.stderr)
-                # Fail fast: these assets are required for later deterministic rendering.
-                sys.exit(1)
-
-            if resume_enabled:
-                # Persist resume state incrementally to survive crashes.
-                uploaded_by_original[original_name] = entry
-                state = {
-                    "bookSlug": book_slug,
-                    "updatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-                    "uploadedByOriginal": uploaded_by_original,
-                }
-                write_json_atomic(state_path, state)
+def decode_tiff_streaming(
+    path: SourceFile, *, max_px: int, memory_mb: int = 1024, threads: int = 4
+) -> Tuple[Image.Image, str]:
+    """
+    Streaming, area-averaged downsample for TIFFs that Pillow cannot decode (e.g., huge CMYK+alpha LZW strips).
+
+    Strategy:
+    - Pick an integer box factor f = floor(max(h, w) / max_px) and walk the image in horizontal
+      bands of k*f rows, so every band maps to whole output rows.
+    - Per band, read only the strips/tiles it overlaps (raw bytes under a file lock) and decode them
+      with tifffile in worker threads (the codecs release the GIL).
+    - Box-filter each band (sum of every f x f block / pixel count) straight into the output raster;
+      only the final resample to max_px uses LANCZOS.
+    - Peak memory = output raster + threads x (band incl. straddling strips + block sums). Band height
+      and thread count are derived from memory_mb; if one minimal band cannot fit, fail instead of swapping.
+    - Convert CMYK/RGB -> sRGB (extra samples ignored, embedded ICC profile honored) per reduced band
+      with the shared color engine, so the output raster is already RGB.
+    """
+    tf = _optional_import("tifffile")
+    np = _optional_import("numpy")
+    if tf is None or np is None:
+        raise RuntimeError(
+            "BLOCKED: TIFF streaming fallback requires python packages: tifffile, numpy (and imagecodecs for compressed TIFFs)."
+        )
 
-            if i % 25 == 0 or i == len(files):
-                print(f"  [OK] uploaded {i}/{len(files)}")
+    with decode_input(path) as source, tf.TiffFile(source) as tif:
+        page, plan = _pick_tiff_level(tif, min_side=int(max_px) * DECODE_REDUCING_GAP)
+        shaped = page.shaped  # (planes, depth, height, width, samples-per-segment)
+        if shaped[1] != 1:
+            raise RuntimeError("Unsupported TIFF shape (volumetric)")
+        height, width = int(shaped[2]), int(shaped[3])
+        planar = page.planarconfig == 2
+        samples = int(shaped[0]) if planar else int(shaped[4])
+        photometric = int(page.photometric)
+        icc_tag = page.tags.get(34675)  # InterColorProfile
+        icc = bytes(icc_tag.value) if icc_tag is not None and icc_tag.value else None
+        if page.dtype is None or page.dtype.kind != "u" or page.dtype.itemsize > 2:
+            raise RuntimeError(f"Unsupported TIFF sample type: {page.dtype}")
+        max_value = float(2 ** (8 * page.dtype.itemsize) - 1)
 
-        # Upload index JSON
-        index_path = f"{args.prefix}/{book_slug}/images-index.json"
-        index_bytes = json.dumps(index, ensure_ascii=False, indent=2).encode("utf-8")
-        if args.dry_run:
-            print(f"  (dry-run) would upload index: {index_path}")
+        # Keep only the color samples (gray / RGB / CMYK); extra samples (alpha, spot) are ignored.
+        if photometric == 5 and samples >= 4:
+            keep = 4
+        elif samples >= 3:
+            keep = 3
         else:
-            storage_upload_with_retries(
-                session=session,
-                supabase_url=supabase_url,
-                service_role_key=service_key,
-                bucket=args.bucket,
-                object_path=index_path,
-                content_type="application/json",
-                body=index_bytes,
-                upsert=True,
-                timeout_s=int(args.timeout_s),
-                retries=int(args.retries),
+            keep = 1
+
+        f = max(1, max(height, width) // max(1, int(max_px)))
+        if f > 1:
+            plan.append(f"box/{f}")
+        out_h, out_w = -(-height // f), -(-width // f)
+        out = np.empty((out_h, out_w, 1 if keep == 1 else 3), dtype=np.uint8)
+
+        # Segment layout: planes (outermost) x chunk rows x chunk columns.
+        chunk_h = int(page.tilelength) if page.is_tiled else int(page.rowsperstrip or height)
+        chunk_h = max(1, min(chunk_h, height))
+        chunks_down = -(-height // chunk_h)
+        chunks_across = -(-width // int(page.tilewidth)) if page.is_tiled else 1
+        offsets, bytecounts = page.dataoffsets, page.databytecounts
+        planes = max(1, len(offsets) // (chunks_down * chunks_across))
+
+        # Memory plan: rows of decoded pixels in a band + the strips straddling its edges, plus the
+        # row sums (1/f of the band rows, 8-byte accumulators). The output raster (and its final RGB image copy)
+        # is reserved up front.
+        row_bytes = width * keep * page.dtype.itemsize
+        per_row = row_bytes + (width * keep * 8) / f
+        budget = int(memory_mb) * 1024 * 1024 - 2 * out.nbytes
+        threads = max(1, int(threads))
+        min_band_bytes = (f + 2 * chunk_h) * per_row
+        while threads > 1 and min_band_bytes * threads > budget:
+            threads -= 1
+        if min_band_bytes > budget:
+            raise RuntimeError(
+                f"BLOCKED: streaming TIFF reduce needs ~{int((min_band_bytes + 2 * out.nbytes) / 2**20)} MB "
+                f"(strip of {chunk_h} rows x {width} px); raise --tiff-memory-mb."
+            )
+        band_rows = max(f, int(budget / threads / per_row - 2 * chunk_h) // f * f)
+        if threads > 1:
+            # Enough bands (~4 per thread) to keep every thread busy.
+            band_rows = min(band_rows, max(f, -(-height // (threads * 4 * f)) * f))
+        band_rows = min(band_rows, -(-height // f) * f)
+
+        lock = threading.Lock()
+        fh = tif.filehandle
+        acc_dtype = np.uint64 if page.dtype.itemsize > 1 else np.uint32
+
+        def reduce_band(y0: int) -> None:
+            y1 = min(height, y0 + band_rows)
+            band = np.zeros((y1 - y0, width, keep), dtype=page.dtype)
+            for cr in range(y0 // chunk_h, -(-y1 // chunk_h)):
+                for plane in range(planes):
+                    if planar and plane >= keep:
+                        continue
+                    for cx in range(chunks_across):
+                        i = (plane * chunks_down + cr) * chunks_across + cx
+                        if not bytecounts[i]:
+                            continue
+                        with lock:
+                            fh.seek(offsets[i])
+                            data = fh.read(bytecounts[i])
+                        seg, idx, _ = page.decode(data, i)
+                        if seg is None:
+                            continue
+                        seg = seg.reshape(seg.shape[-3:])  # (rows, cols, samples)
+                        sy, sx = int(idx[2]), int(idx[3])
+                        a, z = max(sy, y0), min(sy + seg.shape[0], y1, height)
+                        cols = min(seg.shape[1], width - sx)
+                        if a >= z or cols <= 0:
+                            continue
+                        src = seg[a - sy : z - sy, :cols]
+                        if planar:
+                            band[a - y0 : z - y0, sx : sx + cols, plane] = src[..., 0]
+                        else:
+                            band[a - y0 : z - y0, sx : sx + cols, :] = src[..., :keep]
+                        del seg, src
+
+            # Box filter: f x f block sums (partial edge blocks included), then / pixel count.
+            sums = _box_sum(_box_sum(band, f, axis=0, acc_dtype=acc_dtype, np=np), f, axis=1, acc_dtype=acc_dtype, np=np)
+            del band
+            row_counts = np.minimum(f, (y1 - y0) - np.arange(0, y1 - y0, f))
+            col_counts = np.minimum(f, width - np.arange(0, width, f))
+            counts = row_counts[:, None] * col_counts[None, :]
+            means = sums * (255.0 / max_value) / counts[..., None]
+            del sums
+            block = np.rint(means, out=means).clip(0, 255, out=means).astype(np.uint8)
+            del means
+            o0 = y0 // f
+            out[o0 : o0 + block.shape[0]] = _tiff_block_to_rgb(block, photometric=photometric, icc_profile=icc, np=np)
+
+        starts = list(range(0, height, band_rows))
+        if threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="tiff") as ex:
+                for _ in ex.map(reduce_band, starts):
+                    pass
+        else:
+            for y0 in starts:
+                reduce_band(y0)
+
+    pil = Image.fromarray(out[:, :, 0], mode="L").convert("RGB") if keep == 1 else Image.fromarray(out, mode="RGB")
+    if max(pil.size) > max_px:
+        pil.thumbnail((max_px, max_px), Image.Resampling.LANCZOS, reducing_gap=None)
+        plan.append("lanczos")
+    return pil, "+".join(plan) or "full"
+
+
+def _pick_tiff_level(tif, *, min_side: int):
+    """
+    Full-resolution page of the first series, or its smallest reduced-resolution level (pyramid
+    SubIFDs / reduced pages as exposed by tifffile) whose long side is still >= min_side.
+    Returns (page, plan tokens).
+    """
+    page = tif.pages[0]
+    best, best_k = page, 0
+    series = tif.series[0] if tif.series else None
+    for k, level in enumerate(getattr(series, "levels", None) or [], start=0):
+        if k == 0:
+            continue
+        cand = level.keyframe
+        h, w = int(cand.imagelength), int(cand.imagewidth)
+        if abs(w / float(h) - page.imagewidth / float(page.imagelength)) > 0.01 * page.imagewidth / float(page.imagelength):
+            continue
+        if min_side <= max(h, w) < max(int(best.imagelength), int(best.imagewidth)):
+            best, best_k = cand, k
+    return best, ([f"tiff-level{best_k}"] if best_k else [])
+
+
+def _box_sum(a, f: int, *, axis: int, acc_dtype, np):
+    """
+    Sum consecutive groups of f along axis 0 or 1 (last group may be shorter).
+
+    Uses reshape + sum(dtype=...) so numpy casts in small buffers; np.add.reduceat with a wider
+    dtype would first materialize a full-size widened copy of the band.
+    """
+    n = a.shape[axis]
+    full = n // f * f
+    parts = []
+    if axis == 0:
+        if full:
+            parts.append(a[:full].reshape(full // f, f, *a.shape[1:]).sum(axis=1, dtype=acc_dtype))
+        if full < n:
+            parts.append(a[full:].sum(axis=0, keepdims=True, dtype=acc_dtype))
+    else:
+        if full:
+            parts.append(a[:, :full].reshape(a.shape[0], full // f, f, *a.shape[2:]).sum(axis=2, dtype=acc_dtype))
+        if full < n:
+            parts.append(a[:, full:].sum(axis=1, keepdims=True, dtype=acc_dtype))
+    return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=axis)
+
+
+def _tiff_block_to_rgb(block, *, photometric: int, icc_profile: Optional[bytes], np):
+    """Reduced uint8 block (gray/RGB/CMYK samples) -> uint8 RGB (or single-channel gray)."""
+    samples = block.shape[2]
+    if samples >= 4:
+        # Many textbook exports are CMYK (+ optional extra). Use first 4 as CMYK.
+        return cmyk_to_rgb_u8(block, np=np, icc_profile=icc_profile)
+
+    if samples == 3:
+        return rgb_icc_to_srgb_u8(block, np=np, icc_profile=icc_profile)
+
+    # Grayscale (photometric 0 = min-is-white)
+    return np.subtract(255, block, out=block) if photometric == 0 else block
+
+
+# -----------------------------
+# Optimized rendition cache (local disk)
+# -----------------------------
+
+
+class RenditionCache:
+    """
+    On-disk cache of optimize_image_adaptive() outputs, shared across runs, buckets and environments.
+
+    Key: source content sha256 + source size + every setting that changes the output
+    (max_px, jpeg_quality, alpha_mode, max_upload_mb). Hashing a multi-GB scan is still much
+    cheaper than decoding it, and the source hash itself is memoized per path under (size, mtime),
+    so unchanged files are not re-read at all.
+
+    Layout:
+      {root}/sources/{sha1(path)}.json     {size, mtimeNs, sha256}
+      {root}/objects/{k[:2]}/{k}.bin       encoded bytes
+      {root}/objects/{k[:2]}/{k}.json      OptimizedImage metadata
+
+    LRU: a hit touches the .json mtime; prune() evicts least recently used entries beyond max_bytes.
+    Writes are tmp-and-rename with per-process tmp names, so worker processes can share the cache.
+    """
+
+    VERSION = 2
+
+    def __init__(self, root: Path, *, max_bytes: int) -> None:
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+
+    def source_sha256(self, path: SourceFile) -> str:
+        st = path.stat()
+        ident = str(path) if isinstance(path, ZipMember) else str(path.resolve())
+        memo_path = self.root / "sources" / (hashlib.sha1(ident.encode("utf-8")).hexdigest() + ".json")
+        try:
+            memo = json.loads(memo_path.read_text(encoding="utf-8"))
+            if memo.get("size") == st.st_size and memo.get("mtimeNs") == st.st_mtime_ns:
+                return str(memo["sha256"])
+        except Exception:
+            pass
+        digest = sha256_file(path)
+        memo = {"size": st.st_size, "mtimeNs": st.st_mtime_ns, "sha256": digest}
+        self._write_atomic(memo_path, json.dumps(memo).encode("utf-8"))
+        return digest
+
+    def key_for(self, path: SourceFile, settings: OptimizeSettings) -> str:
+        ident = {
+            "v": self.VERSION,
+            "sha256": self.source_sha256(path),
+            "size": path.stat().st_size,
+            **settings.output_ident(),
+        }
+        return sha256_bytes(json.dumps(ident, sort_keys=True).encode("utf-8"))
+
+    def key_for_rendition(self, path: SourceFile, settings: OptimizeSettings, spec: RenditionSpec, fmt: str) -> str:
+        ident = {
+            "v": self.VERSION,
+            "sha256": self.source_sha256(path),
+            "size": path.stat().st_size,
+            **settings.output_ident(),
+            "rendition": spec.max_px,
+            "format": fmt,
+        }
+        return sha256_bytes(json.dumps(ident, sort_keys=True).encode("utf-8"))
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        d = self.root / "objects" / key[:2]
+        return d / f"{key}.bin", d / f"{key}.json"
+
+    def get(self, key: str) -> Optional[OptimizedImage]:
+        bin_path, meta_path = self._paths(key)
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            data = bin_path.read_bytes()
+        except Exception:
+            return None
+        if len(data) != meta.get("bytes"):
+            return None
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+        return OptimizedImage(
+            output_bytes=data,
+            output_ext=str(meta["outputExt"]),
+            width=int(meta["width"]),
+            height=int(meta["height"]),
+            mode=str(meta["mode"]),
+            encode_attempts=int(meta.get("encodeAttempts") or 0),
+            decode_path=str(meta.get("decodePath") or ""),
+            quality=meta.get("quality"),
+            ssim=meta.get("ssim"),
+        )
+
+    def put(self, key: str, opt: OptimizedImage) -> None:
+        bin_path, meta_path = self._paths(key)
+        meta = {
+            "bytes": len(opt.output_bytes),
+            "outputExt": opt.output_ext,
+            "width": opt.width,
+            "height": opt.height,
+            "mode": opt.mode,
+            "encodeAttempts": opt.encode_attempts,
+            "decodePath": opt.decode_path,
+            "quality": opt.quality,
+            "ssim": opt.ssim,
+        }
+        # Payload first: a .json without its .bin is never visible as a hit.
+        self._write_atomic(bin_path, opt.output_bytes)
+        self._write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+    def prune(self) -> Tuple[int, int]:
+        """Evict least recently used entries until the cache fits max_bytes. Returns (evicted, bytes_kept)."""
+        entries: List[Tuple[float, int, Path, Path]] = []
+        for meta_path in (self.root / "objects").glob("*/*.json"):
+            bin_path = meta_path.with_suffix(".bin")
+            try:
+                entries.append((meta_path.stat().st_mtime, bin_path.stat().st_size, bin_path, meta_path))
+            except OSError:
+                continue
+        total = sum(e[1] for e in entries)
+        evicted = 0
+        for _, size, bin_path, meta_path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            for p in (meta_path, bin_path):
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+        return evicted, total
+
+# -----------------------------
+# Near-duplicate detection (--near-dup)
+# -----------------------------
+
+# Grayscale probes per image: 32x32 for pHash (low DCT frequencies), 9x8 for dHash (row gradients).
+PHASH_SIZE = 32
+DHASH_SIZE = (9, 8)
+# Probes flatter than this (pixel std-dev, 0..255) hash to near-constant bits and would match any
+# other flat image (blank pages, solid fills); they are never deduplicated.
+NEAR_DUP_MIN_STDDEV = 4.0
+# Canonical and duplicate must agree on aspect ratio within this relative tolerance.
+NEAR_DUP_ASPECT_TOLERANCE = 0.03
+
+
+@dataclass
+class HashProbe:
+    """Downsampled grayscale pixels of one image; hashed in batches by perceptual_hashes()."""
+
+    phash_px: bytes
+    dhash_px: bytes
+    aspect: float
+
+
+def hash_probe(img: Image.Image) -> HashProbe:
+    """Probe pixels of an image (transparent areas flattened onto white)."""
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        flat = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        flat.alpha_composite(rgba)
+        img = flat
+    gray = img.convert("L")
+    return HashProbe(
+        phash_px=gray.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BOX).tobytes(),
+        dhash_px=gray.resize(DHASH_SIZE, Image.Resampling.BOX).tobytes(),
+        aspect=img.width / max(1, img.height),
+    )
+
+
+def probe_encoded(source: UploadBody) -> HashProbe:
+    """Probe an encoded image (bytes or file) using a reduced JPEG decode where possible."""
+    from io import BytesIO
+
+    if isinstance(source, ZipMember):
+        with source.open("rb") as f:
+            return probe_encoded(f.read())
+    with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as im:
+        im.draft(None, (PHASH_SIZE * 2, PHASH_SIZE * 2))
+        return hash_probe(ImageOps.exif_transpose(im))
+
+
+_DCT_MATRICES: Dict[int, object] = {}
+
+
+def _dct_matrix(np, n: int):
+    """Orthonormal DCT-II matrix: coefficients of a batch X are M @ X @ M.T."""
+    m = _DCT_MATRICES.get(n)
+    if m is None:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        m = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+        m[0] /= np.sqrt(2.0)
+        _DCT_MATRICES[n] = m = m.astype(np.float32)
+    return m
+
+
+def perceptual_hashes(probes: List[HashProbe]) -> List[Optional[Tuple[int, int]]]:
+    """
+    64-bit (pHash, dHash) for a batch of probes in one pass of array ops; None for flat probes.
+
+    pHash: 8x8 lowest DCT frequencies of the 32x32 probe against their median (DC excluded).
+    dHash: sign of the horizontal gradient across the 9x8 probe.
+    """
+    np = _optional_import("numpy")
+    if np is None:
+        raise RuntimeError("BLOCKED: --near-dup requires numpy. Install: pip install numpy")
+    if not probes:
+        return []
+    n = len(probes)
+    px = np.frombuffer(b"".join(p.phash_px for p in probes), dtype=np.uint8).reshape(n, PHASH_SIZE, PHASH_SIZE)
+    px = px.astype(np.float32)
+    m = _dct_matrix(np, PHASH_SIZE)
+    low = (m @ px @ m.T)[:, :8, :8].reshape(n, 64)
+    p_bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    w, h = DHASH_SIZE
+    d = np.frombuffer(b"".join(p.dhash_px for p in probes), dtype=np.uint8).reshape(n, h, w).astype(np.int16)
+    d_bits = (d[:, :, 1:] > d[:, :, :-1]).reshape(n, 64)
+
+    def pack(bits) -> List[int]:
+        return [int(v) for v in np.packbits(bits, axis=1).view(">u8").ravel()]
+
+    flat = px.reshape(n, -1).std(axis=1) < NEAR_DUP_MIN_STDDEV
+    return [None if flat[i] else (ph, dh) for i, (ph, dh) in enumerate(zip(pack(p_bits), pack(d_bits)))]
+
+
+def with_perceptual_hashes(prepared: Iterator["PreparedFile"], *, batch: int) -> Iterator["PreparedFile"]:
+    """Pass PreparedFiles through in order, filling .phash/.dhash for up to `batch` files per NumPy call."""
+    buf: List["PreparedFile"] = []
+
+    def flush() -> Iterator["PreparedFile"]:
+        probed = [p for p in buf if p.probe is not None]
+        for p, hashes in zip(probed, perceptual_hashes([p.probe for p in probed])):  # type: ignore[misc]
+            if hashes is not None:
+                p.phash, p.dhash = hashes
+        yield from buf
+        buf.clear()
+
+    for item in prepared:
+        buf.append(item)
+        if len(buf) >= batch:
+            yield from flush()
+    yield from flush()
+
+
+def hamming(np, hashes, query: int):
+    """Bit distance between each uint64 in `hashes` and `query`."""
+    x = np.bitwise_xor(hashes, np.uint64(query))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return np.unpackbits(x.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class NearDupIndex:
+    """
+    Library-wide pHash index of canonical images (first seen wins), persisted in {state_dir}/near-duplicates.json.
+
+    Lookup is multi-index hashing: the 64-bit pHash is cut into max_distance+1 bands, and by
+    pigeonhole every hash within max_distance of a query equals it exactly in at least one band.
+    A query therefore only measures distances (vectorized) to its bucket mates instead of the
+    whole library. Candidates are confirmed on dHash distance, aspect ratio and stored format.
+
+    `duplicates` maps "{book}/{originalName}" -> canonical storagePath, so --sync never deletes
+    a canonical object that another book still points at.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path, *, max_distance: int) -> None:
+        self.path = Path(path)
+        self.max_distance = int(max_distance)
+        bands = self.max_distance + 1
+        self._bands = [(64 * b // bands, 64 * (b + 1) // bands) for b in range(bands)]
+        self.items: List[Dict[str, object]] = []
+        self.duplicates: Dict[str, str] = {}
+        self._by_path: Dict[str, int] = {}
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in self._bands]
+
+    def load(self) -> "NearDupIndex":
+        try:
+            state = json.loads(self.path.read_text(encoding="utf-8"))
+        except Exception:
+            return self
+        if state.get("version") != self.VERSION:
+            return self
+        for item in state.get("canonicals") or []:
+            if isinstance(item, dict):
+                self.add(item)
+        dups = state.get("duplicates")
+        self.duplicates = {str(k): str(v) for k, v in dups.items()} if isinstance(dups, dict) else {}
+        return self
+
+    def save(self) -> None:
+        write_json_atomic(
+            self.path,
+            {"version": self.VERSION, "maxDistance": self.max_distance, "canonicals": self.items, "duplicates": self.duplicates},
+        )
+
+    def __contains__(self, storage_path: str) -> bool:
+        return storage_path in self._by_path
+
+    def _band_keys(self, h: int) -> List[int]:
+        return [(h >> (64 - hi)) & ((1 << (hi - lo)) - 1) for lo, hi in self._bands]
+
+    def add(self, item: Dict[str, object]) -> None:
+        """Register (or replace) a canonical: an entry subset plus bookSlug, phash/dhash hex and aspect."""
+        path = str(item["storagePath"])
+        if path in self._by_path:
+            self.items[self._by_path[path]] = item
+            return
+        i = len(self.items)
+        self.items.append(item)
+        self._by_path[path] = i
+        for bucket, key in zip(self._buckets, self._band_keys(int(str(item["phash"]), 16))):
+            bucket.setdefault(key, []).append(i)
+
+    def query(self, *, phash: int, dhash: int, aspect: Optional[float], ext: str) -> Optional[Tuple[Dict[str, object], int]]:
+        """Closest confirmed canonical within max_distance (ties: earliest canonical) and its pHash distance."""
+        np = _optional_import("numpy")
+        cands = sorted({i for bucket, key in zip(self._buckets, self._band_keys(phash)) for i in bucket.get(key, [])})
+        cands = [i for i in cands if self.items[i].get("storedExt") == ext]
+        if not cands:
+            return None
+        hashes = np.array([[int(str(self.items[i][k]), 16) for k in ("phash", "dhash")] for i in cands], dtype=np.uint64)
+        dp = hamming(np, hashes[:, 0].copy(), phash)
+        dd = hamming(np, hashes[:, 1].copy(), dhash)
+        best: Optional[Tuple[int, int]] = None
+        for j in np.flatnonzero((dp <= self.max_distance) & (dd <= self.max_distance)):
+            item = self.items[cands[int(j)]]
+            other = item.get("aspect")
+            if aspect and isinstance(other, (int, float)) and abs(other / aspect - 1.0) > NEAR_DUP_ASPECT_TOLERANCE:
+                continue
+            score = int(dp[j]) + int(dd[j])
+            if best is None or score < best[0]:
+                best = (score, int(j))
+        return None if best is None else (self.items[cands[best[1]]], int(dp[best[1]]))
+
+    def retain_book(self, book_slug: str, entries: List[Dict[str, object]]) -> None:
+        """
+        After a book: record its current duplicates and drop its canonicals whose source is gone,
+        unless a duplicate still points at them (--sync keeps those objects, so they stay valid).
+        """
+        self.duplicates = {k: v for k, v in self.duplicates.items() if not k.startswith(f"{book_slug}/")}
+        for e in entries:
+            dup = e.get("duplicateOf")
+            if isinstance(dup, dict):
+                self.duplicates[f"{book_slug}/{e['originalName']}"] = str(dup["storagePath"])
+        keep = {str(e.get("storagePath")) for e in entries if not e.get("duplicateOf")} | set(self.duplicates.values())
+        kept = [it for it in self.items if it.get("bookSlug") != book_slug or str(it["storagePath"]) in keep]
+        if len(kept) != len(self.items):
+            self.items, self._by_path = [], {}
+            self._buckets = [{} for _ in self._bands]
+            for item in kept:
+                self.add(item)
+
+    def referenced_paths(self) -> set:
+        """Objects that near-duplicates elsewhere point at (canonical image + its renditions)."""
+        targets = set(self.duplicates.values())
+        return {p for it in self.items if str(it["storagePath"]) in targets for p in entry_storage_paths(it)}
+
+
+def near_dup_item(book_slug: str, entry: Dict[str, object], aspect: Optional[float]) -> Dict[str, object]:
+    """The canonical record NearDupIndex keeps for an uploaded entry."""
+    keys = ("originalName", "storagePath", "storedExt", "storedMime", "storedBytes", "storedSha256", "width", "height")
+    item: Dict[str, object] = {"bookSlug": book_slug, **{k: entry[k] for k in keys if k in entry}}
+    item.update(phash=entry["phash"], dhash=entry["dhash"])
+    if aspect:
+        item["aspect"] = round(aspect, 4)
+    if entry.get("renditions"):
+        item["renditions"] = entry["renditions"]
+    return item
+
+
+def duplicate_entry(entry: Dict[str, object], canonical: Dict[str, object], distance: int) -> Dict[str, object]:
+    """Index entry for a near-duplicate: its own source facts, the canonical's stored object(s)."""
+    dup: Dict[str, object] = {k: entry[k] for k in ("originalName", "originalBytes", "phash", "dhash")}
+    for k in ("storagePath", "storedExt", "storedMime", "storedBytes", "storedSha256", "width", "height", "renditions"):
+        if k in canonical:
+            dup[k] = canonical[k]
+    dup["duplicateOf"] = {
+        "bookSlug": canonical["bookSlug"],
+        "originalName": canonical["originalName"],
+        "storagePath": canonical["storagePath"],
+        "distance": distance,
+    }
+    return dup
+
+
+# -----------------------------
+# Zip archive sources (--root extracted_images.zip)
+# -----------------------------
+
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+class MemberStat(NamedTuple):
+    st_size: int
+    st_mtime_ns: int
+
+
+class _StoredMemberReader(io.RawIOBase):
+    """Seekable view of an uncompressed (stored) member: its bytes are read in place, with its own file handle."""
+
+    def __init__(self, archive: str, header_offset: int, size: int) -> None:
+        super().__init__()
+        self._f = open(archive, "rb")
+        self._f.seek(header_offset)
+        header = ZIP_LOCAL_HEADER.unpack(self._f.read(ZIP_LOCAL_HEADER.size))
+        if header[0] != b"PK\x03\x04":
+            self._f.close()
+            raise zipfile.BadZipFile(f"Bad local file header at offset {header_offset} in {archive}")
+        self._start = header_offset + ZIP_LOCAL_HEADER.size + header[-2] + header[-1]
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = min(max(0, base + offset), self._size)
+        return self._pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self._size - self._pos)
+        if n <= 0:
+            return 0
+        self._f.seek(self._start + self._pos)
+        got = self._f.readinto(memoryview(b)[:n]) or 0
+        self._pos += got
+        return got
+
+    def close(self) -> None:
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+
+# Deflated members are read through one ZipFile per process (never a handle inherited across fork).
+_ZIP_HANDLES: Dict[Tuple[int, str], zipfile.ZipFile] = {}
+_ZIP_HANDLES_LOCK = threading.Lock()
+
+
+def _zip_handle(archive: str) -> zipfile.ZipFile:
+    key = (os.getpid(), archive)
+    with _ZIP_HANDLES_LOCK:
+        zf = _ZIP_HANDLES.get(key)
+        if zf is None:
+            zf = _ZIP_HANDLES[key] = zipfile.ZipFile(archive)
+        return zf
+
+
+@dataclass(frozen=True)
+class ZipMember:
+    """
+    One image inside the archive, used wherever a source file path is: the pipeline only needs
+    .name, .suffix, .stat() and .open(). Picklable, so it travels to --workers processes as is.
+    """
+
+    archive: str
+    member: str
+    size: int
+    header_offset: int
+    compressed: bool
+    mtime_ns: int
+    # Set by inflated(): the member's bytes, read once and shared by hashing, decoding and upload.
+    data: Optional[bytes] = field(default=None, compare=False, repr=False)
+
+    @property
+    def name(self) -> str:
+        return self.member.rsplit("/", 1)[-1]
+
+    @property
+    def suffix(self) -> str:
+        return os.path.splitext(self.name)[1]
+
+    def __str__(self) -> str:
+        return f"{self.archive}!/{self.member}"
+
+    def stat(self) -> MemberStat:
+        return MemberStat(st_size=self.size, st_mtime_ns=self.mtime_ns)
+
+    def open(self, mode: str = "rb") -> IO[bytes]:
+        if mode != "rb":
+            raise ValueError(f"zip members are read-only: {self}")
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        if not self.compressed:
+            return io.BufferedReader(_StoredMemberReader(self.archive, self.header_offset, self.size), 1024 * 1024)
+        f = _zip_handle(self.archive).open(self.member)
+        # requests sizes a streamed body from .len; without it, it seeks to the end (inflating the member twice).
+        f.len = self.size  # type: ignore[attr-defined]
+        return f
+
+    def inflated(self) -> "ZipMember":
+        with self.open("rb") as f:
+            return replace(self, data=f.read())
+
+
+SourceFile = Union[Path, ZipMember]
+
+
+@contextmanager
+def decode_input(path: SourceFile, *, header_only: bool = False) -> Iterator[Union[str, IO[bytes]]]:
+    """
+    What Image.open() / tifffile decode from. Decoders seek freely, so a deflated zip member is
+    inflated into memory first (estimate_prepare_bytes() counts it); stored members are read in place.
+    header_only: a header needs only the first blocks, so deflated members are read as a stream.
+    """
+    if not isinstance(path, ZipMember):
+        yield str(path)
+        return
+    if path.compressed and path.data is None and not header_only:
+        path = path.inflated()
+    with path.open("rb") as f:
+        yield f
+
+
+@dataclass
+class ZipBook:
+    """extracted_images/{name}/linked_images/ inside the archive; files sorted by name like a book folder."""
+
+    name: str
+    files: List[ZipMember]
+
+
+BookSource = Union[Path, ZipBook]
+
+
+def scan_zip_library(archive: Path) -> List[ZipBook]:
+    """
+    Books in an archive laid out as extracted_images/{book}/linked_images/{file} (the layout
+    organize_book_images.py extracts). Files are flattened to their base name exactly as that
+    script does (a later entry replaces an earlier one), so originalName, resume state and indexes
+    are the same whether a book is uploaded from the archive or from its extracted folder.
+    """
+    archive_s = str(archive.resolve())
+    books: Dict[str, Dict[str, ZipMember]] = {}
+    with zipfile.ZipFile(archive_s) as zf:
+        for info in zf.infolist():
+            parts = info.filename.split("/")
+            if info.is_dir() or len(parts) < 4 or parts[0] != "extracted_images" or parts[2] != "linked_images":
+                continue
+            if info.flag_bits & 0x1:
+                raise RuntimeError(f"BLOCKED: encrypted zip member not supported: {info.filename}")
+            member = ZipMember(
+                archive=archive_s,
+                member=info.filename,
+                size=info.file_size,
+                header_offset=info.header_offset,
+                compressed=info.compress_type != zipfile.ZIP_STORED,
+                mtime_ns=int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000,
+            )
+            files = books.setdefault(parts[1], {})
+            if member.name in files and files[member.name].member != member.member:
+                print(f"[WARN] {parts[1]}: {files[member.name].member} and {member.member} share a name; keeping the latter", file=sys.stderr)
+            files[member.name] = member
+    return [ZipBook(name=name, files=sorted(files.values(), key=lambda m: m.name)) for name, files in books.items()]
+
+
+def list_book_files(book: BookSource) -> Optional[List[SourceFile]]:
+    """A book's source files sorted by name (the same order on every machine); None without an images/ folder."""
+    if isinstance(book, ZipBook):
+        return list(book.files)
+    images_dir = book / "images"
+    if not images_dir.exists():
+        return None
+    return sorted((p for p in images_dir.iterdir() if p.is_file()), key=lambda p: p.name)
+
+
+# -----------------------------
+# Per-file preparation (optimize stage)
+# -----------------------------
+
+
+# Upload payloads are either in-memory bytes (optimized renditions, bounded by --max-px /
+# --max-upload-mb) or a preserved original, streamed from disk (Path) or from the archive (ZipMember).
+UploadBody = Union[bytes, Path, ZipMember]
+
+
+@dataclass
+class PreparedFile:
+    body: UploadBody
+    size: int
+    output_ext: str
+    object_name: str
+    content_type: str
+    sha256: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    mode: Optional[str] = None
+    encode_attempts: int = 0
+    decode_path: Optional[str] = None
+    # --jpeg-target-ssim: the JPEG quality used and the probe SSIM it reached.
+    quality: Optional[int] = None
+    ssim: Optional[float] = None
+    renditions: List[RenditionOutput] = field(default_factory=list)
+    # Seconds per stage spent preparing this file (StageTimer.seconds).
+    timings: Dict[str, float] = field(default_factory=dict)
+    # --near-dup: probe from the worker, hashed in batches in the main process (with_perceptual_hashes).
+    probe: Optional[HashProbe] = None
+    phash: Optional[int] = None
+    dhash: Optional[int] = None
+
+
+# Floors for the adaptive size search (pixel size first, then JPEG quality).
+ADAPTIVE_MIN_PX = 800
+ADAPTIVE_MIN_QUALITY = 65
+
+
+def decode_for_optimize(
+    path: SourceFile, settings: OptimizeSettings, *, timer: Optional[StageTimer] = None
+) -> Tuple[Image.Image, str]:
+    """load_normalized() at settings.max_px; decode errors surface as 'Failed to convert image'."""
+    try:
+        with pixel_limit(settings.max_image_pixels):
+            return load_normalized(
+                path,
+                max_px=settings.max_px,
+                alpha_mode=settings.alpha_mode,
+                tiff_memory_mb=settings.tiff_memory_mb,
+                tiff_threads=settings.tiff_threads,
+                timer=timer,
+            )
+    except Exception as e:
+        raise RuntimeError(f"Failed to convert image: {type(e).__name__}") from e
+
+
+def optimize_image_adaptive(
+    path: SourceFile,
+    settings: OptimizeSettings,
+    *,
+    decoded: Optional[Tuple[Image.Image, str]] = None,
+    timer: Optional[StageTimer] = None,
+) -> OptimizedImage:
+    """
+    Convert to a render-friendly JPEG/PNG downscaled to max_px; if the output is larger than
+    max_upload_mb, search for the largest pixel size (then highest JPEG quality) that fits.
+    With --jpeg-target-ssim the starting JPEG quality is searched per image (search_jpeg_quality()).
+
+    The source is decoded and normalized once. Smaller candidates are resized from that
+    max_px image and cached per size, so each attempt costs at most one resize plus one encode.
+    Pixel size is bisected between ADAPTIVE_MIN_PX and max_px (probes guided by bytes ~ area);
+    only if ADAPTIVE_MIN_PX still doesn't fit is quality bisected down to ADAPTIVE_MIN_QUALITY.
+    `decoded` reuses an image already returned by decode_for_optimize() (it is not modified).
+    """
+    max_bytes = int(settings.max_upload_mb * 1024 * 1024)
+    timer = timer or StageTimer()
+    base, plan = decoded if decoded is not None else decode_for_optimize(path, settings, timer=timer)
+
+    base_px = max(base.size)
+    sized: Dict[int, Image.Image] = {base_px: base}
+    attempts = 0
+
+    def encode_at(px: int, quality: int) -> OptimizedImage:
+        nonlocal attempts
+        im = sized.get(px)
+        if im is None:
+            with timer.stage("resize"):
+                im = base.copy()
+                im.thumbnail((px, px), Image.Resampling.LANCZOS)
+            sized[px] = im
+        attempts += 1
+        with timer.stage("encode"):
+            opt = encode_image(im, jpeg_quality=quality)
+        opt.encode_attempts = attempts
+        opt.decode_path = plan
+        return opt
+
+    def fits(opt: OptimizedImage) -> bool:
+        return len(opt.output_bytes) <= max_bytes
+
+    q = int(settings.jpeg_quality)
+    searched: Optional[float] = None
+    if settings.target_ssim > 0 and base.mode != "RGBA":
+        with timer.stage("quality_search"):
+            q_min, q_max = settings.jpeg_quality_range
+            q, searched = search_jpeg_quality(base, target=settings.target_ssim, lo=q_min, hi=q_max)
+    opt = encode_at(base_px, q)
+    if fits(opt):
+        # The probe score holds for this exact image and quality only (not for the fallbacks below).
+        opt.ssim = round(searched, 5) if searched is not None else None
+        return opt
+
+    # 1) Pixel size at the requested quality. Invariant: hi_px is too large, lo_px fits.
+    hi_px, hi_bytes = base_px, len(opt.output_bytes)
+    lo_px = min(ADAPTIVE_MIN_PX, base_px)
+    best: Optional[OptimizedImage] = None
+    if lo_px < hi_px:
+        opt = encode_at(lo_px, q)
+        if fits(opt):
+            best = opt
+            while hi_px - lo_px > max(16, int(hi_px * 0.03)):
+                # Encoded bytes scale roughly with pixel area; aim just under the limit,
+                # but keep probes inside the middle half so the bracket always shrinks.
+                guess = int(hi_px * math.sqrt(max_bytes * 0.97 / hi_bytes))
+                span = hi_px - lo_px
+                px = min(max(guess, lo_px + span // 4), hi_px - span // 4)
+                opt = encode_at(px, q)
+                if fits(opt):
+                    lo_px, best = px, opt
+                else:
+                    hi_px, hi_bytes = px, len(opt.output_bytes)
+    if best is not None:
+        return best
+
+    # 2) Smallest size still too large: lower JPEG quality (PNG output has no quality knob).
+    if opt.output_ext == "jpg" and q > ADAPTIVE_MIN_QUALITY:
+        lo_q, hi_q = ADAPTIVE_MIN_QUALITY, q
+        opt = encode_at(lo_px, lo_q)
+        if fits(opt):
+            best = opt
+            while hi_q - lo_q > 2:
+                mid_q = (lo_q + hi_q) // 2
+                opt = encode_at(lo_px, mid_q)
+                if fits(opt):
+                    lo_q, best = mid_q, opt
+                else:
+                    hi_q = mid_q
+    if best is not None:
+        return best
+
+    raise RuntimeError(
+        f"BLOCKED: Optimized image is still too large ({len(opt.output_bytes)} bytes). "
+        f"Lower --max-px or --max-upload-mb and retry."
+    )
+
+
+def prepare_file(
+    path: SourceFile,
+    *,
+    convert: bool,
+    settings: OptimizeSettings,
+    cache: Optional[RenditionCache] = None,
+) -> PreparedFile:
+    """
+    Produce the upload payload for one source file (preserve as-is or optimize).
+
+    Top-level and free of shared in-memory state so it can run in a worker process (--workers).
+    """
+    original_name = path.name
+    ext = path.suffix.lower().lstrip(".")
+
+    timer = StageTimer()
+
+    # --renditions: look up every (rendition, format) first; decode at most once for whatever is missing.
+    specs = renditions_for(original_name, settings.renditions)
+
+    # A deflated zip member that will be hashed and decoded is inflated once, here, not per reader.
+    if isinstance(path, ZipMember) and path.compressed and (convert or specs or settings.near_dup):
+        with timer.stage("read"):
+            path = path.inflated()
+    rendition_keys: Dict[Tuple[str, str], str] = {}
+    renditions: Dict[Tuple[str, str], OptimizedImage] = {}
+    if cache is not None:
+        with timer.stage("cache"):
+            for spec in specs:
+                for fmt in spec.formats:
+                    rendition_keys[(spec.name, fmt)] = key = cache.key_for_rendition(path, settings, spec, fmt)
+                    hit = cache.get(key)
+                    if hit is not None:
+                        renditions[(spec.name, fmt)] = hit
+    need_renditions = len(renditions) < sum(len(spec.formats) for spec in specs)
+
+    decoded: Optional[Tuple[Image.Image, str]] = None
+    opt: Optional[OptimizedImage] = None
+    if convert:
+        if cache is not None:
+            with timer.stage("cache"):
+                cache_key = cache.key_for(path, settings)
+                opt = cache.get(cache_key)
+        if opt is None:
+            decoded = decode_for_optimize(path, settings, timer=timer)
+            opt = optimize_image_adaptive(path, settings, decoded=decoded, timer=timer)
+            if cache is not None:
+                with timer.stage("cache"):
+                    cache.put(cache_key, opt)
+
+    if need_renditions:
+        if decoded is None:
+            decoded = decode_for_optimize(path, settings, timer=timer)
+        hits = set(renditions)
+        renditions = render_renditions(decoded[0], specs, settings=settings, cached=renditions, timer=timer)
+        if cache is not None:
+            with timer.stage("cache"):
+                for rkey, ropt in renditions.items():
+                    if rkey not in hits:
+                        cache.put(rendition_keys[rkey], ropt)
+    decoded = None
+    rendition_outputs: List[RenditionOutput] = []
+    with timer.stage("sha256"):
+        for spec in specs:
+            for fmt in spec.formats:
+                ropt = renditions[(spec.name, fmt)]
+                rendition_outputs.append(
+                    RenditionOutput(
+                        name=spec.name,
+                        format=fmt,
+                        body=ropt.output_bytes,
+                        ext=ropt.output_ext,
+                        width=ropt.width,
+                        height=ropt.height,
+                        sha256=sha256_bytes(ropt.output_bytes),
+                        quality=ropt.quality,
+                        ssim=ropt.ssim,
+                    )
+                )
+
+    # --near-dup probe: from the smallest rendition, else the stored output, so the hash depends only
+    # on output bytes (identical on cache hits and misses).
+    probe: Optional[HashProbe] = None
+    if settings.near_dup and ext != "svg":
+        smallest = min(rendition_outputs, key=lambda r: len(r.body), default=None)
+        with timer.stage("phash"):
+            try:
+                probe = probe_encoded(smallest.body if smallest is not None else (opt.output_bytes if opt is not None else path))
+            except Exception:
+                probe = None  # undecodable preserved file: uploaded as-is, just never deduplicated
+
+    if opt is None:
+        # Preserved as-is: hash now, stream from disk at upload time (never held in memory).
+        with timer.stage("stat"):
+            size = path.stat().st_size
+        with timer.stage("sha256"):
+            digest = sha256_file(path)
+        return PreparedFile(
+            body=path,
+            size=size,
+            output_ext=ext,
+            object_name=safe_storage_filename(original_name),
+            content_type=mime_for_ext(ext),
+            sha256=digest,
+            renditions=rendition_outputs,
+            timings=timer.seconds,
+            probe=probe,
+        )
+
+    output_ext = opt.output_ext
+    # Ensure uniqueness and make mapping explicit (e.g. foo.tif.jpg)
+    object_name = f"{original_name}.{output_ext}" if output_ext != ext else original_name
+    with timer.stage("sha256"):
+        digest = sha256_bytes(opt.output_bytes)
+    return PreparedFile(
+        body=opt.output_bytes,
+        size=len(opt.output_bytes),
+        output_ext=output_ext,
+        object_name=safe_storage_filename(object_name),
+        content_type=mime_for_ext(output_ext),
+        sha256=digest,
+        width=opt.width,
+        height=opt.height,
+        mode=opt.mode,
+        encode_attempts=opt.encode_attempts,
+        decode_path=opt.decode_path or None,
+        quality=opt.quality if settings.target_ssim > 0 else None,
+        ssim=opt.ssim,
+        renditions=rendition_outputs,
+        timings=timer.seconds,
+        probe=probe,
+    )
+
+
+def iter_prepared(
+    jobs: List[Tuple[SourceFile, bool]],
+    *,
+    pool: Optional[ProcessPoolExecutor],
+    workers: int,
+    window: int,
+    settings: OptimizeSettings,
+    cache: Optional[RenditionCache] = None,
+    memory_budget_mb: int = 0,
+) -> Iterator[PreparedFile]:
+    """
+    Yield PreparedFile results for (path, convert) jobs in input order.
+
+    With a process pool, jobs that decode (conversions, renditions, --near-dup probes) run through a
+    PrepareScheduler: largest first within `window` jobs ahead of the caller, under a decoded-memory
+    budget, while the caller uploads. Preserved files are cheap and read inline.
+    Ordered output keeps `entries`/`srcMap` and `__dupN` naming deterministic.
+    """
+    opts = dict(settings=settings, cache=cache)
+    if pool is None:
+        for path, convert in jobs:
+            yield prepare_file(path, convert=convert, **opts)
+        return
+
+    heavy = [convert or bool(renditions_for(path.name, settings.renditions)) or settings.near_dup for path, convert in jobs]
+    scheduler = PrepareScheduler(
+        [(path, convert) for (path, convert), h in zip(jobs, heavy) if h],
+        pool=pool,
+        workers=workers,
+        window=window,
+        settings=settings,
+        cache=cache,
+        budget_bytes=(memory_budget_mb or default_memory_budget_mb()) * 1024 * 1024,
+    )
+    try:
+        n = 0
+        for (path, convert), h in zip(jobs, heavy):
+            if h:
+                yield scheduler.result(n)
+                n += 1
+            else:
+                yield prepare_file(path, convert=convert, **opts)
+    finally:
+        scheduler.close()
+
+
+# -----------------------------
+# Optimize scheduling (memory admission, largest first)
+# -----------------------------
+
+
+@dataclass(frozen=True)
+class ImageHeader:
+    format: str
+    width: int
+    height: int
+    mode: str
+    alpha: bool = False
+    icc: bool = False
+    # False: Pillow cannot open it; decoded by the streaming TIFF reducer (always JPEG output).
+    pillow: bool = True
+
+
+def read_image_header(path: SourceFile) -> Optional[ImageHeader]:
+    """
+    Format, size, mode, alpha and embedded ICC without decoding pixels. TIFFs Pillow cannot identify
+    are read with tifffile (pillow=False); None for anything else neither can open.
+    """
+    try:
+        with pixel_limit(0), decode_input(path, header_only=True) as source, Image.open(source) as im:
+            return ImageHeader(
+                format=str(im.format or ""),
+                width=int(im.size[0]),
+                height=int(im.size[1]),
+                mode=im.mode,
+                alpha=("A" in im.getbands()) or (im.mode in ("LA", "RGBA")),
+                icc=bool(im.info.get("icc_profile")),
+            )
+    except Exception:
+        pass
+    tf = _optional_import("tifffile") if path.suffix.lower() in (".tif", ".tiff") else None
+    if tf is None:
+        return None
+    try:
+        with decode_input(path) as source, tf.TiffFile(source) as tif:
+            page = tif.pages[0]
+            shaped = page.shaped  # (planes, depth, height, width, samples-per-segment)
+            mode = {5: "CMYK", 2: "RGB"}.get(int(page.photometric), "L")
+            return ImageHeader(
+                format="TIFF",
+                width=int(shaped[3]),
+                height=int(shaped[2]),
+                mode=mode,
+                icc=34675 in page.tags,
+                pillow=False,
+            )
+    except Exception:
+        return None
+
+
+def decoded_size(header: ImageHeader, settings: OptimizeSettings) -> Tuple[int, int]:
+    """Size load_normalized() decodes a source at: JPEGs shrink by DCT scaling (draft) first."""
+    w, h = header.width, header.height
+    min_side = settings.max_px * DECODE_REDUCING_GAP
+    draft = 1
+    if header.format == "JPEG" and max(w, h) >= 2 * min_side:
+        while draft < 8 and max(w, h) >= 2 * draft * min_side:
+            draft *= 2
+    return -(-w // draft), -(-h // draft)
+
+
+def pixel_bytes(mode: str) -> int:
+    """Bytes per pixel of a decoded Pillow image (multi-band 8-bit modes are stored 4 bytes wide)."""
+    try:
+        info = ImageMode.getmode(mode)
+    except KeyError:
+        return 4
+    itemsize = int(info.typestr[2:] or 1)
+    return 4 if len(info.bands) > 1 and itemsize == 1 else len(info.bands) * itemsize
+
+
+def estimate_prepare_bytes(path: SourceFile, settings: OptimizeSettings) -> int:
+    """
+    Peak decoded-pixel memory of decode_for_optimize() for one source, from its header alone.
+
+    Mirrors load_normalized(): the source raster (after JPEG draft scaling), the integer reduce()
+    and its color-converted copy, plus the --max-px image and one rendition. libtiff decodes into
+    its own buffer before Pillow unpacks it, so a TIFF briefly needs ~2.25x its raster while loading.
+    Files Pillow cannot identify go to the streaming TIFF reducer, which caps itself at --tiff-memory-mb.
+    A deflated zip member is also held inflated in memory while it decodes (decode_input()).
+    """
+    out_bytes = settings.max_px * settings.max_px * 4
+    inflated = path.size if isinstance(path, ZipMember) and path.compressed else 0
+    header = read_image_header(path)
+    if header is None or not header.pillow:
+        return inflated + settings.tiff_memory_mb * 1024 * 1024 + 2 * out_bytes
+    w, h = decoded_size(header, settings)
+    decoded = w * h * pixel_bytes(header.mode)
+    factor = max(w, h) // (settings.max_px * DECODE_REDUCING_GAP)
+    reduced = decoded // (factor * factor) if factor >= 2 else decoded
+    loading = decoded * 9 // 4 if header.format == "TIFF" else decoded
+    return inflated + max(loading, decoded + 2 * reduced + 2 * min(reduced, out_bytes))
+
+
+def default_memory_budget_mb() -> int:
+    """Half of physical RAM (POSIX); 4096 MB where the platform does not report it."""
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, OSError, ValueError):
+        return 4096
+    return max(256, int(total // (2 * 1024 * 1024)))
+
+
+class PrepareScheduler:
+    """
+    Runs prepare_file() jobs on a process pool under a decoded-memory budget.
+
+    Each job costs its header estimate (estimate_prepare_bytes). A job starts only while the running
+    total fits the budget, and at most one per worker, so nothing queued inside the pool holds memory;
+    a job larger than the whole budget runs alone. Among the jobs at most `window` ahead of the caller
+    the largest starts first, so giant scans begin early instead of becoming the batch's tail, and
+    smaller ones backfill what budget is left. The job the caller waits for is never passed over.
+
+    A feeder thread submits as soon as a job finishes, however fast results are consumed; results
+    are returned by job index, so the caller still sees input order.
+    """
+
+    def __init__(
+        self,
+        jobs: List[Tuple[SourceFile, bool]],
+        *,
+        pool: ProcessPoolExecutor,
+        workers: int,
+        window: int,
+        settings: OptimizeSettings,
+        cache: Optional[RenditionCache],
+        budget_bytes: int,
+    ) -> None:
+        self.jobs = jobs
+        self.pool = pool
+        self.workers = max(1, workers)
+        self.window = max(self.workers, window)
+        self.opts = dict(settings=settings, cache=cache)
+        self.budget = max(1, budget_bytes)
+        self.costs = [estimate_prepare_bytes(path, settings) for path, _ in jobs]
+        self.peak_bytes = 0
+        self._pending = list(range(len(jobs)))  # not yet submitted, ascending
+        self._futures: Dict[int, Future] = {}
+        self._running: Dict[Future, int] = {}  # future -> admitted cost
+        self._used = 0
+        self._next = 0  # job the caller needs next
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._cond = threading.Condition()
+        self._wakeup: Future = Future()
+        for path, cost in zip((p for p, _ in jobs), self.costs):
+            if cost > self.budget:
+                print(
+                    f"  [WARN] {path.name}: ~{cost / (1024 * 1024):.0f} MB decoded exceeds the memory budget "
+                    f"({self.budget / (1024 * 1024):.0f} MB); it will run alone.",
+                    file=sys.stderr,
+                )
+        self._thread = threading.Thread(target=self._feed, name="prepare-scheduler", daemon=True)
+        self._thread.start()
+
+    def _pick(self) -> Optional[int]:
+        if not self._pending or len(self._running) >= self.workers:
+            return None
+        head = self._pending[0]
+        if head <= self._next:
+            candidates = [head]
+        else:
+            ahead = self._pending[: bisect.bisect_left(self._pending, self._next + self.window)]
+            candidates = sorted(ahead, key=lambda i: (-self.costs[i], i))
+        for i in candidates:
+            if not self._running or self._used + min(self.costs[i], self.budget) <= self.budget:
+                return i
+        return None
+
+    def _feed(self) -> None:
+        try:
+            while True:
+                with self._cond:
+                    while not self._closed:
+                        i = self._pick()
+                        if i is None:
+                            break
+                        self._pending.remove(i)
+                        path, convert = self.jobs[i]
+                        fut = self.pool.submit(prepare_file, path, convert=convert, **self.opts)
+                        self._futures[i] = fut
+                        self._running[fut] = cost = min(self.costs[i], self.budget)
+                        self._used += cost
+                        self.peak_bytes = max(self.peak_bytes, self._used)
+                        self._cond.notify_all()
+                    if self._closed or (not self._pending and not self._running):
+                        return
+                    waiting = [*self._running, self._wakeup]
+                done, _ = wait(waiting, return_when=FIRST_COMPLETED)
+                with self._cond:
+                    if self._wakeup.done():
+                        self._wakeup = Future()
+                    for fut in done:
+                        self._used -= self._running.pop(fut, 0)
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+    def _wake(self) -> None:
+        if not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def result(self, i: int) -> PreparedFile:
+        """Block until job `i` has run; its worker exception, if any, is raised here."""
+        with self._cond:
+            self._next = i
+            self._wake()
+            while i not in self._futures:
+                if self._error is not None:
+                    raise RuntimeError(f"optimize scheduler failed: {self._error}") from self._error
+                self._cond.wait()
+            fut = self._futures.pop(i)
+        return fut.result()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._wake()
+            for fut in self._futures.values():
+                fut.cancel()
+        self._thread.join()
+
+
+# -----------------------------
+# Planning (--plan: header-only projection)
+# -----------------------------
+
+
+# Calibration files come from this fraction of each class, smallest first.
+PLAN_SAMPLE_SPAN = 0.75
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    if seconds < 2 * 3600:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+@dataclass
+class PlannedFile:
+    path: Path
+    size: int
+    convert: bool
+    header: Optional[ImageHeader]
+    output_ext: str
+    # Pixels decoded (after JPEG draft scaling) and stored (after --max-px); 0 when unknown.
+    decode_px: int = 0
+    out_px: int = 0
+
+    @property
+    def kind(self) -> str:
+        """Calibration class: source format -> stored format."""
+        return f"{self.header.format if self.header is not None else self.path.suffix.lower().lstrip('.')}->{self.output_ext}"
+
+
+def plan_file(path: SourceFile, *, convert: bool, settings: OptimizeSettings) -> PlannedFile:
+    """What prepare_file() would do with `path`, from its header alone."""
+    raster = not path.name.lower().endswith(".svg")
+    header = read_image_header(path) if raster else None
+    planned = PlannedFile(
+        path=path,
+        size=path.stat().st_size,
+        convert=convert,
+        header=header,
+        output_ext=predict_output_ext(path, convert=convert, alpha_mode=settings.alpha_mode, header=header),
+    )
+    if header is not None:
+        dw, dh = decoded_size(header, settings)
+        scale = min(1.0, settings.max_px / float(max(header.width, header.height, 1)))
+        planned.decode_px = dw * dh
+        planned.out_px = max(1, round(header.width * scale)) * max(1, round(header.height * scale))
+    return planned
+
+
+def rendition_px(planned: PlannedFile, spec: RenditionSpec) -> int:
+    """Pixels of one rendition: renditions scale the stored image down, never up."""
+    if planned.header is None or not planned.out_px:
+        return 0
+    long_side = min(spec.max_px, max(planned.header.width, planned.header.height))
+    return max(1, int(planned.out_px * (long_side / float(max(planned.header.width, planned.header.height))) ** 2))
+
+
+def run_plan(
+    *,
+    book_dirs: List[BookSource],
+    settings: OptimizeSettings,
+    convert_of,
+    state_dir: Path,
+    resume: bool,
+    limit: int,
+    workers: int,
+    sample_per_class: int,
+    upload_mbps: float,
+) -> None:
+    """
+    --plan: project a run from image headers instead of running it.
+
+    Every file gets a header read (dimensions, mode, alpha, ICC, format) to predict convert vs preserve,
+    the stored format and pixel counts. A few files per class (source format -> stored format, spread
+    over the class's size range) are really optimized to calibrate bytes per stored pixel (per rendition
+    too) and seconds per decoded pixel; everything else is extrapolated from those ratios. Preserved
+    files cost their own size and a sha256 pass. Files already in resume state are counted, not planned.
+    """
+    t0 = time.perf_counter()
+    plans: Dict[str, List[PlannedFile]] = {}
+    resumed: Dict[str, int] = {}
+    for book_dir in sorted(book_dirs, key=lambda p: p.name):
+        files = list_book_files(book_dir)
+        if files is None:
+            continue
+        if limit and limit > 0:
+            files = files[:limit]
+        done = ResumeStore(state_dir, book_dir.name).load() if resume else {}
+        book: List[PlannedFile] = []
+        for path in files:
+            prev = resumed_entry(done, path.name)
+            if prev is not None and entry_has_renditions(prev, renditions_for(path.name, settings.renditions)):
+                resumed[book_dir.name] = resumed.get(book_dir.name, 0) + 1
+                continue
+            book.append(plan_file(path, convert=convert_of(path), settings=settings))
+        plans[book_dir.name] = book
+    all_files = [f for book in plans.values() for f in book]
+    header_s = time.perf_counter() - t0
+
+    def decodes(f: PlannedFile) -> bool:
+        return f.convert or bool(renditions_for(f.path.name, settings.renditions)) or (settings.near_dup and f.header is not None)
+
+    # Calibration: evenly spaced over the lower PLAN_SAMPLE_SPAN of each class's sizes (the largest
+    # scans would dominate planning time; cost per pixel extrapolates), optimized for real (no cache).
+    by_kind: Dict[str, List[PlannedFile]] = {}
+    for f in all_files:
+        if decodes(f):
+            by_kind.setdefault(f.kind, []).append(f)
+    ratios: Dict[str, Dict[str, float]] = {}
+    totals = {"bytes": 0.0, "px": 0.0, "seconds": 0.0, "decode_px": 0.0}
+    r_totals: Dict[Tuple[str, str], List[float]] = {}
+    for kind, members in sorted(by_kind.items()):
+        members = sorted(members, key=lambda f: (f.decode_px, f.path.name))
+        n = min(len(members), max(1, sample_per_class))
+        picks = sorted({round(PLAN_SAMPLE_SPAN * i * (len(members) - 1) / max(1, n - 1)) for i in range(n)})
+        acc = {"bytes": 0.0, "px": 0.0, "seconds": 0.0, "decode_px": 0.0, "files": 0.0}
+        for f in (members[i] for i in picks):
+            t = time.perf_counter()
+            try:
+                prepared = prepare_file(f.path, convert=f.convert, settings=settings)
+            except Exception as e:
+                print(f"  [WARN] plan: calibration failed for {f.path.name}: {type(e).__name__}: {str(e)[:120]}", file=sys.stderr)
+                continue
+            acc["seconds"] += time.perf_counter() - t
+            acc["decode_px"] += f.decode_px or 1
+            acc["files"] += 1
+            if f.convert:
+                acc["bytes"] += prepared.size
+                acc["px"] += prepared.width * prepared.height if prepared.width and prepared.height else f.out_px
+            for r in prepared.renditions:
+                slot = r_totals.setdefault((r.name, r.format), [0.0, 0.0])
+                slot[0] += len(r.body)
+                slot[1] += r.width * r.height
+        if acc["files"]:
+            ratios[kind] = acc
+            for k in totals:
+                totals[k] += acc[k]
+
+    def ratio(kind: str, num: str, den: str) -> Optional[float]:
+        acc = ratios.get(kind)
+        if acc is not None and acc[den] > 0:
+            return acc[num] / acc[den]
+        return totals[num] / totals[den] if totals[den] > 0 else None
+
+    # sha256 throughput for preserved files (streamed from disk at upload time, hashed once).
+    probe = os.urandom(8 * 1024 * 1024)
+    t = time.perf_counter()
+    sha256_bytes(probe)
+    hash_bps = len(probe) / max(1e-6, time.perf_counter() - t)
+
+    grand = {"files": 0, "convert": 0, "preserve": 0, "src": 0.0, "out": 0.0, "rend": 0.0, "objects": 0, "seconds": 0.0}
+    uncalibrated = 0
+    for book_slug, book in plans.items():
+        src = out = rend = seconds = 0.0
+        objects = 0
+        for f in book:
+            src += f.size
+            objects += 1
+            if f.convert:
+                bpp = ratio(f.kind, "bytes", "px")
+                if bpp is None or not f.out_px:
+                    uncalibrated += 1
+                    out += f.size
+                else:
+                    out += bpp * f.out_px
+            else:
+                out += f.size
+                seconds += f.size / hash_bps
+            if decodes(f):
+                spp = ratio(f.kind, "seconds", "decode_px")
+                seconds += spp * max(1, f.decode_px) if spp is not None else 0.0
+            for spec in renditions_for(f.path.name, settings.renditions):
+                for fmt in spec.formats:
+                    objects += 1
+                    rt = r_totals.get((spec.name, fmt))
+                    if rt and rt[1] > 0:
+                        rend += rt[0] / rt[1] * rendition_px(f, spec)
+        converts = sum(1 for f in book if f.convert)
+        print(
+            f"  BOOK {book_slug}: {len(book)} to process ({converts} convert, {len(book) - converts} preserve), "
+            f"{resumed.get(book_slug, 0)} resumed; {src / 2**20:.1f} MB -> ~{out / 2**20:.1f} MB"
+            + (f" + ~{rend / 2**20:.1f} MB renditions" if settings.renditions else "")
+        )
+        grand["files"] += len(book)
+        grand["convert"] += converts
+        grand["preserve"] += len(book) - converts
+        grand["src"] += src
+        grand["out"] += out
+        grand["rend"] += rend
+        grand["objects"] += objects
+        grand["seconds"] += seconds
+
+    print(f"\n[OK] Plan calibration ({time.perf_counter() - t0:.1f}s total, headers {header_s:.1f}s):")
+    for kind, acc in sorted(ratios.items()):
+        bpp = f"{acc['bytes'] / acc['px']:.2f} B/px, " if acc["px"] else ""
+        print(f"  {kind:14s} {int(acc['files'])}/{len(by_kind[kind])} files sampled: {bpp}{acc['seconds'] / max(1.0, acc['decode_px']) * 1e6:.3f} s/MP decoded")
+    if uncalibrated:
+        print(f"  [WARN] {uncalibrated} converted files without a calibrated class or header; counted at source size.", file=sys.stderr)
+
+    upload_bytes = grand["out"] + grand["rend"]
+    optimize_s = grand["seconds"] / max(1, workers)
+    upload_s = upload_bytes * 8 / (upload_mbps * 1e6) if upload_mbps > 0 else 0.0
+    print(
+        f"\n[OK] Plan: {grand['files']} files to process ({grand['convert']} convert, {grand['preserve']} preserve), "
+        f"{sum(resumed.values())} resumed"
+    )
+    print(
+        f"[OK] Projected upload: ~{upload_bytes / 2**20:.1f} MB in {grand['objects']} objects "
+        f"(sources {grand['src'] / 2**20:.1f} MB)"
+    )
+    print(
+        f"[OK] Projected runtime: optimize ~{format_duration(optimize_s)} on {workers} worker(s), "
+        f"upload ~{format_duration(upload_s)} at {upload_mbps:g} Mbit/s; wall ~{format_duration(max(optimize_s, upload_s))} (stages overlap)"
+    )
+
+
+# -----------------------------
+# Supabase Storage upload
+# -----------------------------
+
+
+# Supabase Storage's TUS endpoint requires 6 MB chunks (only the last one may be smaller).
+TUS_CHUNK_BYTES = 6 * 1024 * 1024
+
+
+def body_size(body: UploadBody) -> int:
+    return len(body) if isinstance(body, bytes) else body.stat().st_size
+
+
+# Worth retrying: request timeouts, rate limits and server-side failures. Any other 4xx
+# (validation, auth, 409 already exists) is permanent and fails on the first attempt.
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# The server telling us to slow down: shrinks the adaptive concurrency limit.
+THROTTLE_STATUSES = {429, 503}
+BACKOFF_BASE_S = 0.5
+BACKOFF_CAP_S = 60.0
+
+
+class StorageError(RuntimeError):
+    """A failed Storage request: HTTP status (None for network errors) and the server's Retry-After."""
+
+    def __init__(self, message: str, *, status: Optional[int] = None, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status is None or self.status in RETRYABLE_STATUSES or self.status >= 500
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After as seconds from now (delta-seconds or HTTP-date); None if absent or unparseable."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def storage_error(what: str, r: requests.Response) -> StorageError:
+    """StorageError for a failed response. Storage wraps some errors as HTTP 400 with the real status in the body."""
+    status = r.status_code
+    try:
+        body_status = int(r.json().get("statusCode"))
+        if status == 400 and 400 <= body_status < 600:
+            status = body_status
+    except (ValueError, TypeError, AttributeError):
+        pass
+    # Avoid printing secrets; response body is safe.
+    return StorageError(
+        f"{what} ({r.status_code}): {r.text[:300]}", status=status, retry_after=parse_retry_after(r.headers.get("Retry-After"))
+    )
+
+
+def backoff_delay(attempt: int, *, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff (uniform in [0, min(cap, base * 2^attempt)]), never before Retry-After."""
+    delay = random.uniform(0.0, min(BACKOFF_CAP_S, BACKOFF_BASE_S * 2**attempt))
+    if retry_after is not None:
+        # A little jitter on top so throttled clients do not all return in the same instant.
+        delay = max(delay, retry_after + random.uniform(0.0, min(1.0, retry_after * 0.1 + 0.1)))
+    return delay
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit for Storage requests, shared by all upload threads (AIMD).
+
+    Every request holds a slot. Each success adds 1/limit (about +1 per round of requests); a
+    429/503 multiplies the limit by THROTTLE_DECREASE, and queueing delay by LATENCY_DECREASE:
+    when the smoothed latency of requests of one size class (powers of 4 from 64 KB) exceeds
+    LATENCY_TOLERANCE x the best recently seen in that class, the server is saturating and more
+    parallelism only adds waiting. Latency estimates restart after such a decrease, and decreases
+    happen at most once per LATENCY_WINDOW samples so a burst of concurrent 429s counts once.
+    The throttled request itself waits out Retry-After (backoff_delay); meanwhile the limit is
+    held (no growth) so the others do not immediately climb back into the rate limit.
+    """
+
+    THROTTLE_DECREASE = 0.7
+    LATENCY_DECREASE = 0.9
+    LATENCY_TOLERANCE = 2.0
+    # Samples of one size class needed before its latency can trigger a decrease.
+    LATENCY_WINDOW = 8
+    # The latency baseline creeps up by this factor per sample so a stale minimum expires.
+    BASELINE_DRIFT = 1.002
+
+    def __init__(self, *, initial: int, minimum: int, maximum: int) -> None:
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = float(min(self.maximum, max(self.minimum, int(initial))))
+        self.throttled = 0
+        self.decreases = 0
+        self.peak = self.limit
+        self._in_use = 0
+        self._hold_until = 0.0
+        # Size class -> [baseline seconds, smoothed seconds, samples since the last restart].
+        self._latency: Dict[int, List[float]] = {}
+        self._since_decrease = self.LATENCY_WINDOW
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        with self._cond:
+            while self._in_use >= int(self.limit):
+                self._cond.wait()
+            self._in_use += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+
+    def _decrease(self, factor: float) -> None:
+        if self._since_decrease < self.LATENCY_WINDOW:
+            return
+        self._since_decrease = 0
+        self.limit = max(float(self.minimum), self.limit * factor)
+        self.decreases += 1
+        for stats in self._latency.values():
+            stats[1], stats[2] = stats[0], 0
+
+    def on_success(self, seconds: float, nbytes: int) -> None:
+        size_class = max(0, int(math.log(max(1, nbytes) / 65536, 4) + 1)) if nbytes > 65536 else 0
+        with self._cond:
+            self._since_decrease += 1
+            stats = self._latency.get(size_class)
+            if stats is None:
+                stats = self._latency[size_class] = [seconds, seconds, 0]
+            stats[0] = min(stats[0] * self.BASELINE_DRIFT, seconds)
+            stats[1] = 0.8 * stats[1] + 0.2 * seconds
+            stats[2] += 1
+            if stats[2] >= self.LATENCY_WINDOW and stats[1] > self.LATENCY_TOLERANCE * stats[0]:
+                self._decrease(self.LATENCY_DECREASE)
+            elif time.monotonic() >= self._hold_until:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+                self.peak = max(self.peak, self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self, retry_after: Optional[float]) -> None:
+        with self._cond:
+            self.throttled += 1
+            self._decrease(self.THROTTLE_DECREASE)
+            self._hold_until = max(self._hold_until, time.monotonic() + (retry_after or 1.0))
+
+    def describe(self) -> str:
+        return (
+            f"limit {self.limit:.1f} (range {self.minimum}-{self.maximum}, peak {self.peak:.1f}), "
+            f"{self.throttled} throttled responses, {self.decreases} decreases"
+        )
+
+
+_T = TypeVar("_T")
+
+
+def storage_request_with_retries(
+    what: str, send: Callable[[], _T], *, retries: int, limiter: Optional[AdaptiveLimiter] = None, nbytes: int = 0
+) -> Tuple[_T, int]:
+    """
+    Run one Storage request (`send`) under a limiter slot; returns (result, retries it took).
+    Network errors, 408/425/429 and 5xx are retried with jittered backoff (honoring Retry-After);
+    other errors are permanent and raised immediately.
+    """
+    attempt = 0
+    while True:
+        try:
+            with _request_slot(limiter, nbytes):
+                return send(), attempt
+        except (requests.RequestException, StorageError) as e:
+            if isinstance(e, StorageError) and not e.retryable:
+                raise
+            attempt += 1
+            if attempt > retries:
+                raise
+            sleep_s = backoff_delay(attempt, retry_after=e.retry_after if isinstance(e, StorageError) else None)
+            print(f"  [WARN] {what} retry {attempt}/{retries} in {sleep_s:.1f}s after error: {str(e)[:120]}", file=sys.stderr)
+            time.sleep(sleep_s)
+
+
+@contextmanager
+def _request_slot(limiter: Optional[AdaptiveLimiter], nbytes: int) -> Iterator[None]:
+    """Hold a limiter slot for one request; feeds its latency (or throttling) back to the limiter."""
+    if limiter is None:
+        yield
+        return
+    with limiter.slot():
+        t = time.perf_counter()
+        try:
+            yield
+        except StorageError as e:
+            if e.status in THROTTLE_STATUSES:
+                limiter.on_throttle(e.retry_after)
+            raise
+        limiter.on_success(time.perf_counter() - t, nbytes)
+
+
+def storage_upload(
+    *,
+    session: requests.Session,
+    supabase_url: str,
+    service_role_key: str,
+    bucket: str,
+    object_path: str,
+    content_type: str,
+    body: UploadBody,
+    upsert: bool,
+    timeout_s: int,
+    metadata: Optional[Dict[str, str]] = None,
+) -> None:
+    url = f"{supabase_url.rstrip('/')}/storage/v1/object/{bucket}/{quote(object_path, safe='/')}"
+    headers = {
+        "Authorization": f"Bearer {service_role_key}",
+        "Content-Type": content_type,
+        "x-upsert": "true" if upsert else "false",
+    }
+    if metadata:
+        # Stored as the object's user metadata (returned by the list endpoint for --reconcile-remote).
+        headers["x-metadata"] = base64.b64encode(json.dumps(metadata).encode("utf-8")).decode("ascii")
+    if not isinstance(body, bytes):
+        # requests streams file objects in small blocks (Content-Length from the file size).
+        with body.open("rb") as f:
+            r = session.post(url, headers=headers, data=f, timeout=timeout_s)
+    else:
+        r = session.post(url, headers=headers, data=body, timeout=timeout_s)
+    if r.status_code >= 400:
+        raise storage_error("Upload failed", r)
+
+
+def storage_upload_resumable(
+    *,
+    session: requests.Session,
+    supabase_url: str,
+    service_role_key: str,
+    bucket: str,
+    object_path: str,
+    content_type: str,
+    body: UploadBody,
+    upsert: bool,
+    timeout_s: int,
+    retries: int,
+    metadata: Optional[Dict[str, str]] = None,
+    limiter: Optional[AdaptiveLimiter] = None,
+) -> int:
+    """
+    TUS resumable upload (Supabase Storage /storage/v1/upload/resumable).
+
+    The body is sent in TUS_CHUNK_BYTES PATCH requests read straight from the file (or sliced from
+    the buffer), so memory stays bounded. After an error we ask the server for its Upload-Offset
+    (HEAD) and continue from there instead of restarting. `retries` counts consecutive failures;
+    any accepted chunk resets it. Returns the total number of retried requests. Each chunk is one
+    request under the limiter; a 409 on a chunk means the offsets diverged and is resynced.
+    """
+    endpoint = f"{supabase_url.rstrip('/')}/storage/v1/upload/resumable"
+    size = body_size(body)
+    base_headers = {"Authorization": f"Bearer {service_role_key}", "Tus-Resumable": "1.0.0"}
+
+    def b64(s: str) -> str:
+        return base64.b64encode(s.encode("utf-8")).decode("ascii")
+
+    tus_metadata = [f"bucketName {b64(bucket)}", f"objectName {b64(object_path)}", f"contentType {b64(content_type)}"]
+    if metadata:
+        tus_metadata.append(f"metadata {b64(json.dumps(metadata))}")
+    create_headers = {
+        **base_headers,
+        "Upload-Length": str(size),
+        "Upload-Metadata": ",".join(tus_metadata),
+        "x-upsert": "true" if upsert else "false",
+    }
+
+    location: Optional[str] = None
+    offset = 0
+    resync = False
+    attempt = 0
+    retried = 0
+    f = None if isinstance(body, bytes) else body.open("rb")
+    try:
+        while True:
+            try:
+                if location is None:
+                    with _request_slot(limiter, 0):
+                        r = session.post(endpoint, headers=create_headers, timeout=timeout_s)
+                        if r.status_code >= 400:
+                            raise storage_error("Resumable upload create failed", r)
+                    location = urljoin(endpoint, r.headers["Location"])
+                    offset = 0
+                elif resync:
+                    r = session.head(location, headers=base_headers, timeout=timeout_s)
+                    if r.status_code in (404, 410):
+                        # Upload expired server-side: start a new one.
+                        location = None
+                        continue
+                    if r.status_code >= 400:
+                        raise storage_error("Resumable upload offset check failed", r)
+                    offset = int(r.headers["Upload-Offset"])
+                resync = False
+
+                if offset >= size and location is not None:
+                    return retried
+
+                if f is not None:
+                    f.seek(offset)
+                    chunk = f.read(TUS_CHUNK_BYTES)
+                else:
+                    chunk = body[offset : offset + TUS_CHUNK_BYTES]  # type: ignore[index]
+                headers = {
+                    **base_headers,
+                    "Upload-Offset": str(offset),
+                    "Content-Type": "application/offset+octet-stream",
+                }
+                with _request_slot(limiter, len(chunk)):
+                    r = session.patch(location, headers=headers, data=chunk, timeout=timeout_s)
+                    if r.status_code >= 400:
+                        raise storage_error("Resumable upload chunk failed", r)
+                offset = int(r.headers.get("Upload-Offset") or (offset + len(chunk)))
+                attempt = 0
+                if offset >= size:
+                    return retried
+            except (requests.RequestException, StorageError, KeyError, ValueError) as e:
+                status = e.status if isinstance(e, StorageError) else None
+                if isinstance(e, StorageError) and not e.retryable and not (status == 409 and location is not None):
+                    raise
+                attempt += 1
+                if attempt > retries:
+                    raise
+                retried += 1
+                resync = location is not None
+                sleep_s = backoff_delay(attempt, retry_after=e.retry_after if isinstance(e, StorageError) else None)
+                print(
+                    f"  [WARN] resumable upload retry {attempt}/{retries} at {offset}/{size} bytes: {str(e)[:120]}",
+                    file=sys.stderr,
+                )
+                time.sleep(sleep_s)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def storage_upload_with_retries(
+    *,
+    session: requests.Session,
+    supabase_url: str,
+    service_role_key: str,
+    bucket: str,
+    object_path: str,
+    content_type: str,
+    body: UploadBody,
+    upsert: bool,
+    timeout_s: int,
+    retries: int,
+    resumable_threshold: int = 0,
+    metadata: Optional[Dict[str, str]] = None,
+    limiter: Optional[AdaptiveLimiter] = None,
+) -> int:
+    """
+    Upload one object (TUS above resumable_threshold); returns how many retries it took.
+    Retried as in storage_request_with_retries().
+    """
+    if resumable_threshold > 0 and body_size(body) > resumable_threshold:
+        return storage_upload_resumable(
+            session=session,
+            supabase_url=supabase_url,
+            service_role_key=service_role_key,
+            bucket=bucket,
+            object_path=object_path,
+            content_type=content_type,
+            body=body,
+            upsert=upsert,
+            timeout_s=timeout_s,
+            retries=retries,
+            metadata=metadata,
+            limiter=limiter,
+        )
+
+    _, attempts = storage_request_with_retries(
+        "upload",
+        lambda: storage_upload(
+            session=session,
+            supabase_url=supabase_url,
+            service_role_key=service_role_key,
+            bucket=bucket,
+            object_path=object_path,
+            content_type=content_type,
+            body=body,
+            upsert=upsert,
+            timeout_s=timeout_s,
+            metadata=metadata,
+        ),
+        retries=retries,
+        limiter=limiter,
+        nbytes=body_size(body),
+    )
+    return attempts
+
+
+def storage_delete(
+    *,
+    session: requests.Session,
+    supabase_url: str,
+    service_role_key: str,
+    bucket: str,
+    object_paths: List[str],
+    timeout_s: int,
+    retries: int = 0,
+    limiter: Optional[AdaptiveLimiter] = None,
+) -> None:
+    url = f"{supabase_url.rstrip('/')}/storage/v1/object/{bucket}"
+    headers = {"Authorization": f"Bearer {service_role_key}", "Content-Type": "application/json"}
+
+    def send(batch: List[str]) -> None:
+        r = session.delete(url, headers=headers, json={"prefixes": batch}, timeout=timeout_s)
+        if r.status_code >= 400:
+            raise storage_error("Delete failed", r)
+
+    # The bulk delete endpoint accepts up to 1000 keys per request.
+    for i in range(0, len(object_paths), 1000):
+        batch = object_paths[i : i + 1000]
+        storage_request_with_retries("delete", lambda: send(batch), retries=retries, limiter=limiter)
+
+
+def storage_download(
+    *,
+    session: requests.Session,
+    supabase_url: str,
+    service_role_key: str,
+    bucket: str,
+    object_path: str,
+    timeout_s: int,
+    retries: int = 0,
+    limiter: Optional[AdaptiveLimiter] = None,
+) -> Optional[bytes]:
+    """Fetch one (private) object; None if it does not exist."""
+    url = f"{supabase_url.rstrip('/')}/storage/v1/object/{bucket}/{quote(object_path, safe='/')}"
+
+    def send() -> Optional[bytes]:
+        r = session.get(url, headers={"Authorization": f"Bearer {service_role_key}"}, timeout=timeout_s)
+        # Storage reports a missing key as 404 (or 400 with statusCode 404 in the body).
+        if r.status_code == 404 or (r.status_code == 400 and '"404"' in r.text):
+            return None
+        if r.status_code >= 400:
+            raise storage_error("Download failed", r)
+        return r.content
+
+    return storage_request_with_retries("download", send, retries=retries, limiter=limiter)[0]
+
+
+@dataclass
+class RemoteObject:
+    """One listed object: size plus whatever content hash the backend can vouch for."""
+
+    size: int
+    sha256: Optional[str] = None  # user metadata written by this script
+    etag: Optional[str] = None  # Storage eTag: MD5 of the body for single-request uploads
+
+
+# Page size of the Storage list endpoint (its maximum).
+LIST_PAGE_SIZE = 1000
+
+
+def storage_list(
+    *,
+    session: requests.Session,
+    supabase_url: str,
+    service_role_key: str,
+    bucket: str,
+    prefix: str,
+    timeout_s: int,
+    retries: int = 0,
+    limiter: Optional[AdaptiveLimiter] = None,
+) -> Dict[str, RemoteObject]:
+    """
+    All objects directly under `prefix` (a "folder", trailing slash optional), keyed by full
+    object path. Paged with limit/offset; sub-folders are skipped.
+    """
+    url = f"{supabase_url.rstrip('/')}/storage/v1/object/list/{bucket}"
+    headers = {"Authorization": f"Bearer {service_role_key}", "Content-Type": "application/json"}
+    folder = prefix.rstrip("/")
+    out: Dict[str, RemoteObject] = {}
+    offset = 0
+
+    def send(offset: int) -> List[Dict[str, object]]:
+        body = {"prefix": folder, "limit": LIST_PAGE_SIZE, "offset": offset, "sortBy": {"column": "name", "order": "asc"}}
+        r = session.post(url, headers=headers, json=body, timeout=timeout_s)
+        if r.status_code >= 400:
+            raise storage_error("List failed", r)
+        return r.json()
+
+    while True:
+        page, _ = storage_request_with_retries("list", lambda: send(offset), retries=retries, limiter=limiter)
+        for item in page:
+            meta = item.get("metadata")
+            if not item.get("id") or not isinstance(meta, dict):
+                continue  # folder placeholder
+            user_meta = item.get("user_metadata") if isinstance(item.get("user_metadata"), dict) else {}
+            out[f"{folder}/{item['name']}"] = RemoteObject(
+                size=int(meta.get("size") or meta.get("contentLength") or 0),
+                sha256=user_meta.get("sha256"),
+                etag=str(meta.get("eTag") or "").strip('"') or None,
+            )
+        if len(page) < LIST_PAGE_SIZE:
+            return out
+        offset += LIST_PAGE_SIZE
+
+
+def body_md5(body: UploadBody) -> str:
+    h = hashlib.md5()
+    if not isinstance(body, bytes):
+        with body.open("rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    else:
+        h.update(body)
+    return h.hexdigest()
+
+
+def remote_matches(remote: Optional[RemoteObject], *, body: UploadBody, sha256: str) -> bool:
+    """
+    True if the listed object is byte-identical to what we would upload: same size and either
+    our sha256 user metadata or (without it) an MD5 eTag. Objects we cannot verify (e.g. TUS
+    uploads, whose eTag is multipart-style) count as different and are re-uploaded.
+    """
+    if remote is None or remote.size != body_size(body):
+        return False
+    if remote.sha256:
+        return remote.sha256 == sha256
+    if remote.etag and re.fullmatch(r"[0-9a-f]{32}", remote.etag):
+        return remote.etag == body_md5(body)
+    return False
+
+
+def make_session(*, pool_size: int) -> requests.Session:
+    """
+    requests.Session with a keep-alive pool sized for `pool_size` concurrent requests to one host.
+    pool_block=True makes extra requests wait for a free connection instead of opening throwaway ones.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# -----------------------------
+# Storage backends (--storage)
+# -----------------------------
+
+
+class SupabaseStorage:
+    """
+    Supabase Storage REST API (/storage/v1/object, TUS /storage/v1/upload/resumable).
+
+    Thread-safe: each calling thread owns its own Session (requests.Session is not guaranteed
+    thread-safe) holding a single keep-alive connection. Also used against MockStorageServer.
+    """
+
+    def __init__(
+        self,
+        *,
+        supabase_url: str,
+        service_role_key: str,
+        bucket: str,
+        timeout_s: int,
+        retries: int,
+        resumable_threshold: int = 0,
+        limiter: Optional[AdaptiveLimiter] = None,
+    ) -> None:
+        self.supabase_url = supabase_url
+        self.limiter = limiter
+        self.bucket = bucket
+        self._service_role_key = service_role_key
+        self._timeout_s = timeout_s
+        self._retries = retries
+        self._resumable_threshold = resumable_threshold
+        self._local = threading.local()
+
+    def describe(self) -> str:
+        return f"supabase {self.supabase_url} (bucket {self.bucket})"
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = make_session(pool_size=1)
+            self._local.session = session
+        return session
+
+    def upload(
+        self, *, object_path: str, content_type: str, body: UploadBody, upsert: bool, metadata: Optional[Dict[str, str]] = None
+    ) -> int:
+        """Upload one object; returns how many retries it took."""
+        return storage_upload_with_retries(
+            session=self._session(),
+            supabase_url=self.supabase_url,
+            service_role_key=self._service_role_key,
+            bucket=self.bucket,
+            object_path=object_path,
+            content_type=content_type,
+            body=body,
+            upsert=upsert,
+            timeout_s=self._timeout_s,
+            retries=self._retries,
+            resumable_threshold=self._resumable_threshold,
+            metadata=metadata,
+            limiter=self.limiter,
+        )
+
+    def list(self, prefix: str) -> Dict[str, RemoteObject]:
+        return storage_list(
+            session=self._session(),
+            supabase_url=self.supabase_url,
+            service_role_key=self._service_role_key,
+            bucket=self.bucket,
+            prefix=prefix,
+            timeout_s=self._timeout_s,
+            retries=self._retries,
+            limiter=self.limiter,
+        )
+
+    def download(self, object_path: str) -> Optional[bytes]:
+        return storage_download(
+            session=self._session(),
+            supabase_url=self.supabase_url,
+            service_role_key=self._service_role_key,
+            bucket=self.bucket,
+            object_path=object_path,
+            timeout_s=self._timeout_s,
+            retries=self._retries,
+            limiter=self.limiter,
+        )
+
+    def delete(self, object_paths: List[str]) -> None:
+        storage_delete(
+            session=self._session(),
+            supabase_url=self.supabase_url,
+            service_role_key=self._service_role_key,
+            bucket=self.bucket,
+            object_paths=object_paths,
+            timeout_s=self._timeout_s,
+            retries=self._retries,
+            limiter=self.limiter,
+        )
+
+
+class LocalStorage:
+    """
+    Bucket on the local filesystem: objects live at {root}/{bucket}/{object_path}.
+
+    Same contract as SupabaseStorage (an existing object without upsert is an error), so runs,
+    resume and --sync can be exercised without credentials.
+    """
+
+    def __init__(self, root: Path, *, bucket: str) -> None:
+        self.root = Path(root)
+        self.bucket = bucket
+
+    def describe(self) -> str:
+        return f"local {self.root / self.bucket}"
+
+    def _path(self, object_path: str) -> Path:
+        target = (self.root / self.bucket / object_path).resolve()
+        if not str(target).startswith(str((self.root / self.bucket).resolve())):
+            raise StorageError(f"Upload failed (400): invalid object path {object_path!r}", status=400)
+        return target
+
+    def upload(
+        self, *, object_path: str, content_type: str, body: UploadBody, upsert: bool, metadata: Optional[Dict[str, str]] = None
+    ) -> int:
+        target = self._path(object_path)
+        if target.exists() and not upsert:
+            raise StorageError("Upload failed (409): The resource already exists", status=409)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        if not isinstance(body, bytes):
+            with body.open("rb") as src, tmp.open("wb") as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+        else:
+            tmp.write_bytes(body)
+        tmp.replace(target)
+        return 0
+
+    def download(self, object_path: str) -> Optional[bytes]:
+        try:
+            return self._path(object_path).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, object_paths: List[str]) -> None:
+        for object_path in object_paths:
+            try:
+                self._path(object_path).unlink()
+            except FileNotFoundError:
+                pass
+
+    def list(self, prefix: str) -> Dict[str, RemoteObject]:
+        # No metadata store on disk: hash the files (local disks make this cheap enough).
+        folder = prefix.rstrip("/")
+        base = self._path(folder) if folder else (self.root / self.bucket).resolve()
+        if not base.is_dir():
+            return {}
+        return {
+            f"{folder}/{p.name}": RemoteObject(size=p.stat().st_size, sha256=sha256_file(p))
+            for p in sorted(base.iterdir())
+            if p.is_file() and not p.name.endswith(".tmp")
+        }
+
+
+class _BodyDigests:
+    """sha256 + MD5 (the eTag) of a request body, fed chunk by chunk."""
+
+    def __init__(self) -> None:
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def update(self, chunk: bytes) -> None:
+        self.sha256.update(chunk)
+        self.md5.update(chunk)
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    mock: "MockStorageServer"
+
+
+class _MockStorageHandler(BaseHTTPRequestHandler):
+    """Request handler for MockStorageServer (Supabase Storage object + TUS subset)."""
+
+    protocol_version = "HTTP/1.1"
+    server: _MockHTTPServer
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002 - BaseHTTPRequestHandler signature
+        return
+
+    def _reply(self, status: int, obj: Optional[object] = None, headers: Optional[Dict[str, str]] = None) -> None:
+        # bytes are sent as-is (object downloads); anything else as JSON.
+        raw = isinstance(obj, bytes)
+        data = obj if isinstance(obj, bytes) else (json.dumps(obj).encode("utf-8") if obj is not None else b"")
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if data and not raw:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if data and self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _handle(self) -> None:
+        mock = self.server.mock
+        length = int(self.headers.get("Content-Length") or 0)
+        fault = mock.fault()
+        # The body is always consumed (throttled), so a rejected request costs what it would upstream.
+        # Object bodies are only hashed; TUS chunks, request JSON and index objects (JSON / gzip) are kept.
+        keep = fault is None and (
+            self.command in ("PATCH", "DELETE")
+            or (self.headers.get("Content-Type") or "").startswith(("application/json", "application/gzip"))
+        )
+        body_hash = _BodyDigests()
+        data = bytearray() if keep else None
+        try:
+            size = mock.read_body(self.rfile, length, data if data is not None else body_hash)
+            if fault is not None:
+                status, headers = fault
+                self._reply(status, {"statusCode": str(status), "error": "injected", "message": "mock fault"}, headers)
+                return
+            if not self.headers.get("Authorization"):
+                self._reply(401, {"statusCode": "401", "error": "Unauthorized", "message": "missing Authorization"})
+                return
+            path = self.path.split("?", 1)[0]
+            status, obj, headers = mock.dispatch(
+                self.command, path, self.headers, size=size, digests=body_hash, data=bytes(data or b"")
+            )
+            self._reply(status, obj, headers)
+        finally:
+            if fault is None:
+                mock.release()
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_HEAD = do_DELETE = _handle
+
+
+class MockStorageServer:
+    """
+    In-process HTTP stand-in for Supabase Storage, for offline load tests of concurrency,
+    retries and resume (--storage mock, bench-book-image-pipeline.py).
+
+    Implements object upload (POST/PUT, x-upsert, x-metadata), download, paged list, bulk delete,
+    and TUS create/HEAD/PATCH. Objects are kept as metadata only (size, sha256, MD5 eTag, content
+    type, user metadata), so scale tests stay small; JSON and gzip objects (indexes) also keep
+    their body so they can be downloaded again.
+    Fault injection: fixed latency per request, a fraction of 429 (with Retry-After) and 5xx
+    responses, a shared bandwidth cap on request bodies (token bucket across connections), and
+    a concurrency cap: requests beyond max_concurrent in progress get 429, like a project rate limit.
+    """
+
+    def __init__(
+        self,
+        *,
+        latency_ms: float = 0.0,
+        error_rate: float = 0.0,
+        rate_429: float = 0.0,
+        bandwidth_mbps: float = 0.0,
+        max_concurrent: int = 0,
+        seed: int = 0,
+    ) -> None:
+        self.max_concurrent = max(0, int(max_concurrent))
+        self._active = 0
+        self.latency_s = max(0.0, latency_ms) / 1000.0
+        self.error_rate = max(0.0, error_rate)
+        self.rate_429 = max(0.0, rate_429)
+        self.bytes_per_s = max(0.0, bandwidth_mbps) * 1_000_000 / 8
+        self.objects: Dict[str, Dict[str, object]] = {}
+        self._uploads: Dict[str, Dict[str, object]] = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._bw_next = 0.0
+        self.stats = {"requests": 0, "injected429": 0, "injected5xx": 0, "bytesIn": 0}
+        self._httpd: Optional[_MockHTTPServer] = None
+
+    def start(self) -> str:
+        """Serve on an ephemeral localhost port (daemon thread); returns the base URL."""
+        httpd = _MockHTTPServer(("127.0.0.1", 0), _MockStorageHandler)
+        httpd.mock = self
+        threading.Thread(target=httpd.serve_forever, name="mock-storage", daemon=True).start()
+        self._httpd = httpd
+        return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    def stop(self) -> None:
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def read_body(self, rfile, length: int, sink) -> int:
+        """Read `length` bytes into sink (bytearray or hash object) under the bandwidth cap."""
+        remaining = length
+        while remaining > 0:
+            chunk = rfile.read(min(256 * 1024, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if isinstance(sink, bytearray):
+                sink += chunk
+            else:
+                sink.update(chunk)
+            if self.bytes_per_s > 0:
+                with self._lock:
+                    now = time.monotonic()
+                    self._bw_next = max(self._bw_next, now) + len(chunk) / self.bytes_per_s
+                    wait_s = self._bw_next - now
+                time.sleep(max(0.0, wait_s))
+        with self._lock:
+            self.stats["bytesIn"] += length - remaining
+        return length - remaining
+
+    def fault(self) -> Optional[Tuple[int, Dict[str, str]]]:
+        """
+        Maybe pick an injected error: (status, headers), or None when the request is admitted (the
+        caller then owes a release()). Latency applies either way.
+        """
+        result: Optional[Tuple[int, Dict[str, str]]] = None
+        with self._lock:
+            self.stats["requests"] += 1
+            r = self._rng.random()
+            if self.max_concurrent and self._active >= self.max_concurrent:
+                self.stats["injected429"] += 1
+                result = 429, {"Retry-After": "1"}
+            elif r < self.rate_429:
+                self.stats["injected429"] += 1
+                result = 429, {"Retry-After": "1"}
+            elif r < self.rate_429 + self.error_rate:
+                self.stats["injected5xx"] += 1
+                result = self._rng.choice((500, 502, 503)), {}
+            else:
+                self._active += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return result
+
+    def release(self) -> None:
+        with self._lock:
+            self._active -= 1
+
+    def _put_object(
+        self,
+        key: str,
+        *,
+        size: int,
+        digest: str,
+        md5: str,
+        content_type: str,
+        upsert: bool,
+        body: Optional[bytes] = None,
+        user_metadata: Optional[Dict[str, object]] = None,
+    ) -> Tuple[int, object]:
+        with self._lock:
+            if key in self.objects and not upsert:
+                return 409, {"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"}
+            self.objects[key] = {"size": size, "sha256": digest, "md5": md5, "contentType": content_type}
+            if user_metadata:
+                self.objects[key]["userMetadata"] = user_metadata
+            if body is not None:
+                self.objects[key]["body"] = body
+        return 200, {"Key": key}
+
+    def _list(self, bucket: str, data: bytes) -> Tuple[int, object]:
+        """POST /object/list/{bucket}: one page of the files directly under `prefix`, by name."""
+        try:
+            req = json.loads(data.decode("utf-8"))
+        except ValueError:
+            return 400, {"statusCode": "400", "error": "invalid_json", "message": "bad list body"}
+        folder = f"{bucket}/{str(req.get('prefix') or '').strip('/')}/".replace("//", "/")
+        offset, limit = int(req.get("offset") or 0), int(req.get("limit") or 100)
+        with self._lock:
+            names = sorted(k[len(folder) :] for k in self.objects if k.startswith(folder) and "/" not in k[len(folder) :])
+            page = []
+            for name in names[offset : offset + limit]:
+                meta = self.objects[folder + name]
+                page.append(
+                    {
+                        "name": name,
+                        "id": hashlib.sha1((folder + name).encode("utf-8")).hexdigest(),
+                        "metadata": {"size": meta["size"], "mimetype": meta["contentType"], "eTag": f'"{meta["md5"]}"'},
+                        "user_metadata": meta.get("userMetadata"),
+                    }
+                )
+        return 200, page
+
+    def dispatch(
+        self, method: str, path: str, headers, *, size: int, digests: _BodyDigests, data: bytes
+    ) -> Tuple[int, Optional[object], Dict[str, str]]:
+        upsert = (headers.get("x-upsert") or "").lower() == "true"
+        obj_prefix = "/storage/v1/object/"
+        list_prefix = "/storage/v1/object/list/"
+        tus_prefix = "/storage/v1/upload/resumable"
+
+        if path.startswith(list_prefix) and method == "POST":
+            status, obj = self._list(unquote(path[len(list_prefix) :]).strip("/"), data)
+            return status, obj, {}
+
+        if path.startswith(obj_prefix) and method in ("POST", "PUT"):
+            key = unquote(path[len(obj_prefix) :])
+            content_type = headers.get("Content-Type") or "application/octet-stream"
+            digest, md5 = digests.sha256.hexdigest(), digests.md5.hexdigest()
+            if data:
+                digest, md5 = hashlib.sha256(data).hexdigest(), hashlib.md5(data).hexdigest()
+            try:
+                user_metadata = json.loads(base64.b64decode(headers.get("x-metadata") or "") or b"null")
+            except ValueError:
+                return 400, {"statusCode": "400", "error": "invalid_metadata", "message": "bad x-metadata"}, {}
+            status, obj = self._put_object(
+                key,
+                size=size,
+                digest=digest,
+                md5=md5,
+                content_type=content_type,
+                upsert=upsert or method == "PUT",
+                body=data or None,
+                user_metadata=user_metadata,
+            )
+            return status, obj, {}
+
+        if path.startswith(obj_prefix) and method == "GET":
+            with self._lock:
+                meta = self.objects.get(unquote(path[len(obj_prefix) :]))
+            if meta is None:
+                return 404, {"statusCode": "404", "error": "not_found", "message": "Object not found"}, {}
+            if "body" not in meta:
+                return 501, {"statusCode": "501", "error": "mock", "message": "mock keeps only JSON/gzip bodies"}, {}
+            return 200, bytes(meta["body"]), {}  # type: ignore[arg-type]
+
+        if path.startswith(obj_prefix) and method == "DELETE":
+            bucket = unquote(path[len(obj_prefix) :]).strip("/")
+            try:
+                prefixes = json.loads(data.decode("utf-8")).get("prefixes") or []
+            except ValueError:
+                return 400, {"statusCode": "400", "error": "invalid_json", "message": "bad delete body"}, {}
+            deleted = []
+            with self._lock:
+                for name in prefixes:
+                    if self.objects.pop(f"{bucket}/{name}", None) is not None:
+                        deleted.append({"name": name, "bucket_id": bucket})
+            return 200, deleted, {}
+
+        if path == tus_prefix and method == "POST":
+            meta: Dict[str, str] = {}
+            for item in (headers.get("Upload-Metadata") or "").split(","):
+                if " " in item.strip():
+                    k, v = item.strip().split(" ", 1)
+                    meta[k] = base64.b64decode(v).decode("utf-8")
+            key = f"{meta.get('bucketName', '')}/{meta.get('objectName', '')}"
+            with self._lock:
+                if key in self.objects and not upsert:
+                    return 409, {"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"}, {}
+                upload_id = hashlib.sha1(f"{key}:{time.time_ns()}".encode("utf-8")).hexdigest()
+                self._uploads[upload_id] = {
+                    "key": key,
+                    "length": int(headers.get("Upload-Length") or 0),
+                    "offset": 0,
+                    "hash": _BodyDigests(),
+                    "contentType": meta.get("contentType", "application/octet-stream"),
+                    "userMetadata": json.loads(meta["metadata"]) if meta.get("metadata") else None,
+                }
+            return 201, None, {"Location": f"{tus_prefix}/{upload_id}", "Tus-Resumable": "1.0.0"}
+
+        if path.startswith(tus_prefix + "/") and method in ("HEAD", "PATCH"):
+            upload_id = path[len(tus_prefix) + 1 :]
+            with self._lock:
+                up = self._uploads.get(upload_id)
+                if up is None:
+                    return 404, None, {}
+                if method == "HEAD":
+                    return 200, None, {"Upload-Offset": str(up["offset"]), "Upload-Length": str(up["length"])}
+                if int(headers.get("Upload-Offset") or -1) != up["offset"]:
+                    return 409, {"statusCode": "409", "error": "Conflict", "message": "offset mismatch"}, {}
+                up["hash"].update(data)  # type: ignore[union-attr]
+                up["offset"] = int(up["offset"]) + len(data)  # type: ignore[call-overload]
+                done = up["offset"] >= up["length"]  # type: ignore[operator]
+                if done:
+                    self._uploads.pop(upload_id, None)
+            if done:
+                status, obj = self._put_object(
+                    str(up["key"]),
+                    size=int(up["offset"]),  # type: ignore[call-overload]
+                    digest=up["hash"].sha256.hexdigest(),  # type: ignore[union-attr]
+                    md5=up["hash"].md5.hexdigest(),  # type: ignore[union-attr]
+                    content_type=str(up["contentType"]),
+                    upsert=True,
+                    user_metadata=up["userMetadata"],  # type: ignore[arg-type]
+                )
+                if status >= 400:
+                    return status, obj, {}
+            return 204, None, {"Upload-Offset": str(up["offset"]), "Tus-Resumable": "1.0.0"}
+
+        return 404, {"statusCode": "404", "error": "not_found", "message": f"{method} {path}"}, {}
+
+
+StorageBackend = Union[SupabaseStorage, LocalStorage]
+
+
+@dataclass
+class UploadStats:
+    seconds: float
+    retries: int
+
+
+class UploadPool:
+    """
+    Bounded pool of upload threads over a storage backend (SupabaseStorage, LocalStorage).
+    """
+
+    def __init__(self, *, concurrency: int, storage: "StorageBackend") -> None:
+        self.concurrency = max(1, int(concurrency))
+        self.storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="upload")
+
+    def _upload(
+        self, object_path: str, content_type: str, body: UploadBody, upsert: bool, metadata: Optional[Dict[str, str]]
+    ) -> UploadStats:
+        t = time.perf_counter()
+        retries = self.storage.upload(
+            object_path=object_path, content_type=content_type, body=body, upsert=upsert, metadata=metadata
+        )
+        return UploadStats(seconds=time.perf_counter() - t, retries=retries)
+
+    def submit(
+        self, *, object_path: str, content_type: str, body: UploadBody, upsert: bool, metadata: Optional[Dict[str, str]] = None
+    ) -> Future:
+        """Queue one upload; the future resolves to its UploadStats."""
+        return self._executor.submit(self._upload, object_path, content_type, body, upsert, metadata)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def write_json_atomic(path: Path, obj: object) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(path)
+
+
+class ResumeStore:
+    """
+    Per-book resume state: a JSON snapshot plus an append-only NDJSON journal.
+
+      {state_dir}/{book_slug}.json     snapshot {bookSlug, updatedAt, uploadedByOriginal, sourceByOriginal}
+      {state_dir}/{book_slug}.ndjson   one {"originalName", "entry", "source"?} record per confirmed upload
+                                       ({"originalName", "removed": true} when a source is gone)
+
+    `sourceByOriginal` is the --sync manifest: source {size, mtimeNs, sha256} per original name.
+
+    Recording an upload appends and flushes one line (O(1)) instead of rewriting the whole map.
+    The journal is folded into the snapshot once it grows past the snapshot size (amortized O(1)
+    per record) and on close(). Crash safety matches the old tmp-and-rename rewrite: the snapshot
+    is still replaced atomically, a torn trailing journal line is ignored on load, and replaying
+    records already in the snapshot is harmless.
+    """
+
+    def __init__(self, state_dir: Path, book_slug: str) -> None:
+        self.book_slug = book_slug
+        self.snapshot_path = Path(state_dir) / f"{book_slug}.json"
+        self.journal_path = Path(state_dir) / f"{book_slug}.ndjson"
+        self.uploaded_by_original: Dict[str, object] = {}
+        self.sources: Dict[str, Dict[str, object]] = {}
+        self._journal = None
+        self._journal_records = 0
+
+    def load(self) -> Dict[str, object]:
+        state: Dict[str, object] = {}
+        if self.snapshot_path.exists():
+            try:
+                state = json.loads(self.snapshot_path.read_text(encoding="utf-8"))
+            except Exception:
+                state = {}
+        uploaded = state.get("uploadedByOriginal")
+        self.uploaded_by_original = dict(uploaded) if isinstance(uploaded, dict) else {}
+        sources = state.get("sourceByOriginal")
+        self.sources = dict(sources) if isinstance(sources, dict) else {}
+
+        if self.journal_path.exists():
+            with self.journal_path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn write from a crash mid-append
+                    if not isinstance(rec, dict) or not isinstance(rec.get("originalName"), str):
+                        continue
+                    name = rec["originalName"]
+                    if rec.get("removed"):
+                        self.uploaded_by_original.pop(name, None)
+                        self.sources.pop(name, None)
+                    else:
+                        self.uploaded_by_original[name] = rec.get("entry")
+                        if isinstance(rec.get("source"), dict):
+                            self.sources[name] = rec["source"]
+                    self._journal_records += 1
+        return self.uploaded_by_original
+
+    def record(
+        self, original_name: str, entry: Dict[str, object], source: Optional[Dict[str, object]] = None
+    ) -> None:
+        self.uploaded_by_original[original_name] = entry
+        rec: Dict[str, object] = {"originalName": original_name, "entry": entry}
+        if source is not None:
+            self.sources[original_name] = source
+            rec["source"] = source
+        self._append(rec)
+
+    def forget(self, original_name: str) -> None:
+        self.uploaded_by_original.pop(original_name, None)
+        self.sources.pop(original_name, None)
+        self._append({"originalName": original_name, "removed": True})
+
+    def _append(self, rec: Dict[str, object]) -> None:
+        if self._journal is None:
+            self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+            torn = False
+            if self.journal_path.exists() and self.journal_path.stat().st_size > 0:
+                with self.journal_path.open("rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    torn = f.read(1) != b"\n"
+            self._journal = self.journal_path.open("a", encoding="utf-8")
+            if torn:
+                # Terminate a torn trailing line so the next record starts on its own line.
+                self._journal.write("\n")
+        self._journal.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        self._journal_records += 1
+        if self._journal_records >= max(1000, len(self.uploaded_by_original)):
+            self.compact()
+
+    def compact(self) -> None:
+        """Fold the journal into the snapshot: atomic snapshot replace first, then truncate the journal."""
+        snapshot: Dict[str, object] = {
+            "bookSlug": self.book_slug,
+            "updatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "uploadedByOriginal": self.uploaded_by_original,
+        }
+        if self.sources:
+            snapshot["sourceByOriginal"] = self.sources
+        write_json_atomic(self.snapshot_path, snapshot)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.journal_path.unlink(missing_ok=True)
+        self._journal_records = 0
+
+    def close(self) -> None:
+        if self._journal_records:
+            self.compact()
+
+
+def classify_source(
+    path: SourceFile, prev_entry: Optional[Dict[str, object]], prev_source: Optional[Dict[str, object]]
+) -> Tuple[str, Dict[str, object]]:
+    """
+    --sync: compare a local source to the manifest. Returns ("added" | "changed" | "unchanged", source)
+    where source is the {size, mtimeNs, sha256} manifest record to keep.
+
+    Same size + mtime is trusted without reading the file; otherwise the content hash decides,
+    so a touched-but-identical file is still "unchanged".
+    """
+    st = path.stat()
+    source: Dict[str, object] = {"size": st.st_size, "mtimeNs": st.st_mtime_ns}
+    if (
+        prev_entry is not None
+        and prev_source is not None
+        and prev_source.get("size") == st.st_size
+        and prev_source.get("mtimeNs") == st.st_mtime_ns
+        and isinstance(prev_source.get("sha256"), str)
+    ):
+        return "unchanged", dict(prev_source)
+    source["sha256"] = sha256_file(path)
+    if prev_entry is None:
+        return "added", source
+    if prev_source is not None:
+        same = prev_source.get("sha256") == source["sha256"]
+    else:
+        # State written before --sync existed: only preserved uploads can be verified by hash.
+        same = prev_entry.get("storedSha256") == source["sha256"]
+    return ("unchanged" if same else "changed"), source
+
+
+def resumed_entry(uploaded_by_original: Dict[str, object], original_name: str) -> Optional[Dict[str, object]]:
+    entry = uploaded_by_original.get(original_name)
+    if isinstance(entry, dict) and isinstance(entry.get("storagePath"), str):
+        return entry
+    return None
+
+
+# -----------------------------
+# Sharding (--shard i/N, --merge-shards N)
+# -----------------------------
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Parse --shard "i/N" (0 <= i < N)."""
+    m = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", spec or "")
+    if not m or int(m.group(2)) < 1 or int(m.group(1)) >= int(m.group(2)):
+        raise ValueError(f"invalid --shard '{spec}' (expected i/N with 0 <= i < N)")
+    return int(m.group(1)), int(m.group(2))
+
+
+def shard_of(key: str, shards: int) -> int:
+    """Stable shard for a key (book slug or book/file name): same answer on every machine and run."""
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) % max(1, shards)
+
+
+def split_by_file(*, shard_by: str, file_count: int, auto_files: int) -> bool:
+    """Whether a book's files are spread over all shards (instead of the whole book going to one)."""
+    return shard_by == "file" or (shard_by == "auto" and file_count >= auto_files)
+
+
+def shard_index_path(prefix: str, book_slug: str, shard: int, shards: int) -> str:
+    return f"{prefix}/{book_slug}/shards/images-index.{shard}-of-{shards}.json"
+
+
+def predict_output_ext(path: SourceFile, *, convert: bool, alpha_mode: str, header: Optional[ImageHeader] = None) -> str:
+    """
+    Output extension prepare_file() will produce, from the header only: preserved files keep their
+    extension; converted images are PNG only when they keep an alpha channel. Sources Pillow cannot
+    open go through the streaming TIFF reducer, which always yields JPEG.
+    `header` skips reading it again when the caller already has it.
+    """
+    ext = path.suffix.lower().lstrip(".")
+    if not convert:
+        return ext
+    header = header or read_image_header(path)
+    has_alpha = header is not None and header.pillow and header.alpha
+    return "png" if has_alpha and alpha_mode == "png" else "jpg"
+
+
+def assign_object_name(object_name: str, used_names: Dict[str, int], taken_names: set) -> str:
+    """Unique name within a book prefix: first come keeps the name, later ones get __dupN."""
+    if object_name not in used_names and object_name not in taken_names:
+        used_names[object_name] = 0
+        return object_name
+    dup = used_names.get(object_name, 0)
+    base, ext2 = os.path.splitext(object_name)
+    while True:
+        dup += 1
+        candidate = safe_storage_filename(f"{base}__dup{dup}{ext2}")
+        if candidate not in taken_names:
+            break
+    used_names[object_name] = dup
+    return candidate
+
+
+def plan_object_names(files: List[SourceFile], *, convert_of, alpha_mode: str) -> Dict[str, str]:
+    """
+    Stored names for a whole book (files in sorted order), computed without decoding, so every
+    shard derives the same __dupN assignment no matter which subset of files it processes.
+    """
+    used_names: Dict[str, int] = {}
+    plan: Dict[str, str] = {}
+    for path in files:
+        ext = path.suffix.lower().lstrip(".")
+        out_ext = predict_output_ext(path, convert=convert_of(path), alpha_mode=alpha_mode)
+        candidate = safe_storage_filename(f"{path.name}.{out_ext}" if out_ext != ext else path.name)
+        plan[path.name] = assign_object_name(candidate, used_names, set())
+    return plan
+
+
+def plan_rendition_names(
+    files: List[SourceFile], name_plan: Dict[str, str], specs: Tuple[RenditionSpec, ...], *, alpha_mode: str
+) -> Dict[Tuple[str, str, str], str]:
+    """
+    Rendition file names for a whole book, keyed (original name, rendition, format): per rendition
+    folder in sorted file order, like plan_object_names(), so shards agree on __dupN.
+    """
+    used: Dict[str, Dict[str, int]] = {spec.name: {} for spec in specs}
+    plan: Dict[Tuple[str, str, str], str] = {}
+    for path in files:
+        for spec in renditions_for(path.name, specs):
+            for fmt in spec.formats:
+                ext = predict_output_ext(path, convert=True, alpha_mode=alpha_mode) if fmt == "jpeg" else RENDITION_FORMATS[fmt][0]
+                candidate = rendition_object_name(name_plan[path.name], ext)
+                plan[(path.name, spec.name, fmt)] = assign_object_name(candidate, used[spec.name], set())
+    return plan
+
+
+def merge_shard_indexes(book_slug: str, parts: List[Dict[str, object]]) -> Dict[str, object]:
+    """
+    Combine the per-shard images-index parts of one book into the final images-index.json.
+    Raises RuntimeError("BLOCKED: ...") if shards disagree on settings or the union is not exactly
+    the book's file list (missing/duplicate files or colliding storage paths).
+    """
+    settings_keys = ("maxPx", "jpegQuality", "jpegTargetSsim", "jpegQualityRange", "alphaMode", "renditions")
+    first = parts[0]
+    for part in parts[1:]:
+        for k in settings_keys:
+            if part.get(k) != first.get(k):
+                raise RuntimeError(f"BLOCKED: {book_slug}: shards disagree on {k} ({first.get(k)!r} vs {part.get(k)!r})")
+    entries: List[Dict[str, object]] = [e for part in parts for e in part.get("entries") or []]  # type: ignore[union-attr]
+    entries.sort(key=lambda e: str(e.get("originalName")))
+    names = [str(e.get("originalName")) for e in entries]
+    paths = [p for e in entries for p in entry_storage_paths(e)]
+    if len(set(names)) != len(names) or len(set(paths)) != len(paths):
+        raise RuntimeError(f"BLOCKED: {book_slug}: shards produced duplicate files or storage paths")
+    expected = int(first.get("bookFiles") or 0)  # type: ignore[call-overload]
+    if len(entries) != expected:
+        raise RuntimeError(f"BLOCKED: {book_slug}: merged {len(entries)} entries, book has {expected} files")
+    index: Dict[str, object] = {
+        "bookSlug": book_slug,
+        "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        **{k: first[k] for k in settings_keys if k in first},
+        "entries": entries,
+        "srcMap": {str(e["originalName"]): e["storagePath"] for e in entries},
+    }
+    return index
+
+
+def run_merge_shards(
+    *,
+    storage: "StorageBackend",
+    book_dirs: List[BookSource],
+    prefix: str,
+    shards: int,
+    dry_run: bool,
+    compact_prefix_len: Optional[int],
+) -> None:
+    """
+    --merge-shards N: for every book that the shard runs split by file, fetch the N index parts,
+    publish the merged images-index.json and delete the parts. Split books are found by probing
+    storage for part 0 (the --shard-by used by the shard runs is not needed here); whole-book
+    shards already uploaded their final index and are skipped.
+    """
+    merged = 0
+    for book_dir in sorted(book_dirs, key=lambda p: p.name):
+        if list_book_files(book_dir) is None:
+            continue
+        book_slug = book_dir.name
+        part_paths = [shard_index_path(prefix, book_slug, i, shards) for i in range(shards)]
+        first = storage.download(part_paths[0])
+        if first is None:
+            continue
+        parts: List[Dict[str, object]] = [json.loads(first.decode("utf-8"))]
+        missing: List[str] = []
+        for part_path in part_paths[1:]:
+            data = storage.download(part_path)
+            if data is None:
+                missing.append(part_path)
+            else:
+                parts.append(json.loads(data.decode("utf-8")))
+        if missing:
+            raise RuntimeError(f"BLOCKED: {book_slug}: missing shard index parts (shard not finished?): {', '.join(missing)}")
+        index = merge_shard_indexes(book_slug, parts)
+        index_path = f"{prefix}/{book_slug}/images-index.json"
+        if dry_run:
+            print(f"  (dry-run) {book_slug}: would merge {shards} parts ({len(index['entries'])} entries) into {index_path}")  # type: ignore[arg-type]
+            continue
+        index_bytes = json.dumps(index, ensure_ascii=False, indent=2).encode("utf-8")
+        storage.upload(object_path=index_path, content_type="application/json", body=index_bytes, upsert=True)
+        if compact_prefix_len is not None:
+            publish_compact_index(storage, index, prefix=prefix, prefix_len=compact_prefix_len, dry_run=False)
+        storage.delete(part_paths)
+        merged += 1
+        print(f"  [OK] {book_slug}: merged {shards} parts ({len(index['entries'])} entries) into {index_path}")  # type: ignore[arg-type]
+    if merged or dry_run:
+        print(f"\n[OK] Merged {merged} split books")
+    else:
+        print(f"\n[WARN] No shard index parts found under {prefix}/*/shards/ for {shards} shards; nothing merged", file=sys.stderr)
+
+
+# -----------------------------
+# Compact index (images-index.min.json.gz)
+# -----------------------------
+
+COMPACT_INDEX_VERSION = 1
+COMPACT_INDEX_NAME = "images-index.min.json.gz"
+
+
+def normalize_stem_key(raw: str) -> str:
+    """
+    Same key as normalizeStemKey() in supabase/functions/book-version-input-urls: basename without
+    extension, lowercased, ch0N/img0N unpadded, runs of other characters collapsed to "_".
+    """
+    base = re.split(r"[\\/]", str(raw or "").strip())[-1].strip()
+    s = re.sub(r"\.[a-z0-9]+$", "", base, flags=re.IGNORECASE).lower()
+    s = re.sub(r"ch0+(\d+)", r"ch\1", s)
+    s = re.sub(r"img0+(\d+)", r"img\1", s)
+    return re.sub(r"[^a-z0-9]+", "_", s).strip("_")
+
+
+def compact_shard_key(stem: str, prefix_len: int) -> str:
+    """Shard of a normalized key: its first prefix_len characters ("_" for an empty key)."""
+    return stem[:prefix_len] or "_"
+
+
+def compact_shard_path(prefix: str, book_slug: str, key: str) -> str:
+    return f"{prefix}/{book_slug}/images-index.min/{key}.json.gz"
+
+
+def _gzip_json(doc: Dict[str, object]) -> bytes:
+    # mtime=0 keeps the bytes stable so unchanged indexes hash the same between runs.
+    raw = json.dumps(doc, ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return gzip.compress(raw, compresslevel=9, mtime=0)
+
+
+def build_compact_index(index: Dict[str, object], *, prefix: str, prefix_len: int) -> Dict[str, bytes]:
+    """
+    Lookup-only view of images-index.json for render jobs, as {object_path: gzip bytes}.
+
+    `src` maps the exact original name and `stem` the normalized key (first name wins, like the
+    edge functions) to the storage path relative to `base`. With prefix_len > 0 both maps are split
+    into shards by the first prefix_len characters of the normalized key; the top-level document
+    then only lists the shards, so a job that needs a few images fetches a few small files.
+    """
+    book_slug = str(index["bookSlug"])
+    base = f"{prefix}/{book_slug}/"
+    src_map: Dict[str, str] = index.get("srcMap") or {}  # type: ignore[assignment]
+    shards: Dict[str, Dict[str, Dict[str, str]]] = {}
+    for name, path in src_map.items():
+        rel = path[len(base):] if path.startswith(base) else path
+        stem = normalize_stem_key(name)
+        part = shards.setdefault(compact_shard_key(stem, prefix_len) if prefix_len > 0 else "", {"src": {}, "stem": {}})
+        part["src"][name] = rel
+        if stem:
+            part["stem"].setdefault(stem, rel)
+    head: Dict[str, object] = {"v": COMPACT_INDEX_VERSION, "bookSlug": book_slug, "base": base}
+    out: Dict[str, bytes] = {}
+    if prefix_len <= 0:
+        part = shards.get("", {"src": {}, "stem": {}})
+        out[f"{base}{COMPACT_INDEX_NAME}"] = _gzip_json({**head, **part})
+        return out
+    for key, part in shards.items():
+        out[compact_shard_path(prefix, book_slug, key)] = _gzip_json({**head, "shard": key, **part})
+    out[f"{base}{COMPACT_INDEX_NAME}"] = _gzip_json({**head, "prefixLen": prefix_len, "shards": sorted(shards)})
+    return out
+
+
+def publish_compact_index(
+    storage: "StorageBackend",
+    index: Dict[str, object],
+    *,
+    prefix: str,
+    prefix_len: int,
+    dry_run: bool,
+) -> None:
+    """Upload the compact index (shards first, then the top-level document) and drop shards that went away."""
+    book_slug = str(index["bookSlug"])
+    docs = build_compact_index(index, prefix=prefix, prefix_len=prefix_len)
+    head_path = f"{prefix}/{book_slug}/{COMPACT_INDEX_NAME}"
+    size = sum(len(b) for b in docs.values())
+    if dry_run:
+        print(f"  (dry-run) would upload compact index: {head_path} ({len(docs)} objects, {size / 1024:.1f} KB gz)")
+        return
+    previous: Optional[List[str]] = []
+    try:
+        prev_bytes = storage.download(head_path)
+    except (StorageError, requests.RequestException) as e:
+        # The book's objects and JSON index are already up; only stale-shard cleanup depends on this.
+        print(f"  [WARN] could not fetch previous compact index {head_path} (stale shards kept): {str(e)[:120]}", file=sys.stderr)
+        prev_bytes, previous = None, None
+    if prev_bytes is not None:
+        try:
+            prev = json.loads(gzip.decompress(prev_bytes).decode("utf-8"))
+            previous = [compact_shard_path(prefix, book_slug, k) for k in prev.get("shards") or []]
+        except (OSError, ValueError):
+            previous = []
+    for path in sorted(docs, key=lambda p: p == head_path):
+        storage.upload(object_path=path, content_type="application/gzip", body=docs[path], upsert=True)
+    stale = sorted(set(previous) - set(docs)) if previous is not None else []
+    if stale:
+        storage.delete(stale)
+    print(f"  [OK] uploaded compact index: {head_path} ({len(docs)} objects, {size / 1024:.1f} KB gz)")
+
+
+# -----------------------------
+# Run metrics (stage timings, counters, --metrics-out)
+# -----------------------------
+
+
+class RunMetrics:
+    """
+    Per-file stage timings and run counters (retries, bytes in/out, compression ratio).
+
+    With a path, each processed file is appended as one NDJSON event (plus run/book events) and
+    the summary is written next to it as {stem}.summary.json. Only aggregates and the top
+    SLOWEST files are held in memory, so a full-library run costs O(stages) memory.
+    """
+
+    SLOWEST = 20
+
+    def __init__(self, path: Optional[Path]) -> None:
+        self.path = path
+        self._fh = None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._fh = path.open("a", encoding="utf-8")
+        self.started = time.time()
+        self.stage_seconds: Dict[str, float] = {}
+        self.files = 0
+        self.converted = 0
+        self.resumed = 0
+        self.objects = 0
+        self.retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._slowest: List[Tuple[float, int, Dict[str, object]]] = []
+
+    def emit(self, event: str, **fields: object) -> None:
+        if self._fh is None:
+            return
+        self._fh.write(json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, ensure_ascii=False) + "\n")
+        self._fh.flush()
+
+    def file_done(
+        self,
+        *,
+        book: str,
+        name: str,
+        converted: bool,
+        bytes_in: int,
+        bytes_out: int,
+        stages: Dict[str, float],
+        retries: int,
+        objects: int,
+    ) -> None:
+        seconds = sum(stages.values())
+        self.files += 1
+        self.converted += int(converted)
+        self.objects += objects
+        self.retries += retries
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        for stage, secs in stages.items():
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + secs
+        record: Dict[str, object] = {
+            "book": book,
+            "name": name,
+            "action": "converted" if converted else "preserved",
+            "bytesIn": bytes_in,
+            "bytesOut": bytes_out,
+            "ratio": round(bytes_out / bytes_in, 4) if bytes_in else None,
+            "seconds": round(seconds, 4),
+            "stages": {k: round(v, 4) for k, v in sorted(stages.items())},
+            "retries": retries,
+            "objects": objects,
+        }
+        self.emit("file", **record)
+        item = (seconds, self.files, record)
+        if len(self._slowest) < self.SLOWEST:
+            heapq.heappush(self._slowest, item)
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            "wallSeconds": round(time.time() - self.started, 3),
+            "files": self.files,
+            "converted": self.converted,
+            "preserved": self.files - self.converted,
+            "resumed": self.resumed,
+            "objects": self.objects,
+            "retries": self.retries,
+            "bytesIn": self.bytes_in,
+            "bytesOut": self.bytes_out,
+            "compressionRatio": round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else None,
+            "stageSeconds": {k: round(v, 3) for k, v in sorted(self.stage_seconds.items(), key=lambda kv: -kv[1])},
+            "slowest": [rec for _, _, rec in sorted(self._slowest, key=lambda it: -it[0])],
+        }
+
+    def print_summary(self, top: int = 10) -> None:
+        summary = self.summary()
+        total = sum(self.stage_seconds.values()) or 1.0
+        print(
+            f"\n[OK] Metrics: {self.files} files ({self.converted} converted, {self.resumed} resumed), "
+            f"{self.retries} retries, {self.bytes_in / 2**20:.1f} MB in -> {self.bytes_out / 2**20:.1f} MB out"
+            + (f" (ratio {summary['compressionRatio']:.3f})" if summary["compressionRatio"] is not None else "")
+        )
+        for stage, secs in summary["stageSeconds"].items():  # type: ignore[union-attr]
+            print(f"  {stage:15s} {secs:10.2f}s  {100.0 * secs / total:5.1f}%")
+        slowest = summary["slowest"][:top]  # type: ignore[index]
+        if slowest:
+            print("  slowest files:")
+            for rec in slowest:
+                stages = rec["stages"]
+                worst = max(stages, key=stages.get) if stages else "-"
+                print(f"    {rec['seconds']:8.2f}s  {rec['book']}/{rec['name']}  (mostly {worst})")
+
+    def close(self) -> None:
+        if self._fh is None:
+            return
+        summary = self.summary()
+        self.emit("run_end", **summary)
+        self._fh.close()
+        self._fh = None
+        write_json_atomic(self.path.with_name(self.path.stem + ".summary.json"), summary)  # type: ignore[union-attr]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--root",
+        default="books",
+        help="Local root folder containing book directories, or extracted_images.zip itself "
+        "(extracted_images/{book}/linked_images/{files}; read in place, no extraction).",
+    )
+    parser.add_argument("--bucket", default="books", help="Supabase Storage bucket (default: books).")
+    parser.add_argument("--prefix", default="library", help="Storage prefix under the bucket.")
+    parser.add_argument("--max-px", type=int, default=3000, help="Max pixel dimension for optimized images.")
+    parser.add_argument("--jpeg-quality", type=int, default=85, help="JPEG quality for optimized images.")
+    parser.add_argument(
+        "--jpeg-target-ssim",
+        type=float,
+        default=0.0,
+        help="Per image, use the lowest JPEG quality whose SSIM on a full-resolution probe reaches this (e.g. 0.97; 0 = always --jpeg-quality).",
+    )
+    parser.add_argument("--jpeg-min-quality", type=int, default=50, help="--jpeg-target-ssim: lowest JPEG quality tried.")
+    parser.add_argument("--jpeg-max-quality", type=int, default=95, help="--jpeg-target-ssim: highest JPEG quality used.")
+    parser.add_argument("--max-upload-mb", type=int, default=40, help="Convert files larger than this MB.")
+    parser.add_argument(
+        "--convert-all",
+        action="store_true",
+        help="Force conversion/optimization for ALL non-SVG images (even if below --max-upload-mb). Useful to reduce PDF size by converting small RGB PNGs to JPEG.",
+    )
+    parser.add_argument(
+        "--alpha-mode",
+        type=str,
+        default="png",
+        choices=["png", "flatten-white-jpeg"],
+        help="How to encode images with an alpha channel: png=preserve transparency (larger), flatten-white-jpeg=flatten onto white and encode JPEG (smaller).",
+    )
+    parser.add_argument("--upsert", action="store_true", help="Overwrite existing objects.")
+    parser.add_argument("--timeout-s", type=int, default=600, help="HTTP timeout per upload request.")
+    parser.add_argument("--retries", type=int, default=5, help="Retry count for transient Storage errors (uploads, listing, downloads, deletes).")
+    parser.add_argument("--state-dir", default="tmp/book-images-upload-state", help="Local resume state dir (gitignored).")
+    parser.add_argument("--no-resume", action="store_true", help="Disable resume and reprocess every file.")
+    parser.add_argument("--only-book", default="", help="Process only a single book slug (for smoke tests).")
+    parser.add_argument("--limit", type=int, default=0, help="Max files per book (0 = no limit).")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Do not upload; run everything else and report what would happen (exact sizes; see --plan for a fast projection).",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Read image headers only and project convert/preserve, upload volume and runtime from a small calibration sample.",
+    )
+    parser.add_argument("--plan-sample", type=int, default=3, help="--plan: files optimized per class (source -> stored format) to calibrate.")
+    parser.add_argument("--plan-upload-mbps", type=float, default=100.0, help="--plan: assumed upload bandwidth in Mbit/s.")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Incremental sync: re-process only new/changed sources (size+mtime+sha256 manifest) and delete remote objects no longer in images-index.json. "
+        "Objects near-duplicates still point at are kept; a changed canonical is uploaded under a new name.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes for the optimize stage (1 = in-process, 0 = one per CPU). Output order stays deterministic.",
+    )
+    parser.add_argument(
+        "--upload-concurrency",
+        type=int,
+        default=4,
+        help="Concurrent upload workers (each with its own keep-alive connection); the starting point when adaptive.",
+    )
+    parser.add_argument(
+        "--upload-max-concurrency",
+        type=int,
+        default=16,
+        help="Ceiling for the adaptive upload concurrency (grows while the server keeps up, shrinks on 429/503 or rising latency).",
+    )
+    parser.add_argument("--upload-min-concurrency", type=int, default=1, help="Floor for the adaptive upload concurrency.")
+    parser.add_argument(
+        "--fixed-upload-concurrency",
+        action="store_true",
+        help="Always run exactly --upload-concurrency uploads (no adaptation).",
+    )
+    parser.add_argument(
+        "--resumable-threshold-mb",
+        type=float,
+        default=20.0,
+        help="Upload objects larger than this with the resumable (TUS, 6 MB chunks) protocol (0 = never).",
+    )
+    parser.add_argument(
+        "--tiff-memory-mb",
+        type=int,
+        default=1024,
+        help="Hard cap on decoded-pixel memory per image for the streaming TIFF reducer.",
+    )
+    parser.add_argument("--tiff-threads", type=int, default=4, help="Decode threads per image for the streaming TIFF reducer.")
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=int,
+        default=0,
+        help="Decoded-pixel memory shared by all --workers (estimated from image headers; 0 = half of physical RAM).",
+    )
+    parser.add_argument(
+        "--schedule-window",
+        type=int,
+        default=64,
+        help="--workers > 1: start the largest images first among the next N files (results wait in memory until their turn).",
+    )
+    parser.add_argument(
+        "--max-image-pixels",
+        type=int,
+        default=0,
+        help="Refuse to decode sources with more pixels than this (Pillow decompression-bomb guard; 0 = no limit).",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default="",
+        help="Local cache of optimized renditions, reused across runs/buckets/environments (empty = disabled).",
+    )
+    parser.add_argument("--cache-max-gb", type=float, default=20.0, help="LRU size cap for --cache-dir.")
+    parser.add_argument(
+        "--renditions",
+        default="",
+        help="Extra sizes/formats per image from the same decode, e.g. 'thumb=320:jpeg+webp,web=1200:jpeg+webp,print=3000:jpeg' "
+        "(uploaded to {prefix}/{book}/renditions/{name}/, listed per entry in images-index.json; capped at --max-px). "
+        "With --alpha-mode png, jpeg renditions of images with transparency are written as PNG.",
+    )
+    parser.add_argument(
+        "--shard",
+        default="",
+        help="Process only shard i of N ('i/N', 0 <= i < N) so a full rebuild can be spread over several machines.",
+    )
+    parser.add_argument(
+        "--shard-by",
+        default=None,
+        choices=["book", "file", "auto"],
+        help="book (default)=each book goes to one shard; file=every book is split by file hash (then run --merge-shards); "
+        "auto=split only books with >= --shard-auto-files files. Not needed by --merge-shards, which finds split books in storage.",
+    )
+    parser.add_argument("--shard-auto-files", type=int, default=2000, help="--shard-by auto: split books at least this large.")
+    parser.add_argument(
+        "--merge-shards",
+        type=int,
+        default=0,
+        help="After all N shards finished: merge their per-shard index parts into images-index.json for every split book.",
+    )
+    parser.add_argument(
+        "--near-dup",
+        action="store_true",
+        help="Detect near-duplicate images across books (pHash + dHash) and point their srcMap entries at one "
+        "shared canonical object instead of uploading another copy. Needs numpy; state in {state-dir}/near-duplicates.json.",
+    )
+    parser.add_argument(
+        "--near-dup-distance",
+        type=int,
+        default=6,
+        help="--near-dup: max Hamming distance (of 64 bits, 0-15) for both hashes to count as a duplicate.",
+    )
+    parser.add_argument(
+        "--reconcile-remote",
+        action="store_true",
+        help="List the book's remote folders once and upload only objects that are missing or differ "
+        "(size + sha256 metadata / MD5 eTag). Lets a fresh machine without --state-dir skip objects already uploaded.",
+    )
+    parser.add_argument(
+        "--no-compact-index",
+        action="store_true",
+        help=f"Do not publish {COMPACT_INDEX_NAME} (minified + gzipped lookup index with normalized keys).",
+    )
+    parser.add_argument(
+        "--compact-index-prefix-len",
+        type=int,
+        default=0,
+        help="Shard the compact index by the first N characters of the normalized key (0 = one file). "
+        "Useful for books with 10k+ images.",
+    )
+    parser.add_argument(
+        "--storage",
+        default="supabase",
+        choices=["supabase", "local", "mock"],
+        help="Upload target: supabase=Storage REST API (env credentials), local=directory (--local-dir), "
+        "mock=in-process HTTP stand-in with fault injection (--mock-*), for offline load tests.",
+    )
+    parser.add_argument("--local-dir", default="tmp/book-images-local-storage", help="Root for --storage local.")
+    parser.add_argument("--mock-latency-ms", type=float, default=0.0, help="--storage mock: added latency per request.")
+    parser.add_argument("--mock-error-rate", type=float, default=0.0, help="--storage mock: fraction of requests failing with 5xx.")
+    parser.add_argument("--mock-429-rate", type=float, default=0.0, help="--storage mock: fraction of requests answered 429.")
+    parser.add_argument(
+        "--mock-bandwidth-mbps", type=float, default=0.0, help="--storage mock: shared upload bandwidth cap (0 = unlimited)."
+    )
+    parser.add_argument(
+        "--mock-max-concurrent",
+        type=int,
+        default=0,
+        help="--storage mock: answer 429 (Retry-After: 1) while this many requests are already in progress (0 = no cap).",
+    )
+    parser.add_argument("--mock-seed", type=int, default=0, help="--storage mock: RNG seed for injected faults.")
+    parser.add_argument(
+        "--metrics-out",
+        default="",
+        help="Append per-file stage timings as NDJSON events here; the run summary goes to {stem}.summary.json.",
+    )
+    args = parser.parse_args()
+
+    try:
+        renditions = parse_renditions(args.renditions)
+    except ValueError as e:
+        print(f"[BLOCKED] --renditions: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.sync and (args.no_resume or args.limit):
+        print("[BLOCKED] --sync needs the full file list and resume state; drop --no-resume/--limit.", file=sys.stderr)
+        sys.exit(1)
+
+    shard: Optional[Tuple[int, int]] = None
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        print(f"[BLOCKED] {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.merge_shards and shard is not None:
+        print("[BLOCKED] --merge-shards runs once after all shards; drop --shard.", file=sys.stderr)
+        sys.exit(1)
+    if args.merge_shards and args.shard_by == "book":
+        print("[BLOCKED] --merge-shards with --shard-by book: whole-book shards have nothing to merge.", file=sys.stderr)
+        sys.exit(1)
+    args.shard_by = args.shard_by or "book"
+    if args.sync and (shard is not None or args.merge_shards) and args.shard_by != "book":
+        # Orphan pruning needs the complete index of a book, which a file shard does not have.
+        print("[BLOCKED] --sync with sharding requires --shard-by book.", file=sys.stderr)
+        sys.exit(1)
+    if args.near_dup:
+        if shard is not None or args.merge_shards:
+            # Canonicals are "first seen in the library", which needs one run over all books.
+            print("[BLOCKED] --near-dup cannot be combined with --shard/--merge-shards.", file=sys.stderr)
+            sys.exit(1)
+        if not 0 <= int(args.near_dup_distance) <= 15:
+            print("[BLOCKED] --near-dup-distance must be between 0 and 15.", file=sys.stderr)
+            sys.exit(1)
+        if _optional_import("numpy") is None:
+            print("[BLOCKED] --near-dup requires numpy. Install: pip install numpy", file=sys.stderr)
+            sys.exit(1)
+    if args.jpeg_target_ssim:
+        if not 0 < float(args.jpeg_target_ssim) < 1 or not 1 <= int(args.jpeg_min_quality) <= int(args.jpeg_max_quality) <= 100:
+            print("[BLOCKED] --jpeg-target-ssim must be in (0, 1) and 1 <= --jpeg-min-quality <= --jpeg-max-quality <= 100.", file=sys.stderr)
+            sys.exit(1)
+        if _optional_import("numpy") is None:
+            print("[BLOCKED] --jpeg-target-ssim requires numpy. Install: pip install numpy", file=sys.stderr)
+            sys.exit(1)
+    # Shards keep separate resume state, so several shards can share one machine.
+    state_dir = Path(args.state_dir) / f"shard-{shard[0]}-of-{shard[1]}" if shard is not None else Path(args.state_dir)
+
+    def wants_convert(path: Path) -> bool:
+        ext = path.suffix.lower().lstrip(".")
+        return args.convert_all or should_convert(path, max_upload_mb=args.max_upload_mb) or ext not in SUPPORTED_PRESERVE_EXTS
+
+    root = Path(args.root)
+    if not root.exists():
+        print(f"[BLOCKED] root folder not found: {root}", file=sys.stderr)
+        sys.exit(1)
+
+    book_dirs: List[BookSource]
+    if root.is_file():
+        # The archive itself: members stream through optimize and upload without being extracted.
+        if not zipfile.is_zipfile(root):
+            print(f"[BLOCKED] --root is a file but not a zip archive: {root}", file=sys.stderr)
+            sys.exit(1)
+        book_dirs = scan_zip_library(root)
+        print(f"[OK] Source: {root} ({len(book_dirs)} books, {sum(len(b.files) for b in book_dirs)} images)")
+    else:
+        book_dirs = [p for p in root.iterdir() if p.is_dir()]
+    if args.only_book:
+        book_dirs = [p for p in book_dirs if p.name == args.only_book]
+        if not book_dirs:
+            print(f"[BLOCKED] --only-book '{args.only_book}' not found under {root}", file=sys.stderr)
+            sys.exit(1)
+
+    settings = OptimizeSettings(
+        max_px=int(args.max_px),
+        jpeg_quality=int(args.jpeg_quality),
+        alpha_mode=args.alpha_mode,
+        max_upload_mb=args.max_upload_mb,
+        tiff_memory_mb=int(args.tiff_memory_mb),
+        tiff_threads=max(1, int(args.tiff_threads)),
+        renditions=renditions,
+        near_dup=bool(args.near_dup),
+        max_image_pixels=max(0, int(args.max_image_pixels)),
+        target_ssim=float(args.jpeg_target_ssim),
+        jpeg_quality_range=(int(args.jpeg_min_quality), int(args.jpeg_max_quality)),
+    )
+    workers = int(args.workers) if int(args.workers) > 0 else (os.cpu_count() or 1)
+
+    if args.plan:
+        # Header-only projection: no decode beyond the calibration sample, no storage, no credentials.
+        run_plan(
+            book_dirs=book_dirs,
+            settings=settings,
+            convert_of=wants_convert,
+            state_dir=state_dir,
+            resume=not args.no_resume,
+            limit=args.limit,
+            workers=workers,
+            sample_per_class=int(args.plan_sample),
+            upload_mbps=float(args.plan_upload_mbps),
+        )
+        return
+
+    mock: Optional[MockStorageServer] = None
+    limiter: Optional[AdaptiveLimiter] = None
+    storage: StorageBackend
+    if args.storage == "local":
+        storage = LocalStorage(Path(args.local_dir), bucket=args.bucket)
+    else:
+        if args.storage == "mock":
+            mock = MockStorageServer(
+                latency_ms=args.mock_latency_ms,
+                error_rate=args.mock_error_rate,
+                rate_429=args.mock_429_rate,
+                bandwidth_mbps=args.mock_bandwidth_mbps,
+                max_concurrent=args.mock_max_concurrent,
+                seed=args.mock_seed,
+            )
+            supabase_url, service_key = mock.start(), "mock-service-role"
+        else:
+            env = resolve_env(["SUPABASE_URL", "SUPABASE_SERVICE_ROLE_KEY"])
+            supabase_url = env["SUPABASE_URL"]
+            service_key = env["SUPABASE_SERVICE_ROLE_KEY"]
+        if not args.fixed_upload_concurrency:
+            limiter = AdaptiveLimiter(
+                initial=int(args.upload_concurrency),
+                minimum=int(args.upload_min_concurrency),
+                maximum=max(int(args.upload_concurrency), int(args.upload_max_concurrency)),
+            )
+        storage = SupabaseStorage(
+            supabase_url=supabase_url,
+            service_role_key=service_key,
+            bucket=args.bucket,
+            timeout_s=int(args.timeout_s),
+            retries=int(args.retries),
+            resumable_threshold=int(args.resumable_threshold_mb * 1024 * 1024),
+            limiter=limiter,
+        )
+    if mock is not None:
+        print(f"[OK] Storage: in-process mock at {supabase_url} (bucket {args.bucket})")
+    elif args.storage == "local":
+        print(f"[OK] Storage: {storage.describe()}")
+
+    if args.merge_shards:
+        try:
+            run_merge_shards(
+                storage=storage,
+                book_dirs=book_dirs,
+                prefix=args.prefix,
+                shards=int(args.merge_shards),
+                dry_run=args.dry_run,
+                compact_prefix_len=None if args.no_compact_index else int(args.compact_index_prefix_len),
+            )
+        finally:
+            if mock is not None:
+                mock.stop()
+        return
+
+    total_uploaded = 0
+    start = time.time()
+    # Adaptive: one thread per possible slot; the limiter decides how many requests run at once.
+    uploader = UploadPool(concurrency=limiter.maximum if limiter is not None else args.upload_concurrency, storage=storage)
+    if limiter is not None:
+        print(f"[OK] Upload concurrency: adaptive, start {int(limiter.limit)}, range {limiter.minimum}-{limiter.maximum}")
+
+    cache = RenditionCache(Path(args.cache_dir), max_bytes=int(args.cache_max_gb * 1024**3)) if args.cache_dir else None
+
+    # --near-dup: library-wide canonical index (also read without --near-dup so --sync keeps shared objects).
+    near_path = state_dir / "near-duplicates.json"
+    near: Optional[NearDupIndex] = None
+    if args.near_dup:
+        near = NearDupIndex(near_path, max_distance=int(args.near_dup_distance))
+        if not args.no_resume:
+            near.load()
+        print(f"[OK] Near-duplicate index: {len(near.items)} canonical images (max distance {near.max_distance})")
+    near_refs = near
+    if near is None and near_path.exists():
+        near_refs = NearDupIndex(near_path, max_distance=int(args.near_dup_distance)).load()
+
+    metrics = RunMetrics(Path(args.metrics_out) if args.metrics_out else None)
+    metrics.emit("run_start", args={k: v for k, v in vars(args).items()})
+
+    pool: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    memory_budget_mb = int(args.memory_budget_mb) if int(args.memory_budget_mb) > 0 else default_memory_budget_mb()
+    if pool is not None:
+        print(f"[OK] Optimize: {workers} workers, {memory_budget_mb} MB decode budget, largest first within {max(workers * 2, int(args.schedule_window))} files")
+    try:
+        for book_dir in sorted(book_dirs, key=lambda p: p.name):
+            book_slug = book_dir.name
+            # Sorted so file order (entries, __dupN naming) is the same on every machine.
+            files = list_book_files(book_dir)
+            if files is None:
+                continue
+            if args.limit and args.limit > 0:
+                files = files[: args.limit]
+
+            # --shard: whole books go to one shard; books split by file get names planned up front.
+            name_plan: Optional[Dict[str, str]] = None
+            rendition_plan: Dict[Tuple[str, str, str], str] = {}
+            book_files = len(files)
+            if shard is not None:
+                shard_i, shard_n = shard
+                if split_by_file(shard_by=args.shard_by, file_count=len(files), auto_files=args.shard_auto_files):
+                    name_plan = plan_object_names(files, convert_of=wants_convert, alpha_mode=args.alpha_mode)
+                    rendition_plan = plan_rendition_names(files, name_plan, renditions, alpha_mode=args.alpha_mode)
+                    files = [p for p in files if shard_of(f"{book_slug}/{p.name}", shard_n) == shard_i]
+                elif shard_of(book_slug, shard_n) != shard_i:
+                    continue
+
+            resume_enabled = not args.no_resume and not args.dry_run
+            resume_store = ResumeStore(state_dir, book_slug)
+            # --sync reads the manifest even in --dry-run (report only; nothing is recorded).
+            uploaded_by_original = resume_store.load() if (resume_enabled or args.sync) else {}
+            prev_storage_paths = {p for e in uploaded_by_original.values() if isinstance(e, dict) for p in entry_storage_paths(e)}
+
+            if name_plan is not None:
+                print(f"\nBOOK {book_slug}: {len(files)}/{book_files} files (shard {shard[0]}/{shard[1]})")  # type: ignore[index]
+            else:
+                print(f"\nBOOK {book_slug}: {len(files)} files")
+
+            # --sync: classify every source against the manifest (added/changed/unchanged).
+            sync_status: Dict[str, str] = {}
+            sync_sources: Dict[str, Dict[str, object]] = {}
+            if args.sync:
+                for path in files:
+                    prev = resumed_entry(uploaded_by_original, path.name)
+                    status, source = classify_source(path, prev, resume_store.sources.get(path.name))
+                    sync_status[path.name] = status
+                    sync_sources[path.name] = source
+                    if status == "unchanged" and resume_enabled and source != resume_store.sources.get(path.name):
+                        resume_store.record(path.name, prev, source)  # type: ignore[arg-type]
+
+            # Optimize stage: everything not resumed, in file order (parallel when --workers > 1).
+            jobs: List[Tuple[SourceFile, bool]] = []
+            to_process = set()
+            # Resumed entries missing a configured rendition: re-processed and overwritten in place.
+            refresh = set()
+            for path in files:
+                resumed = resumed_entry(uploaded_by_original, path.name) if (resume_enabled or args.sync) else None
+                if resumed is not None and sync_status.get(path.name, "unchanged") == "unchanged":
+                    planned = name_plan is None or resumed.get("storedName") == name_plan[path.name]
+                    if planned and entry_has_renditions(resumed, renditions_for(path.name, renditions)):
+                        continue
+                    refresh.add(path.name)
+                to_process.add(path.name)
+                jobs.append((path, wants_convert(path)))
+            prepared_iter = iter_prepared(
+                jobs,
+                pool=pool,
+                workers=workers,
+                window=max(workers * 2, int(args.schedule_window)),
+                settings=settings,
+                cache=cache,
+                memory_budget_mb=memory_budget_mb,
+            )
+            if near is not None:
+                prepared_iter = with_perceptual_hashes(prepared_iter, batch=max(16, workers * 2))
+                # Canonicals from resume state that the index file does not know (e.g. it was deleted).
+                for name, e in uploaded_by_original.items():
+                    if isinstance(e, dict) and e.get("phash") and not e.get("duplicateOf") and e.get("storagePath") not in near:
+                        near.add(near_dup_item(book_slug, e, None))
+            near_dups = 0
+
+            index: Dict[str, object] = {
+                "bookSlug": book_slug,
+                "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "maxPx": args.max_px,
+                "jpegQuality": args.jpeg_quality,
+                "alphaMode": args.alpha_mode,
+                "entries": [],
+                "srcMap": {},
+            }
+            if renditions:
+                index["renditions"] = [spec.ident() for spec in renditions]
+            if settings.target_ssim > 0:
+                index["jpegTargetSsim"] = settings.target_ssim
+                index["jpegQualityRange"] = list(settings.jpeg_quality_range)
+            used_names: Dict[str, int] = {}
+            # Names held by every source still present (kept, changed or refreshed): a changed or refreshed
+            # file keeps its name below, so new names must not collide with any of them.
+            file_names = {p.name for p in files}
+            taken_names = {
+                str(e.get("storedName"))
+                for name, e in uploaded_by_original.items()
+                if isinstance(e, dict) and name in file_names
+            }
+            # Canonicals near-duplicates point at: --sync keeps those objects, so their names stay taken too
+            # and a changed canonical moves to a new name instead of overwriting what its duplicates serve.
+            shared_canonicals = set(near_refs.duplicates.values()) if near_refs is not None else set()
+            images_prefix = f"{args.prefix}/{book_slug}/images/"
+            if near_refs is not None:
+                taken_names |= {p[len(images_prefix) :] for p in near_refs.referenced_paths() if p.startswith(images_prefix)}
+            # Rendition names, reserved the same way per rendition folder: x.png's jpeg thumb and
+            # x.png.jpg's both want thumb/x.png.jpg.
+            renditions_prefix = f"{args.prefix}/{book_slug}/renditions/"
+            rendition_used: Dict[str, Dict[str, int]] = {spec.name: {} for spec in renditions}
+            rendition_taken: Dict[str, set] = {spec.name: set() for spec in renditions}
+            held_paths = {
+                p
+                for name, e in uploaded_by_original.items()
+                if isinstance(e, dict) and name in file_names
+                for p in entry_storage_paths(e)
+            }
+            if near_refs is not None:
+                held_paths |= near_refs.referenced_paths()
+            for p in held_paths:
+                if p.startswith(renditions_prefix) and "/" in p[len(renditions_prefix) :]:
+                    r_name, r_file = p[len(renditions_prefix) :].split("/", 1)
+                    rendition_taken.setdefault(r_name, set()).add(r_file)
+
+            # Uploads in flight: future -> (original_name, entry). Bounded so payloads don't pile up in memory.
+            # A file with renditions has several objects in flight; it is recorded once all of them land.
+            in_flight: Dict[Future, Tuple[str, Dict[str, object]]] = {}
+            pending_objects: Dict[str, int] = {}
+            # Per-file metrics until its last object lands: stages, retries, bytes, converted.
+            file_stats: Dict[str, Dict[str, object]] = {}
+            book_start = time.time()
+            max_in_flight = uploader.concurrency * 2
+            uploaded_count = 0
+
+            # --reconcile-remote: one paged listing per folder this book writes to.
+            remote: Optional[Dict[str, RemoteObject]] = None
+            remote_present = remote_skipped = 0
+            if args.reconcile_remote and jobs and not args.dry_run:
+                remote = {}
+                folders = [f"{args.prefix}/{book_slug}/images/"]
+                folders += [f"{args.prefix}/{book_slug}/renditions/{spec.name}/" for spec in renditions]
+                for folder in folders:
+                    remote.update(storage.list(folder))
+                print(f"  [OK] remote: listed {len(remote)} objects")
+
+            def settle(limit: int) -> None:
+                """Wait until at most `limit` uploads are in flight, recording each confirmed upload."""
+                nonlocal total_uploaded, uploaded_count
+                while len(in_flight) > limit:
+                    done, _ = wait(set(in_flight), return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        done_name, done_entry = in_flight.pop(fut)
+                        try:
+                            stats = fut.result()
+                        except Exception as e:
+                            msg = str(e)
+                            print(f"  [ERR] upload failed ({book_slug}/{done_name}): {msg[:200]}", file=sys.stderr)
+                            # Fail fast: these assets are required for later deterministic rendering.
+                            sys.exit(1)
+                        total_uploaded += 1
+                        rec = file_stats[done_name]
+                        stages: Dict[str, float] = rec["stages"]  # type: ignore[assignment]
+                        stages["upload"] = stages.get("upload", 0.0) + stats.seconds
+                        rec["retries"] = int(rec["retries"]) + stats.retries  # type: ignore[call-overload]
+                        pending_objects[done_name] -= 1
+                        if pending_objects[done_name] > 0:
+                            continue
+                        del pending_objects[done_name]
+                        uploaded_count += 1
+
+                        if resume_enabled:
+                            # Persist resume state incrementally to survive crashes (only after the object is confirmed).
+                            t_state = time.perf_counter()
+                            resume_store.record(done_name, done_entry, sync_sources.get(done_name))
+                            stages["state_write"] = time.perf_counter() - t_state
+                        metrics.file_done(book=book_slug, name=done_name, **file_stats.pop(done_name))  # type: ignore[arg-type]
+
+                        if uploaded_count % 25 == 0 or uploaded_count == len(jobs):
+                            print(f"  [OK] uploaded {uploaded_count}/{len(jobs)}")
+
+            for i, path in enumerate(files, start=1):
+                original_name = path.name
+
+                if original_name not in to_process:
+                    resumed = resumed_entry(uploaded_by_original, original_name)
+                    index["entries"].append(resumed)  # type: ignore
+                    index["srcMap"][original_name] = resumed["storagePath"]  # type: ignore
+                    metrics.resumed += 1
+                    if i % 50 == 0 or i == len(files):
+                        print(f"  [OK] resume-skip {i}/{len(files)}")
+                    continue
+
+                t_stat = time.perf_counter()
+                try:
+                    original_size = path.stat().st_size
+                except Exception:
+                    original_size = 0
+                stat_s = time.perf_counter() - t_stat
+
+                prepared = next(prepared_iter)
+                object_name = prepared.object_name
+                body = prepared.body
+                output_ext = prepared.output_ext
+                content_type = prepared.content_type
+                width, height, mode = prepared.width, prepared.height, prepared.mode
+
+                prev_entry = (
+                    resumed_entry(uploaded_by_original, original_name)
+                    if sync_status.get(original_name) == "changed" or original_name in refresh
+                    else None
+                )
+                prev_renditions: Dict[Tuple[object, object], str] = {}
+                if name_plan is not None:
+                    # Split book: the name was planned for the whole book so shards never collide.
+                    planned = name_plan[original_name]
+                    if os.path.splitext(planned)[1] != os.path.splitext(object_name)[1]:
+                        raise RuntimeError(f"BLOCKED: {book_slug}/{original_name}: planned name {planned} does not match .{output_ext} output")
+                    object_name = planned
+                elif (
+                    prev_entry is not None
+                    and prev_entry.get("storedExt") == output_ext
+                    and isinstance(prev_entry.get("storedName"), str)
+                    and not (sync_status.get(original_name) == "changed" and prev_entry.get("storagePath") in shared_canonicals)
+                ):
+                    # Changed or refreshed source: overwrite the object it replaces so storage paths stay stable.
+                    used_names.setdefault(object_name, 0)
+                    object_name = str(prev_entry["storedName"])
+                    # Its renditions keep their paths too.
+                    prev_renditions = {
+                        (r.get("name"), r.get("requestedFormat") or r.get("format")): str(r["storagePath"])
+                        for r in prev_entry.get("renditions") or []  # type: ignore[union-attr]
+                        if isinstance(r, dict) and isinstance(r.get("storagePath"), str)
+                    }
+                # Ensure uniqueness within this book prefix (deterministic-ish): append counter if needed.
+                else:
+                    object_name = assign_object_name(object_name, used_names, taken_names)
+
+                object_path = f"{args.prefix}/{book_slug}/images/{object_name}"
+
+                entry = {
+                    "originalName": original_name,
+                    "storedName": object_name,
+                    "storagePath": object_path,
+                    "originalBytes": original_size,
+                    "storedBytes": prepared.size,
+                    "storedExt": output_ext,
+                    "storedMime": content_type,
+                    "storedSha256": prepared.sha256,
+                }
+                if width and height:
+                    entry["width"] = width
+                    entry["height"] = height
+                if mode:
+                    entry["mode"] = mode
+                if prepared.decode_path:
+                    entry["decodePath"] = prepared.decode_path
+                if prepared.quality is not None:
+                    entry["jpegQuality"] = prepared.quality
+                    if prepared.ssim is not None:
+                        entry["ssim"] = prepared.ssim
+                if prepared.encode_attempts:
+                    entry["encodeAttempts"] = prepared.encode_attempts
+                    if prepared.encode_attempts > 1:
+                        print(f"  [INFO] {original_name}: {prepared.encode_attempts} encode attempts to fit --max-upload-mb")
+
+                uploads = [(object_path, content_type, body, prepared.sha256)]
+                if prepared.renditions:
+                    entry["renditions"] = []
+                    for r in prepared.renditions:
+                        r_prev = prev_renditions.get((r.name, r.format))
+                        if name_plan is not None:
+                            r_file = rendition_plan[(original_name, r.name, r.format)]
+                            if os.path.splitext(r_file)[1] != f".{r.ext}":
+                                raise RuntimeError(f"BLOCKED: {book_slug}/{original_name}: planned rendition {r.name}/{r_file} does not match .{r.ext} output")
+                        elif r_prev is not None and r_prev.endswith(f".{r.ext}"):
+                            r_file = r_prev.rsplit("/", 1)[1]
+                        else:
+                            r_file = assign_object_name(
+                                rendition_object_name(object_name, r.ext), rendition_used[r.name], rendition_taken[r.name]
+                            )
+                        r_path = f"{renditions_prefix}{r.name}/{r_file}"
+                        r_mime = mime_for_ext(r.ext)
+                        # "jpeg" renditions of images with alpha are written as PNG (see encode_rendition).
+                        r_format = "png" if r.ext == "png" else r.format
+                        entry["renditions"].append(  # type: ignore[attr-defined]
+                            {
+                                "name": r.name,
+                                "format": r_format,
+                                **({"requestedFormat": r.format} if r_format != r.format else {}),
+                                "storagePath": r_path,
+                                "width": r.width,
+                                "height": r.height,
+                                "bytes": len(r.body),
+                                "mime": r_mime,
+                                "sha256": r.sha256,
+                                **({"jpegQuality": r.quality, "ssim": r.ssim} if r.ssim is not None else {}),
+                            }
+                        )
+                        uploads.append((r_path, r_mime, r.body, r.sha256))
+
+                if near is not None and prepared.phash is not None and prepared.dhash is not None:
+                    entry["phash"], entry["dhash"] = f"{prepared.phash:016x}", f"{prepared.dhash:016x}"
+                    aspect = prepared.probe.aspect if prepared.probe is not None else None
+                    match = near.query(phash=prepared.phash, dhash=prepared.dhash, aspect=aspect, ext=output_ext)
+                    if match is None:
+                        near.add(near_dup_item(book_slug, entry, aspect))
+                    else:
+                        # Served from the canonical's object(s): nothing of this file is uploaded.
+                        canonical, distance = match
+                        entry = duplicate_entry(entry, canonical, distance)
+                        object_path = str(entry["storagePath"])
+                        uploads = []
+                        near_dups += 1
+                        print(
+                            f"  [OK] near-duplicate: {original_name} -> "
+                            f"{canonical['bookSlug']}/{canonical['originalName']} (distance {distance})"
+                        )
+
+                # Index structures are created above; keep them simple and JSON-friendly.
+                index["entries"].append(entry)  # type: ignore
+                index["srcMap"][original_name] = object_path  # type: ignore
+
+                file_stats[original_name] = {
+                    "converted": isinstance(body, bytes),
+                    "bytes_in": original_size,
+                    "bytes_out": sum(body_size(b) for _, _, b, _ in uploads),
+                    "stages": {**prepared.timings, "stat": prepared.timings.get("stat", 0.0) + stat_s},
+                    "retries": 0,
+                    "objects": len(uploads),
+                }
+
+                if args.dry_run:
+                    metrics.file_done(book=book_slug, name=original_name, **file_stats.pop(original_name))  # type: ignore[arg-type]
+                    if i % 25 == 0 or i == len(files):
+                        print(f"  (dry-run) {i}/{len(files)}")
+                    continue
+
+                upsert = args.upsert or sync_status.get(original_name) == "changed" or original_name in refresh
+                if remote is not None and uploads:
+                    # --reconcile-remote: drop objects already in the bucket byte for byte; overwrite the rest.
+                    missing = [u for u in uploads if not remote_matches(remote.get(u[0]), body=u[2], sha256=u[3])]
+                    remote_skipped += len(uploads) - len(missing)
+                    remote_present += 0 if missing else 1
+                    upsert = upsert or any(u[0] in remote for u in missing)
+                    uploads = missing
+                if not uploads:
+                    # Nothing to send (already in the bucket, or a near-duplicate): confirmed as is.
+                    if resume_enabled:
+                        resume_store.record(original_name, entry, sync_sources.get(original_name))
+                    metrics.file_done(book=book_slug, name=original_name, **file_stats.pop(original_name))  # type: ignore[arg-type]
+                    continue
+
+                settle(max(0, max_in_flight - len(uploads)))
+                pending_objects[original_name] = len(uploads)
+                for up_path, up_type, up_body, up_sha in uploads:
+                    fut = uploader.submit(
+                        object_path=up_path, content_type=up_type, body=up_body, upsert=upsert, metadata={"sha256": up_sha}
+                    )
+                    in_flight[fut] = (original_name, entry)
+
+            settle(0)
+            resume_store.close()
+            if remote is not None:
+                print(
+                    f"  [OK] remote: {remote_present} files already present, {remote_skipped} objects skipped, "
+                    f"{uploaded_count} files uploaded"
+                )
+            if near_refs is not None:
+                near_refs.retain_book(book_slug, index["entries"])  # type: ignore[arg-type]
+                if not args.dry_run:
+                    near_refs.save()
+            if near is not None:
+                print(f"  [OK] near-duplicates: {near_dups} files resolved to canonical objects")
+            metrics.emit(
+                "book",
+                book=book_slug,
+                files=len(files),
+                processed=len(jobs),
+                resumed=len(files) - len(jobs),
+                seconds=round(time.time() - book_start, 3),
+            )
+
+            # Upload index JSON (a split book uploads its shard's part; --merge-shards publishes the index).
+            index_path = f"{args.prefix}/{book_slug}/images-index.json"
+            if name_plan is not None and shard is not None:
+                index_path = shard_index_path(args.prefix, book_slug, shard[0], shard[1])
+                index.update(shard=shard[0], shards=shard[1], bookFiles=book_files)
+            index_bytes = json.dumps(index, ensure_ascii=False, indent=2).encode("utf-8")
+            if args.dry_run:
+                print(f"  (dry-run) would upload index: {index_path}")
+            else:
+                storage.upload(object_path=index_path, content_type="application/json", body=index_bytes, upsert=True)
+                print(f"  [OK] uploaded index: {index_path}")
+            if not args.no_compact_index and not (name_plan is not None and shard is not None):
+                publish_compact_index(
+                    storage, index, prefix=args.prefix, prefix_len=int(args.compact_index_prefix_len), dry_run=args.dry_run
+                )
+
+            if args.sync:
+                # Only after the new index is live: delete objects it no longer references.
+                removed = sorted(name for name in uploaded_by_original if name not in file_names)
+                live_paths = {p for e in index["entries"] for p in entry_storage_paths(e)}  # type: ignore
+                orphans = sorted(prev_storage_paths - live_paths)
+                if near_refs is not None:
+                    # Still the canonical object of a near-duplicate elsewhere in the library: keep it.
+                    shared = near_refs.referenced_paths()
+                    kept = [p for p in orphans if p in shared]
+                    orphans = [p for p in orphans if p not in shared]
+                    if kept:
+                        print(f"  [WARN] sync: kept {len(kept)} orphaned objects still used by near-duplicates", file=sys.stderr)
+                if args.dry_run:
+                    if orphans:
+                        print(f"  (dry-run) would delete {len(orphans)} orphaned objects")
+                else:
+                    if orphans:
+                        storage.delete(orphans)
+                    for name in removed:
+                        resume_store.forget(name)
+                    resume_store.close()
+                counts = {k: sum(1 for v in sync_status.values() if v == k) for k in ("added", "changed", "unchanged")}
+                print(
+                    f"  [OK] sync: added {counts['added']}, changed {counts['changed']}, unchanged {counts['unchanged']}, "
+                    f"removed {len(removed)} (orphaned objects deleted: {0 if args.dry_run else len(orphans)})"
+                )
+    finally:
+        if limiter is not None:
+            print(f"\n[OK] Upload concurrency: {limiter.describe()}")
+            metrics.emit(
+                "upload_limiter", limit=round(limiter.limit, 2), peak=round(limiter.peak, 2), throttled=limiter.throttled
+            )
+        metrics.close()
+        uploader.shutdown()
+        if mock is not None:
+            mock.stop()
+            st = mock.stats
+            print(
+                f"\n[OK] Mock storage: {len(mock.objects)} objects, {st['requests']} requests, "
+                f"{st['injected429']} x 429, {st['injected5xx']} x 5xx, {st['bytesIn'] / 2**20:.1f} MB received"
             )
-            print(f"  [OK] uploaded index: {index_path}")
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if cache is not None:
+            evicted, kept = cache.prune()
+            print(f"\n[OK] Rendition cache: {kept / (1024 * 1024):.1f} MB kept, {evicted} evicted")
 
     dur = time.time() - start
+    metrics.print_summary()
+    if args.metrics_out:
+        print(f"[OK] Metrics events: {args.metrics_out}")
     print(f"\n[OK] Done. Uploaded {total_uploaded} objects in {dur:.1f}s")
 
 
@@ -3,12 +3,29 @@
 """
 Extract and organize book images from extracted_images.zip
 Creates: books/{book_name}/images/ for each book
+
+Incremental: a member whose size and CRC32 (from the zip's central directory) match the
+file already on disk is skipped, so re-running after a small zip update only writes what
+changed (and unchanged files keep their mtime for upload-book-image-library.py --sync).
+Parallel: worker processes each open their own ZipFile handle and extract a partition of
+the members, so deflate decompression and CRC checks use every core.
+
+--dedup: members are grouped by (CRC32, size) and verified by SHA-256 while inflating; each
+distinct payload is written once to books/.content/ and hardlinked into every book that uses
+it, and books/duplicate-map.json lists the files sharing a payload so downstream tools can
+skip repeat work. Editing a linked file in place changes it for every book sharing it.
 """
 import zipfile
 import os
 import sys
+import zlib
+import json
+import hashlib
+import heapq
+import argparse
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import shutil
 
 # Fix Windows console encoding
@@ -19,24 +36,209 @@ if sys.platform == 'win32':
 
 ZIP_PATH = Path("extracted_images.zip")
 OUTPUT_BASE = Path("books")
+CHUNK_SIZE = 1024 * 1024
+# Work units per worker: enough to balance uneven partitions and report progress.
+TASKS_PER_WORKER = 4
+CONTENT_DIR = ".content"
+DUPLICATE_MAP = "duplicate-map.json"
+
+# This process's ZipFile handle (opened once per worker by open_worker_zip).
+_worker_zip = None
+
+
+def open_worker_zip(zip_path):
+    global _worker_zip
+    _worker_zip = zipfile.ZipFile(zip_path, 'r')
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def hash_file(path):
+    """CRC32 and SHA-256 of a file in one pass."""
+    crc = 0
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            sha.update(chunk)
+    return crc, sha.hexdigest()
+
+
+def is_up_to_date(dest_path, info):
+    """Same size (cheap stat) and then same CRC32 as the zip member."""
+    try:
+        if dest_path.stat().st_size != info.file_size:
+            return False
+    except OSError:
+        return False
+    return file_crc32(dest_path) == info.CRC
+
+
+def extract_members(members, force=False):
+    """
+    Extract (zip entry, destination path) pairs with this process's ZipFile.
+    Files are written to a temp name and renamed, so an interrupted run never leaves a partial image.
+    Returns (extracted, skipped, errors).
+    """
+    extracted = skipped = 0
+    errors = []
+    for zip_path, dest in members:
+        dest_path = Path(dest)
+        tmp_path = dest_path.with_name(f"{dest_path.name}.{os.getpid()}.tmp")
+        try:
+            info = _worker_zip.getinfo(zip_path)
+            if not force and is_up_to_date(dest_path, info):
+                skipped += 1
+                continue
+            with _worker_zip.open(info) as source:
+                with open(tmp_path, 'wb') as target:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+            os.replace(tmp_path, dest_path)
+            extracted += 1
+        except Exception as e:
+            errors.append(f"{zip_path}: {e}")
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+    return extracted, skipped, errors
+
+
+def link_into(src, dest_path):
+    """Hardlink src at dest_path, replacing it atomically (copy when the filesystem can't link)."""
+    tmp_path = dest_path.with_name(f"{dest_path.name}.{os.getpid()}.tmp")
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+def store_groups(groups, store_dir, force=False):
+    """
+    --dedup worker. Each group holds the (zip entry, destination path) pairs sharing one (CRC32, size).
+    Every member is hashed (from disk when the destination is already up to date, otherwise while
+    inflating), each distinct SHA-256 is stored once as store_dir/ab/abcd..., and each destination
+    becomes a hardlink to its store file. Groups never share a payload, so workers never race on one.
+    Returns (stored, linked, skipped, errors, digests) with digests as (destination, sha256) pairs.
+    """
+    stored = linked = skipped = 0
+    errors = []
+    digests = []
+    tmp_path = store_dir / f"{os.getpid()}.tmp"
+    for group in groups:
+        for zip_path, dest in group:
+            dest_path = Path(dest)
+            try:
+                info = _worker_zip.getinfo(zip_path)
+                digest = None
+                if not force and dest_path.exists() and dest_path.stat().st_size == info.file_size:
+                    crc, digest = hash_file(dest_path)
+                    if crc != info.CRC:
+                        digest = None
+                if digest is None:
+                    sha = hashlib.sha256()
+                    with _worker_zip.open(info) as source:
+                        with open(tmp_path, 'wb') as target:
+                            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                                sha.update(chunk)
+                                target.write(chunk)
+                    digest = sha.hexdigest()
+                    store_path = store_dir / digest[:2] / digest
+                    if store_path.exists():
+                        tmp_path.unlink()
+                    else:
+                        store_path.parent.mkdir(exist_ok=True)
+                        os.replace(tmp_path, store_path)
+                        stored += 1
+                else:
+                    store_path = store_dir / digest[:2] / digest
+                    if not store_path.exists():
+                        # Adopt the file already on disk as the store copy.
+                        store_path.parent.mkdir(exist_ok=True)
+                        link_into(dest_path, store_path)
+                        stored += 1
+                if dest_path.exists() and os.path.samefile(dest_path, store_path):
+                    skipped += 1
+                else:
+                    link_into(store_path, dest_path)
+                    linked += 1
+                digests.append((dest, digest))
+            except Exception as e:
+                errors.append(f"{zip_path}: {e}")
+                try:
+                    tmp_path.unlink()
+                except OSError:
+                    pass
+    return stored, linked, skipped, errors, digests
+
+
+def write_duplicate_map(path, zip_path, output_base, digests, sizes_by_dest):
+    """
+    Write {output_base}/duplicate-map.json: every payload used by more than one file, with the files
+    (relative to output_base, first one canonical) and the bytes a per-file pipeline would repeat.
+    """
+    files_by_digest = defaultdict(list)
+    for dest, digest in digests:
+        files_by_digest[digest].append(Path(dest).relative_to(output_base).as_posix())
+    duplicates = []
+    for digest, files in files_by_digest.items():
+        if len(files) > 1:
+            files.sort()
+            duplicates.append({"sha256": digest, "size": sizes_by_dest[files[0]], "files": files})
+    duplicates.sort(key=lambda d: (-d["size"] * (len(d["files"]) - 1), d["files"][0]))
+    duplicate_bytes = sum(d["size"] * (len(d["files"]) - 1) for d in duplicates)
+    doc = {
+        "version": 1,
+        "source": Path(zip_path).name,
+        "store": CONTENT_DIR,
+        "files": len(digests),
+        "payloads": len(files_by_digest),
+        "duplicateBytes": duplicate_bytes,
+        "duplicates": duplicates,
+    }
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(doc, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    os.replace(tmp_path, path)
+    return len(duplicates), duplicate_bytes
+
+
+def partition(items, weight, parts):
+    """Split items into `parts` lists of similar total weight (heaviest first into the lightest part)."""
+    heap = [(0, i) for i in range(parts)]
+    buckets = [[] for _ in range(parts)]
+    for item in sorted(items, key=weight, reverse=True):
+        load, i = heapq.heappop(heap)
+        buckets[i].append(item)
+        heapq.heappush(heap, (load + weight(item), i))
+    return [b for b in buckets if b]
+
 
-def extract_and_organize():
+def extract_and_organize(zip_path=ZIP_PATH, output_base=OUTPUT_BASE, workers=0, force=False, dedup=False):
     """Extract zip and organize images by book"""
-    
-    if not ZIP_PATH.exists():
-        print(f"ERROR: {ZIP_PATH} not found!")
+
+    if not zip_path.exists():
+        print(f"ERROR: {zip_path} not found!")
         return
-    
-    print(f"Opening {ZIP_PATH}...")
-    
+
+    print(f"Opening {zip_path}...")
+
     # First pass: identify all books and their images
     books_images = defaultdict(list)
-    
-    with zipfile.ZipFile(ZIP_PATH, 'r') as zip_ref:
+    sizes = {}
+    crcs = {}
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
         print("Scanning zip structure...")
-        all_entries = zip_ref.namelist()
-        
-        for entry in all_entries:
+
+        for info in zip_ref.infolist():
+            entry = info.filename
             # Look for pattern: extracted_images/{book_name}/linked_images/{image_file}
             parts = entry.split('/')
             # Skip directory entries (end with /)
@@ -48,40 +250,119 @@ def extract_and_organize():
                 image_file = '/'.join(parts[3:])  # Get full path after linked_images/
                 if image_file:  # Skip empty
                     books_images[book_name].append((entry, image_file))
-        
-        print(f"Found {len(books_images)} books:")
-        for book_name, images in books_images.items():
-            print(f"  - {book_name}: {len(images)} images")
-        
-        # Extract and organize
-        print("\nExtracting and organizing...")
-        total_files = sum(len(images) for images in books_images.values())
-        processed = 0
-        
-        for book_name, image_list in books_images.items():
-            book_dir = OUTPUT_BASE / book_name / "images"
-            book_dir.mkdir(parents=True, exist_ok=True)
-            
-            print(f"  Processing {book_name}...")
-            
-            for zip_path, image_name in image_list:
-                # Extract to book-specific directory
-                dest_path = book_dir / Path(image_name).name
-                
-                try:
-                    with zip_ref.open(zip_path) as source:
-                        with open(dest_path, 'wb') as target:
-                            shutil.copyfileobj(source, target)
-                    
-                    processed += 1
-                    if processed % 100 == 0:
-                        print(f"    Progress: {processed}/{total_files} files...")
-                except Exception as e:
-                    print(f"    WARNING: Error extracting {zip_path}: {e}")
-        
-        print(f"\nComplete! Processed {processed} images")
-        print(f"Images organized in: {OUTPUT_BASE}/")
+                    sizes[entry] = info.file_size
+                    crcs[entry] = info.CRC
 
-if __name__ == "__main__":
-    extract_and_organize()
+    print(f"Found {len(books_images)} books:")
+    for book_name, images in books_images.items():
+        print(f"  - {book_name}: {len(images)} images")
+
+    # Destinations: images land flat in books/{book}/images/. When two entries share a file name
+    # the later one in the zip wins (as with sequential extraction), so each destination is written once.
+    members = {}
+    for book_name, image_list in books_images.items():
+        book_dir = output_base / book_name / "images"
+        book_dir.mkdir(parents=True, exist_ok=True)
+        for entry, image_name in image_list:
+            dest_path = book_dir / Path(image_name).name
+            if members.get(str(dest_path), entry) != entry:
+                print(f"    WARNING: {members[str(dest_path)]} and {entry} both map to {dest_path}; keeping {entry}")
+            members[str(dest_path)] = entry
+    work = [(entry, dest) for dest, entry in members.items()]
+    total_files = len(work)
+
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    workers = max(1, min(workers, total_files))
+    mode = ", deduplicated" if dedup else ""
+    print(f"\nExtracting and organizing ({workers} workers{mode}{', forced' if force else ''})...")
+
+    if dedup:
+        extract_deduplicated(zip_path, output_base, work, sizes, crcs, workers, force)
+        return
+
+    extracted = skipped = 0
+    errors = []
+    if workers == 1:
+        open_worker_zip(zip_path)
+        try:
+            extracted, skipped, errors = extract_members(work, force)
+        finally:
+            _worker_zip.close()
+    else:
+        tasks = partition(work, lambda m: sizes[m[0]], workers * TASKS_PER_WORKER)
+        with ProcessPoolExecutor(max_workers=workers, initializer=open_worker_zip, initargs=(str(zip_path),)) as pool:
+            futures = [pool.submit(extract_members, task, force) for task in tasks]
+            for fut in as_completed(futures):
+                done_extracted, done_skipped, done_errors = fut.result()
+                extracted += done_extracted
+                skipped += done_skipped
+                errors += done_errors
+                print(f"    Progress: {extracted + skipped + len(errors)}/{total_files} files...")
 
+    for error in errors:
+        print(f"    WARNING: Error extracting {error}")
+
+    print(f"\nComplete! Processed {extracted + skipped} images ({extracted} extracted, {skipped} unchanged)")
+    print(f"Images organized in: {output_base}/")
+
+
+def extract_deduplicated(zip_path, output_base, work, sizes, crcs, workers, force):
+    """--dedup: store each distinct payload once under output_base/.content and hardlink it into the books."""
+    store_dir = output_base / CONTENT_DIR
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    # Candidates from the central directory; store_groups confirms them by SHA-256.
+    by_key = defaultdict(list)
+    for entry, dest in work:
+        by_key[(crcs[entry], sizes[entry])].append((entry, dest))
+    groups = list(by_key.values())
+    total_files = len(work)
+    print(f"  {len(groups)} candidate payloads for {total_files} files")
+
+    stored = linked = skipped = 0
+    errors = []
+    digests = []
+    if workers == 1:
+        open_worker_zip(zip_path)
+        try:
+            stored, linked, skipped, errors, digests = store_groups(groups, store_dir, force)
+        finally:
+            _worker_zip.close()
+    else:
+        tasks = partition(groups, lambda g: sizes[g[0][0]] * len(g), workers * TASKS_PER_WORKER)
+        with ProcessPoolExecutor(max_workers=workers, initializer=open_worker_zip, initargs=(str(zip_path),)) as pool:
+            futures = [pool.submit(store_groups, task, store_dir, force) for task in tasks]
+            for fut in as_completed(futures):
+                done_stored, done_linked, done_skipped, done_errors, done_digests = fut.result()
+                stored += done_stored
+                linked += done_linked
+                skipped += done_skipped
+                errors += done_errors
+                digests += done_digests
+                print(f"    Progress: {linked + skipped + len(errors)}/{total_files} files...")
+
+    for error in errors:
+        print(f"    WARNING: Error extracting {error}")
+
+    sizes_by_dest = {Path(dest).relative_to(output_base).as_posix(): sizes[entry] for entry, dest in work}
+    map_path = output_base / DUPLICATE_MAP
+    shared, duplicate_bytes = write_duplicate_map(map_path, zip_path, output_base, digests, sizes_by_dest)
+
+    print(f"\nComplete! Processed {linked + skipped} images ({linked} linked, {skipped} unchanged)")
+    print(f"  {stored} new payloads in {store_dir}/; {shared} shared by several files "
+          f"({duplicate_bytes / (1024 * 1024):.1f} MB not stored twice)")
+    print(f"  Duplicate map: {map_path}")
+    print(f"Images organized in: {output_base}/")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract extracted_images.zip into books/{book}/images/.")
+    parser.add_argument("--zip", default=str(ZIP_PATH), help="Zip to extract.")
+    parser.add_argument("--out", default=str(OUTPUT_BASE), help="Output root (books/{book}/images/).")
+    parser.add_argument("--workers", type=int, default=0, help="Extraction processes (0 = one per CPU).")
+    parser.add_argument("--force", action="store_true", help="Rewrite every file, even if size and CRC32 match.")
+    parser.add_argument("--dedup", action="store_true",
+                        help=f"Store each distinct image once in OUT/{CONTENT_DIR}/, hardlink it into the books "
+                             f"and write OUT/{DUPLICATE_MAP}.")
+    args = parser.parse_args()
+    extract_and_organize(Path(args.zip), Path(args.out), workers=args.workers, force=args.force, dedup=args.dedup)